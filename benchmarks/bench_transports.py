@@ -0,0 +1,114 @@
+# Benchmark of the kernel's device connection against the emulator in
+# mpyemulator.py, over each kind of transport (a pty in place of the serial
+# port, a raw TCP socket, and the webrepl websocket), measuring:
+#   the round trip of an empty cell (execprogram -> receivestream)
+#   the throughput of parsing printed output (yieldserialchunk and receivestream)
+#   file transfer bytes/s (sendtofile and fetchfile of a binary file)
+#
+#   python benchmarks/bench_transports.py [--transport pty tcp websocket] [--baud 115200] [--latency 0.005] [--jitter 0.002]
+
+import argparse, random, time, sys, os, tempfile, statistics
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), ".."))
+from jupyter_micropython_kernel import deviceconnector
+import mpyemulator
+
+
+class Output:
+    # stands in for the kernel's sres, counting what it is given
+    def __init__(self):
+        self.nchars = 0
+        self.text = [ ]
+        self.bkeep = True
+
+    def sres(self, output, asciigraphicscode=None, n04count=0, clear_output=False):
+        self.nchars += len(output)
+        if self.bkeep:
+            self.text.append(output)
+
+    def sresSYS(self, output, clear_output=False):
+        self.sres(output)
+
+
+def connect(transport, emu, throttle, out):
+    dc = deviceconnector.DeviceConnector(out.sres, out.sresSYS)
+    if transport == "pty":
+        dc.serialconnect(mpyemulator.servepty(emu, throttle), 115200, False)
+    elif transport == "tcp":
+        dc.socketconnect("127.0.0.1", mpyemulator.servetcp(emu, throttle, 0))
+        dc.transport.write_all(b"\r\x01")   # (the kernel doesn't put a plain socket into the raw REPL itself)
+        time.sleep(0.2)
+        dc.workingserialreadall()
+    elif transport == "websocket":
+        dc.websocketconnect("ws://127.0.0.1:{}".format(mpyemulator.servewebsocket(emu, throttle, 0, "bench")))
+        dc.transport.read(len("Password: "), 2)
+        dc.transport.write_all(b"bench\r\n")
+        dc.workingserialreadall()
+    if not (dc.transport and dc.enterpastemode(verbose=False)):
+        raise RuntimeError("could not connect over {}: {}".format(transport, "".join(out.text)[-500:]))
+    return dc
+
+
+def benchlatency(dc, ncells):
+    times = [ ]
+    for i in range(ncells):
+        t0 = time.perf_counter()
+        dc.execprogram(b"pass")
+        times.append(time.perf_counter() - t0)
+    times.sort()
+    return statistics.median(times), times[int(len(times)*0.9)]
+
+
+def benchoutput(dc, out, nbytes):
+    line = "{:6d} temp=21.43 hum=40.7 " + "x"*30   # about 64 bytes a line with the \r\n
+    nlines = nbytes//64
+    out.bkeep = False
+    n0 = out.nchars
+    t0 = time.perf_counter()
+    dc.execprogram("for i in range({}):\r\n print({}.format(i))\r\n".format(nlines, repr(line)).encode())
+    dt = time.perf_counter() - t0
+    out.bkeep = True
+    return (out.nchars - n0)/dt
+
+
+def benchfiles(dc, nbytes):
+    if not dc.transport.brepl:
+        return None, None   # (no file transfers on a plain socket)
+    data = bytes(random.getrandbits(8)  for i in range(nbytes))
+    t0 = time.perf_counter()
+    dc.sendtofile("benchfile.bin", False, False, True, True, data)
+    tsend = time.perf_counter() - t0
+    t0 = time.perf_counter()
+    res = dc.fetchfile("benchfile.bin", True, True)
+    tfetch = time.perf_counter() - t0
+    assert res == data, "fetched file differs"
+    return nbytes/tsend, nbytes/tfetch
+
+
+if __name__ == "__main__":
+    ap = argparse.ArgumentParser()
+    ap.add_argument("--transport", nargs="+", choices=["pty", "tcp", "websocket"], default=["pty", "tcp", "websocket"])
+    ap.add_argument("--baud", type=int, default=0, help="throttle the device's output to this rate (0 for unlimited)")
+    ap.add_argument("--latency", type=float, default=0.0, help="seconds added to each write from the device")
+    ap.add_argument("--jitter", type=float, default=0.0)
+    ap.add_argument("--no-rawpaste", action="store_true")
+    ap.add_argument("--cells", type=int, default=50, help="empty cells timed for the round trip")
+    ap.add_argument("--output", type=float, default=1, help="megabytes printed for the output throughput")
+    ap.add_argument("--filesize", type=int, default=100000, help="bytes of the file sent and fetched")
+    args = ap.parse_args()
+
+    random.seed(1)
+    print("baud {}, latency {}s, jitter {}s, raw-paste {}".format(args.baud or "unlimited", args.latency, args.jitter, "off" if args.no_rawpaste else "on"))
+    print("{:10s} {:>10s} {:>10s} {:>12s} {:>12s} {:>12s}".format("transport", "cell ms", "p90 ms", "output B/s", "send B/s", "fetch B/s"))
+    for transport in args.transport:
+        fsroot = tempfile.mkdtemp(prefix="mpyemulator")
+        emu = mpyemulator.Emulator(fsroot, rawpaste=not args.no_rawpaste, windowsize=256)
+        throttle = mpyemulator.Throttle(args.baud, args.latency, args.jitter)
+        out = Output()
+        dc = connect(transport, emu, throttle, out)
+        tcell, tcell90 = benchlatency(dc, args.cells)
+        outputrate = benchoutput(dc, out, int(args.output*1e6))
+        sendrate, fetchrate = benchfiles(dc, args.filesize)
+        dc.disconnect(raw=True)
+        print("{:10s} {:10.1f} {:10.1f} {:12.0f} {:>12s} {:>12s}".format(transport, tcell*1000, tcell90*1000, outputrate, *[ "{:.0f}".format(r) if r else "-"  for r in (sendrate, fetchrate) ]))
+        sys.stdout.flush()
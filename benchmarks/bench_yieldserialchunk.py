@@ -0,0 +1,127 @@
+# Micro-benchmark of the serial chunker (deviceconnector.yieldserialchunk)
+# against the original byte-at-a-time implementation, which is kept here as
+# the reference for checking that the chunk sequence is unchanged.
+#
+#   python benchmarks/bench_yieldserialchunk.py [--mbytes 2] [--packet 64] [--idle 0.01]
+
+import argparse, random, time, sys, os
+import serial
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), ".."))
+from jupyter_micropython_kernel import deviceconnector, transports
+
+
+class FakeSerial(serial.SerialBase):
+    # delivers canned data in packet sized blocks like a USB-serial adaptor,
+    # with occasional idle timeouts between packets, then raises SerialException
+    # (as on unplugging) so the chunker terminates
+    def __init__(self, data, packetsize, idlefraction):
+        serial.SerialBase.__init__(self)
+        self.data = data
+        self.packetsize = packetsize
+        self.idlefraction = idlefraction
+        self.pos = 0
+        self.packetend = 0
+        self.idle = False
+
+    @property
+    def in_waiting(self):
+        if self.pos == self.packetend:
+            self.packetend = min(len(self.data), self.pos + random.randint(1, self.packetsize))
+        return self.packetend - self.pos
+
+    def read(self, size=1):
+        if self.pos >= len(self.data):
+            raise serial.SerialException("end of benchmark data")
+        if self.idle:
+            self.idle = False
+            return b''
+        size = min(size, self.in_waiting)
+        b = self.data[self.pos:self.pos+size]
+        self.pos += size
+        if self.pos == self.packetend:
+            self.idle = random.random() < self.idlefraction
+        return b
+
+
+# the per-byte loop as it was (serial branch only)
+def legacyyieldserialchunk(s):
+    res = [ ]
+    n = 0
+    while True:
+        try:
+            b = s.read()
+        except serial.SerialException as e:
+            yield b"\r\n**[ys] "
+            yield str(type(e)).encode("utf8")
+            yield b"\r\n**[ys] "
+            yield str(e).encode("utf8")
+            yield b"\r\n\r\n"
+            break
+        if not b:
+            if res and (res[0] != 'O' or len(res) > 3):
+                yield b''.join(res)
+                res.clear()
+            else:
+                n += 1
+                if (n%deviceconnector.serialtimeoutcount) == 0:
+                    yield b''
+        elif b == b'K' and len(res) >= 1 and res[-1] == b'O':
+            if len(res) > 1:
+                yield b''.join(res[:-1])
+            yield b'OK'
+            res.clear()
+        elif b == b'\x04' or b == b'>':
+            if res:
+                yield b''.join(res)
+            yield b
+            res.clear()
+        else:
+            res.append(b)
+            if b == b'\n' and len(res) >= 2 and res[-2] == b'\r':
+                yield b''.join(res)
+                res.clear()
+
+
+def makedevicestream(nbytes):
+    # a board printing sensor readings, with raw repl framing around each cell
+    # and a few awkward cases (OK inside text, lone \r, unicode, no newline)
+    parts = [ ]
+    total = 0
+    i = 0
+    while total < nbytes:
+        if i % 500 == 0:
+            p = b"OK" if i % 1000 == 0 else b"\x04\x04>"
+        elif i % 37 == 0:
+            p = "OKAY °C >> \r {}\r\r\n".format(i).encode()
+        else:
+            p = "{} temp={:.2f} hum={:.1f}\r\n".format(i, 20+i%50/7, 40+i%13/3).encode()
+        parts.append(p)
+        total += len(p)
+        i += 1
+    return b"".join(parts)
+
+
+def run(chunker, data, packetsize, idlefraction):
+    random.seed(1)   # same packetisation for both implementations
+    t0 = time.perf_counter()
+    chunks = list(chunker(FakeSerial(data, packetsize, idlefraction)))
+    return time.perf_counter() - t0, chunks
+
+
+if __name__ == "__main__":
+    ap = argparse.ArgumentParser()
+    ap.add_argument("--mbytes", type=float, default=2)
+    ap.add_argument("--packet", type=int, default=64, help="maximum bytes delivered per read")
+    ap.add_argument("--idle", type=float, default=0.01, help="fraction of packets followed by a read timeout")
+    args = ap.parse_args()
+
+    data = makedevicestream(int(args.mbytes*1e6))
+    tlegacy, clegacy = run(legacyyieldserialchunk, data, args.packet, args.idle)
+    tblock, cblock = run(lambda s: deviceconnector.yieldserialchunk(transports.SerialTransport(s)), data, args.packet, args.idle)
+
+    assert clegacy == cblock, "chunk sequences differ"
+    mb = len(data)/1e6
+    print("{:.2f}MB in {} chunks, packets up to {} bytes".format(mb, len(cblock), args.packet))
+    print("per-byte: {:8.2f} MB/s".format(mb/tlegacy))
+    print("block:    {:8.2f} MB/s  ({:.1f}x)".format(mb/tblock, tlegacy/tblock))
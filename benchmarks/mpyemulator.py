@@ -0,0 +1,546 @@
+# Pure-python stand-in for a MicroPython board, speaking the REPL protocols
+# that the kernel relies on: friendly REPL, raw REPL (Ctrl-A/B/C/D, OK and
+# \x04 framing, > prompts), raw-paste mode and the soft reboot banner.
+# Programs are run with exec() in a namespace that has small stand-ins for
+# os, gc, ubinascii, uhashlib etc, with the filesystem rooted in a directory.
+#
+# It can be attached to a pty (which pyserial opens like a real port),
+# a raw TCP socket, or a websocket in the style of the WebREPL, and can be
+# throttled to a baud rate with added latency and jitter.
+#
+#   python benchmarks/mpyemulator.py --pty             (prints the port name)
+#   python benchmarks/mpyemulator.py --tcp 8023
+#   python benchmarks/mpyemulator.py --websocket 8266 --password pass
+
+import os, sys, io, time, random, threading, traceback, argparse, types
+import binascii, hashlib, struct, socket, select, base64, zlib, queue
+
+BANNER = b'MicroPython v1.20.0 on 2023-04-26; emulator with python\r\nType "help()" for more information.\r\n'
+
+
+class Throttle:
+    # delivers writes to the host after a latency (with jitter), paced to a 
+    # baud rate, from its own thread so that the latency is pipelined like a real link
+    def __init__(self, baudrate=0, latency=0.0, jitter=0.0):
+        self.bytetime = 10.0/baudrate if baudrate else 0.0
+        self.latency = latency
+        self.jitter = jitter
+        self.queue = queue.Queue()
+        self.writefunc = None
+        threading.Thread(target=self.loop, daemon=True).start()
+
+    def write(self, b):
+        if not (self.bytetime or self.latency or self.jitter):
+            self.writefunc(b)
+            return
+        self.queue.put((time.time() + self.latency + random.uniform(0, self.jitter), b))
+
+    def receive(self, nbytes):   # time for bytes from the host to arrive at the baud rate
+        if self.bytetime:
+            time.sleep(nbytes*self.bytetime)
+
+    def loop(self):
+        tfree = 0   # when the simulated line is next free
+        while True:
+            tdue, b = self.queue.get()
+            t = max(tdue, tfree)
+            dt = t - time.time()
+            if dt > 0:
+                time.sleep(dt)
+            tfree = max(t, time.time()) + len(b)*self.bytetime
+            self.writefunc(b)
+
+
+class DeviceFS:
+    # os-module stand in with paths rooted in a host directory
+    def __init__(self, root):
+        self.root = os.path.abspath(root)
+        self.cwd = "/"
+
+    def path(self, p):
+        p = p if p.startswith("/") else (self.cwd.rstrip("/") + "/" + p)
+        return os.path.join(self.root, os.path.normpath(p).lstrip("/"))
+
+    def makeosmodule(self):
+        fs = self
+        m = types.ModuleType("os")
+        m.listdir = lambda p="": os.listdir(fs.path(p))
+        m.mkdir = lambda p: os.mkdir(fs.path(p))
+        m.remove = lambda p: os.remove(fs.path(p))
+        m.rmdir = lambda p: os.rmdir(fs.path(p))
+        m.rename = lambda a, b: os.rename(fs.path(a), fs.path(b))
+        m.getcwd = lambda: fs.cwd
+        def chdir(p):
+            fs.cwd = os.path.normpath(p if p.startswith("/") else fs.cwd + "/" + p)
+        m.chdir = chdir
+        def stat(p):
+            st = os.stat(fs.path(p))
+            return (0x4000 if os.path.isdir(fs.path(p)) else 0x8000, 0, 0, 0, 0, 0, st.st_size, 0, 0, 0)
+        m.stat = stat
+        def ilistdir(p=""):
+            for fn in sorted(os.listdir(fs.path(p))):
+                fp = os.path.join(fs.path(p), fn)
+                yield (fn, 0x4000 if os.path.isdir(fp) else 0x8000, 0, os.path.getsize(fp) if os.path.isfile(fp) else 0)
+        m.ilistdir = ilistdir
+        m.uname = lambda: ("emulator", "emulator", "1.20.0", "v1.20.0", "emulator")
+        return m
+
+    def open(self, p, mode="r"):
+        return open(self.path(p), mode)
+
+
+class DeflateIO:
+    # micropython's deflate.DeflateIO (raw format only), reading decompresses, writing compresses
+    def __init__(self, stream, format=-1, wbits=0, close=False):
+        self.stream = stream
+        self.wbits = max(9, wbits)   # zlib here can't do the 256 byte window micropython defaults to
+        self.decomp = zlib.decompressobj(-self.wbits)
+        self.comp = None
+        self.pending = b""
+
+    def readinto(self, buf):
+        while len(self.pending) < len(buf) and not self.decomp.eof:
+            d = self.stream.read(256)
+            if not d:
+                break
+            self.pending += self.decomp.decompress(d)
+        n = min(len(buf), len(self.pending))
+        buf[:n] = self.pending[:n]
+        self.pending = self.pending[n:]
+        return n
+
+    def write(self, b):
+        if self.comp is None:
+            self.comp = zlib.compressobj(9, zlib.DEFLATED, -self.wbits)
+        self.stream.write(self.comp.compress(bytes(b)))
+        return len(b)
+
+    def close(self):
+        if self.comp is not None:
+            self.stream.write(self.comp.flush())
+
+
+class Emulator:
+    def __init__(self, fsroot, rawpaste=True, windowsize=128, memfree=100000, compression="deflate"):
+        self.fs = DeviceFS(fsroot)
+        self.compression = compression   # deflate (1.21+ with compression), uzlib (DecompIO only) or none
+        self.rawpaste = rawpaste
+        self.windowsize = windowsize
+        self.memfree = memfree
+        self.outfunc = None       # where device output goes
+        self.throttlereceive = lambda nbytes: None
+        self.lock = threading.Lock()
+        self.reset()
+
+    def reset(self):
+        self.mode = "friendly"    # friendly, raw, rawpaste
+        self.buf = bytearray()
+        self.pasteheader = b""
+        self.pasteremain = 0
+        self.namespace = self.makenamespace()
+
+    def makenamespace(self):
+        emu = self
+        out = self.out
+        class StdOut:
+            def write(self, s):
+                out(s.replace("\n", "\r\n").encode() if type(s) == str else bytes(s).replace(b"\n", b"\r\n"))   # cooked, like the device
+                return len(s)
+            @property
+            def buffer(self):
+                class B:
+                    def write(self, b):
+                        out(bytes(b))
+                        return len(b)
+                return B()
+        modules = { }
+        modules["os"] = modules["uos"] = self.fs.makeosmodule()
+        gc = types.ModuleType("gc")
+        gc.collect = lambda: None
+        gc.mem_free = lambda: emu.memfree
+        modules["gc"] = gc
+        ub = types.ModuleType("ubinascii")
+        ub.a2b_base64 = binascii.a2b_base64
+        ub.b2a_base64 = binascii.b2a_base64
+        ub.hexlify = binascii.hexlify
+        modules["ubinascii"] = modules["binascii"] = ub
+        uh = types.ModuleType("uhashlib")
+        uh.sha256 = hashlib.sha256
+        modules["uhashlib"] = modules["hashlib"] = uh
+        us = types.ModuleType("sys")
+        us.stdout = StdOut()
+        us.platform = "emulator"
+        us.byteorder = sys.byteorder
+        us.modules = modules
+        us.implementation = types.SimpleNamespace(name="micropython", version=(1, 20, 0), _mpy=6)
+        modules["sys"] = modules["usys"] = us
+        for name in ("struct", "time", "array", "json", "math", "io"):
+            modules[name] = __import__(name)
+        modules["ustruct"] = struct
+        if self.compression == "deflate":
+            modules["deflate"] = types.SimpleNamespace(DeflateIO=DeflateIO, RAW=-1, ZLIB=1, GZIP=2)
+        elif self.compression == "uzlib":
+            modules["uzlib"] = types.SimpleNamespace(DecompIO=lambda stream, wbits: DeflateIO(stream, -1, -wbits))
+        modules["utime"] = time
+
+        def emuimport(name, globals=None, locals=None, fromlist=(), level=0):
+            if name in modules:
+                return modules[name]
+            for path in [ emu.fs.path(d + name + ".py")  for d in ("", "lib/") ]:   # (sys.path of '' and /lib)
+                if os.path.exists(path):
+                    m = types.ModuleType(name)
+                    m.__dict__.update(dict(ns))
+                    exec(compile(open(path).read(), name, "exec"), m.__dict__)
+                    modules[name] = m
+                    return m
+            raise ImportError("no module named '{}'".format(name))
+
+        def emuprint(*args, sep=" ", end="\n"):
+            out((sep.join(map(str, args)) + end).replace("\n", "\r\n").encode())
+
+        builtins = dict(__builtins__ if type(__builtins__) == dict else __builtins__.__dict__)
+        builtins.update(print=emuprint, open=self.fs.open, __import__=emuimport)
+        ns = {"__builtins__": builtins, "__name__": "__main__"}
+        self.modules = modules
+        return ns
+
+    def out(self, b):
+        if self.outfunc:
+            self.outfunc(b)
+
+    def execute(self, source):
+        try:
+            exec(compile(source, "<stdin>", "exec"), self.namespace)
+            self.out(b"\x04")
+        except SystemExit:
+            self.out(b"\x04")
+        except BaseException as e:
+            tb = traceback.format_exception_only(type(e), e)
+            self.out(b"\x04")
+            self.out(("Traceback (most recent call last):\n" + "".join(tb)).replace("\n", "\r\n").encode())
+        self.out(b"\x04")
+
+    def softreboot(self):
+        self.namespace = self.makenamespace()
+        self.out(b"MPY: soft reboot\r\n")
+
+    # bytes arriving from the host
+    def feed(self, data):
+        with self.lock:
+            for c in data:
+                self.feedbyte(c)
+
+    def feedbyte(self, c):
+        if self.mode == "rawpaste":
+            if c == 0x04:
+                self.out(b"\x04")
+                self.mode = "raw"
+                source = bytes(self.buf)
+                self.buf.clear()
+                self.execute(source)
+                self.out(b">")
+            else:
+                self.buf.append(c)
+                self.pasteremain -= 1
+                if self.pasteremain == 0:
+                    self.pasteremain = self.windowsize
+                    self.out(b"\x01")
+            return
+
+        if self.mode == "raw":
+            if self.pasteheader or c == 0x05:
+                self.pasteheader += bytes([c])
+                if len(self.pasteheader) < 3:
+                    return
+                header, self.pasteheader = self.pasteheader, b""
+                if header == b"\x05A\x01":
+                    if self.rawpaste:   # the window size plus one \x01, so the host can have two windows in flight
+                        self.out(b"R\x01" + struct.pack("<H", self.windowsize) + b"\x01")
+                        self.mode = "rawpaste"
+                        self.pasteremain = self.windowsize
+                        self.buf.clear()
+                    else:
+                        self.out(b"R\x00")
+                    return
+                for b in header:    # not a raw paste request after all
+                    self.buf.append(b)
+                return
+            if c == 0x01:
+                self.buf.clear()
+                self.out(b"raw REPL; CTRL-B to exit\r\n>")
+            elif c == 0x02:
+                self.mode = "friendly"
+                self.buf.clear()
+                self.out(b"\r\n" + BANNER + b">>> ")
+            elif c == 0x03:
+                self.buf.clear()
+            elif c == 0x04:
+                if not self.buf:
+                    self.out(b"OK")
+                    self.softreboot()
+                    self.out(b"raw REPL; CTRL-B to exit\r\n>")
+                    return
+                self.out(b"OK")
+                source = bytes(self.buf)
+                self.buf.clear()
+                self.execute(source)
+                self.out(b">")
+            else:
+                self.buf.append(c)
+            return
+
+        # friendly repl, with echo
+        if c == 0x01:
+            self.mode = "raw"
+            self.buf.clear()
+            self.out(b"\r\nraw REPL; CTRL-B to exit\r\n>")
+        elif c == 0x03:
+            self.buf.clear()
+            self.out(b"\r\n>>> ")
+        elif c == 0x04:
+            self.softreboot()
+            self.out(BANNER + b">>> ")
+        elif c == 0x0d:
+            line = bytes(self.buf)
+            self.buf.clear()
+            self.out(b"\r\n")
+            if line.strip():
+                source = line.decode()
+                try:
+                    try:
+                        r = eval(compile(source, "<stdin>", "eval"), self.namespace)
+                        if r is not None:
+                            self.out((repr(r) + "\r\n").encode())
+                    except SyntaxError:
+                        exec(compile(source, "<stdin>", "exec"), self.namespace)
+                except BaseException as e:
+                    self.out(("Traceback (most recent call last):\n" + "".join(traceback.format_exception_only(type(e), e))).replace("\n", "\r\n").encode())
+            self.out(b">>> ")
+        elif c != 0x0a:
+            self.buf.append(c)
+            self.out(bytes([c]))
+
+
+def servepty(emu, throttle):
+    import pty, tty
+    master, slave = pty.openpty()
+    tty.setraw(slave)
+    throttle.writefunc = lambda b: os.write(master, b)
+    emu.outfunc = throttle.write
+    def loop():
+        while True:
+            try:
+                data = os.read(master, 4096)
+            except OSError:
+                break
+            if not data:
+                break
+            throttle.receive(len(data))
+            emu.feed(data)
+    threading.Thread(target=loop, daemon=True).start()
+    return os.ttyname(slave)
+
+
+def servetcp(emu, throttle, port):
+    srv = socket.socket()
+    srv.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+    srv.bind(("127.0.0.1", port))
+    srv.listen(1)
+    def loop():
+        while True:
+            conn, addr = srv.accept()
+            conn.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+            def writeout(b, conn=conn):
+                try:
+                    conn.sendall(b)
+                except OSError:
+                    pass
+            throttle.writefunc = writeout
+            emu.outfunc = throttle.write
+            while True:
+                try:
+                    data = conn.recv(4096)
+                except OSError:
+                    break
+                if not data:
+                    break
+                emu.feed(data)
+    threading.Thread(target=loop, daemon=True).start()
+    return srv.getsockname()[1]
+
+
+# websocket framing (server side: sends unmasked, receives masked frames)
+def wsframe(opcode, payload):
+    n = len(payload)
+    if n < 126:
+        header = struct.pack("!BB", 0x80 | opcode, n)
+    elif n < 65536:
+        header = struct.pack("!BBH", 0x80 | opcode, 126, n)
+    else:
+        header = struct.pack("!BBQ", 0x80 | opcode, 127, n)
+    return header + payload
+
+def wsreadframe(conn):
+    def recvn(n):
+        b = b""
+        while len(b) < n:
+            d = conn.recv(n - len(b))
+            if not d:
+                raise EOFError
+            b += d
+        return b
+    b0, b1 = recvn(2)
+    n = b1 & 0x7f
+    if n == 126:
+        n, = struct.unpack("!H", recvn(2))
+    elif n == 127:
+        n, = struct.unpack("!Q", recvn(8))
+    mask = recvn(4) if b1 & 0x80 else b"\0\0\0\0"
+    payload = recvn(n)
+    return b0 & 0x0f, bytes(c ^ mask[i%4]  for i, c in enumerate(payload))
+
+
+# The WebREPL: a password prompt, the REPL in text frames, and the binary 
+# file protocol of modwebrepl.c ("WA" request header, "WB" status replies)
+class WebREPLFiles:
+    def __init__(self, emu, sendbinary):
+        self.emu = emu
+        self.sendbinary = sendbinary
+        self.hdr = b""
+        self.fput = None
+        self.putremain = 0
+        self.fget = None
+
+    def status(self, code):
+        self.sendbinary(struct.pack("<2sH", b"WB", code))
+
+    # the request bytes are read as a stream, whatever the frame boundaries
+    def feed(self, data):
+        data = bytes(data)
+        while data:
+            if self.fput:
+                w = data[:self.putremain]
+                self.emu.throttlereceive(len(w))
+                self.fput.write(w)
+                data = data[len(w):]
+                self.putremain -= len(w)
+                if self.putremain == 0:
+                    self.fput.close()
+                    self.fput = None
+                    self.status(0)
+            elif self.fget:   # each \0 from the host asks for the next block
+                data = data[1:]
+                b = self.fget.read(510)   # the size of the device's filebuf less the 2 byte length
+                self.sendbinary(struct.pack("<H", len(b)) + b)
+                if not b:
+                    self.fget.close()
+                    self.fget = None
+                    self.status(0)
+            else:
+                n = 82 - len(self.hdr)
+                self.hdr += data[:n]
+                data = data[n:]
+                if len(self.hdr) == 82:
+                    self.handleop()
+
+    def handleop(self):
+        sig, op, r1, r2, size, fnlen, fname = struct.unpack("<2sBBQLH64s", self.hdr)
+        self.hdr = b""
+        fname = fname[:fnlen].decode()
+        try:
+            if op == 1:
+                self.fput = self.emu.fs.open(fname, "wb")
+                self.putremain = size
+                self.status(0)
+                if size == 0:
+                    self.fput.close()
+                    self.fput = None
+                    self.status(0)
+            elif op == 2:
+                self.fget = self.emu.fs.open(fname, "rb")
+                self.status(0)
+            elif op == 3:
+                self.sendbinary(bytes([1, 20, 0]))
+            else:
+                self.status(1)
+        except OSError:
+            self.status(1)
+
+
+def servewebsocket(emu, throttle, port, password):
+    srv = socket.socket()
+    srv.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+    srv.bind(("127.0.0.1", port))
+    srv.listen(1)
+    def loop():
+        while True:
+            conn, addr = srv.accept()
+            conn.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+            req = b""
+            while b"\r\n\r\n" not in req:
+                req += conn.recv(4096)
+            key = [ l.split(b":", 1)[1].strip()  for l in req.split(b"\r\n")  if l.lower().startswith(b"sec-websocket-key:") ][0]
+            accept = base64.b64encode(hashlib.sha1(key + b"258EAFA5-E914-47DA-95CA-C5AB0DC85B11").digest())
+            conn.sendall(b"HTTP/1.1 101 Switching Protocols\r\nUpgrade: websocket\r\nConnection: Upgrade\r\nSec-WebSocket-Accept: " + accept + b"\r\n\r\n")
+            def writeout(b, conn=conn):
+                try:
+                    conn.sendall(b)
+                except OSError:
+                    pass
+            throttle.writefunc = writeout
+            emu.throttlereceive = throttle.receive
+            files = WebREPLFiles(emu, lambda b: throttle.write(wsframe(2, b)))
+            emu.outfunc = None
+            throttle.write(wsframe(1, b"Password: "))
+            pw = b""
+            while True:
+                try:
+                    opcode, payload = wsreadframe(conn)
+                except (EOFError, OSError):
+                    break
+                if opcode == 8:
+                    break
+                if opcode == 2:
+                    files.feed(payload)
+                elif emu.outfunc is None:   # still logging in
+                    pw += payload
+                    if pw.endswith(b"\n") or pw.endswith(b"\r"):
+                        if pw.strip().decode() == password:
+                            emu.reset()
+                            emu.outfunc = lambda b: throttle.write(wsframe(1, b))
+                            emu.out(b"\r\nWebREPL connected\r\n>>> ")
+                        else:
+                            throttle.write(wsframe(1, b"\r\nAccess denied\r\n"))
+                            break
+                else:
+                    throttle.receive(len(payload))
+                    emu.feed(payload)
+            conn.close()
+    threading.Thread(target=loop, daemon=True).start()
+    return srv.getsockname()[1]
+
+
+if __name__ == "__main__":
+    ap = argparse.ArgumentParser()
+    ap.add_argument("--fsroot", default="emulatorfs")
+    ap.add_argument("--pty", action="store_true")
+    ap.add_argument("--tcp", type=int)
+    ap.add_argument("--websocket", type=int)
+    ap.add_argument("--password", default="pass")
+    ap.add_argument("--baud", type=int, default=0)
+    ap.add_argument("--latency", type=float, default=0.0)
+    ap.add_argument("--jitter", type=float, default=0.0)
+    ap.add_argument("--no-rawpaste", action="store_true")
+    args = ap.parse_args()
+    os.makedirs(args.fsroot, exist_ok=True)
+    emu = Emulator(args.fsroot, rawpaste=not args.no_rawpaste)
+    throttle = Throttle(args.baud, args.latency, args.jitter)
+    if args.pty:
+        print("serial port", servepty(emu, throttle))
+    if args.tcp is not None:
+        print("tcp port", servetcp(emu, throttle, args.tcp))
+    if args.websocket is not None:
+        print("websocket ws://127.0.0.1:{}".format(servewebsocket(emu, throttle, args.websocket, args.password)))
+    sys.stdout.flush()
+    while True:
+        time.sleep(3600)
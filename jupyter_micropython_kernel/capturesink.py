@@ -0,0 +1,109 @@
+import logging, time, os, gzip
+
+logger = logging.getLogger(__name__)
+
+capturebuffersize = 1 << 20   # bytes held in memory before a write to the file
+captureflushtime = 5          # or seconds since the last write, so a slow logger still reaches the disk
+
+# parses sizes like 500k, 20M, 2G (for --rotate-size)
+def parsesize(s):
+    s = s.strip().lower()
+    m = {"k":1 << 10, "m":1 << 20, "g":1 << 30}.get(s[-1:])
+    return int(float(s[:-1])*m) if m else int(s)
+
+# parses durations like 90, 30s, 15m, 6h (for --rotate-time)
+def parseduration(s):
+    s = s.strip().lower()
+    m = {"s":1, "m":60, "h":3600, "d":86400}.get(s[-1:])
+    return float(s[:-1])*m if m else float(s)
+
+
+# Destination of %capture.  Device output is held in one large bytearray and
+# written out in big blocks (optionally through gzip or zstd), with the file
+# rotated by size or age, and only the most recent files kept.
+class CaptureSink:
+    def __init__(self, outputfilename, compression=None, rotatesize=0, rotatetime=0, keep=0, bbackground=False):
+        if compression is None:
+            compression = {".gz":"gzip", ".zst":"zstd"}.get(os.path.splitext(outputfilename)[1])
+        elif compression == "gzip" and not outputfilename.endswith(".gz"):
+            outputfilename += ".gz"
+        elif compression == "zstd" and not outputfilename.endswith(".zst"):
+            outputfilename += ".zst"
+        if compression == "zstd":
+            import zstandard   # optional, pip install zstandard
+            self.zstdcompressor = zstandard.ZstdCompressor(level=3)
+        self.outputfilename = outputfilename
+        root, cext = os.path.splitext(outputfilename) if compression else (outputfilename, "")
+        self.rotatestem, ext = os.path.splitext(root)   # rotated files are named like log.0003.txt.gz
+        self.rotateext = ext + cext
+        self.compression = compression
+        self.rotatesize = rotatesize
+        self.rotatetime = rotatetime
+        self.keep = keep
+        self.bbackground = bbackground   # stays open across cells until %capture --stop
+
+        self.buffer = bytearray()
+        self.nlines = 0
+        self.nbytes = 0               # uncompressed bytes captured
+        self.filenames = [ ]          # files written so far that have not been deleted
+        self.nfiles = 0
+        self.fout = None
+        self.rawfout = None
+        self.filebytes = 0
+        self.fileopentime = 0
+        self.lastflushtime = time.time()
+        self.openfile()
+
+    def openfile(self):
+        if self.rotatesize or self.rotatetime:
+            fname = "{}.{:04d}{}".format(self.rotatestem, self.nfiles, self.rotateext)
+        else:
+            fname = self.outputfilename
+        self.rawfout = open(fname, "wb")
+        if self.compression == "gzip":
+            self.fout = gzip.GzipFile(fileobj=self.rawfout, mode="wb", compresslevel=1)   # the fastest level, to keep the kernel's CPU load down
+        elif self.compression == "zstd":
+            self.fout = self.zstdcompressor.stream_writer(self.rawfout)
+        else:
+            self.fout = self.rawfout
+        self.filenames.append(fname)
+        self.nfiles += 1
+        self.filebytes = 0
+        self.fileopentime = time.time()
+
+    def closefile(self):
+        if self.fout is not self.rawfout:
+            self.fout.close()
+        if not self.rawfout.closed:
+            self.rawfout.close()
+        self.fout = self.rawfout = None
+        while self.keep and len(self.filenames) > self.keep:
+            try:
+                os.remove(self.filenames.pop(0))
+            except OSError as e:
+                logger.warning("could not remove old capture file %s", e)
+
+    def write(self, output):
+        b = output.encode() if type(output) == str else output
+        self.buffer += b
+        self.nlines += b.count(b"\n")
+        self.nbytes += len(b)
+        if len(self.buffer) >= capturebuffersize or (self.rotatesize and self.filebytes + len(self.buffer) >= self.rotatesize) or time.time() >= self.lastflushtime + captureflushtime:
+            self.flush()
+
+    def flush(self, brotate=True):
+        self.lastflushtime = time.time()
+        if self.buffer:
+            self.fout.write(self.buffer)
+            self.filebytes += len(self.buffer)
+            self.buffer.clear()
+        if brotate and ((self.rotatesize and self.filebytes >= self.rotatesize) or (self.rotatetime and self.lastflushtime >= self.fileopentime + self.rotatetime)):
+            self.closefile()
+            self.openfile()
+
+    def close(self):
+        self.flush(brotate=False)
+        self.closefile()
+
+    def currentfilename(self):
+        return self.filenames[-1]
@@ -0,0 +1,99 @@
+import logging, time, json, collections
+
+logger = logging.getLogger(__name__)
+
+celltimingshistory = 1000   # cells kept for %timing
+
+# the stages of a cell, each between two of the marks (in seconds from the start of the cell)
+#   firstwrite, lastwrite: the program (or file) going out to the device
+#   ok: device has received it (the OK of paste mode, or the raw-paste acknowledgement)
+#   firstoutput: first byte printed by the program
+#   end: the final \x04> (or the status of a webrepl file transfer)
+stages = [ ("upload", "firstwrite", "lastwrite"),
+           ("ack", "lastwrite", "ok"),
+           ("1stout", "ok", "firstoutput"),
+           ("run", "ok", "end") ]
+
+# Monotonic timestamps and byte counts of one cell, so that a slow cell can be
+# put down to the upload, the device compiling and running it, or the output
+# streaming back.  The DeviceConnector calls mark() as the stages are reached.
+class CellTiming:
+    def __init__(self, code, transport, iopubcounts):
+        self.t0 = time.monotonic()
+        self.starttime = time.time()
+        self.cell = code.strip().split("\n", 1)[0][:60]
+        self.transport = transport
+        self.bytecounts0 = transport.bytecounts() if transport else (0, 0)
+        self.iopubcounts0 = iopubcounts
+        self.marks = { }
+        self.total = None
+        self.nbyteswritten = self.nbytesread = 0
+        self.niopubpieces = self.niopubmessages = 0
+
+    # the first time a mark is reached, unless blast (for the end of a cell with several transfers in it)
+    def mark(self, name, blast=False):
+        if blast or name not in self.marks:
+            self.marks[name] = time.monotonic() - self.t0
+
+    def finish(self, transport, iopubcounts):
+        self.total = time.monotonic() - self.t0
+        bytecounts0 = self.bytecounts0 if transport is self.transport else (0, 0)   # (connected during the cell)
+        if transport:
+            self.nbyteswritten, self.nbytesread = [ b - b0  for b, b0 in zip(transport.bytecounts(), bytecounts0) ]
+        self.niopubpieces, self.niopubmessages = [ n - n0  for n, n0 in zip(iopubcounts, self.iopubcounts0) ]
+        self.transport = None
+
+    def stage(self, name):
+        for sname, mfrom, mto in stages:
+            if sname == name and mfrom in self.marks and mto in self.marks:
+                return max(0, self.marks[mto] - self.marks[mfrom])
+        return None
+
+    def record(self):
+        return { "time":round(self.starttime, 3), "cell":self.cell, "total":round(self.total, 4),
+                 "marks":{ k:round(v, 4)  for k, v in self.marks.items() },
+                 "byteswritten":self.nbyteswritten, "bytesread":self.nbytesread,
+                 "iopubpieces":self.niopubpieces, "iopubmessages":self.niopubmessages }
+
+
+def percentile(values, p):
+    values = sorted(values)
+    return values[min(len(values) - 1, int(len(values)*p/100))]
+
+def fmtms(t):
+    return "{:7.0f}".format(t*1000) if t is not None else "      -"
+
+
+# the finished cells, and the optional JSON-lines log each one is appended to
+class CellTimings:
+    def __init__(self):
+        self.timings = collections.deque(maxlen=celltimingshistory)
+        self.logfilename = None
+
+    def add(self, timing):
+        self.timings.append(timing)
+        if self.logfilename:
+            try:
+                with open(self.logfilename, "a") as fout:
+                    fout.write(json.dumps(timing.record()))
+                    fout.write("\n")
+            except OSError as e:
+                logger.warning("could not append to timing log %s", e)
+
+    def report(self, n):
+        timings = list(self.timings)[-n:]
+        if not timings:
+            return "No cells timed yet\n"
+        columns = [ "total" ] + [ sname  for sname, mfrom, mto in stages ]
+        lines = [ "{:30s} {}  {:>8s} {:>8s} {:>6s}".format("cell", " ".join("{:>7s}".format(c)  for c in columns), "written", "read", "iopub") ]
+        for t in timings:
+            lines.append("{:30s} {}{}  {:8d} {:8d} {:6d}".format(t.cell[:30], fmtms(t.total), "".join(" "+fmtms(t.stage(sname))  for sname in columns[1:]), t.nbyteswritten, t.nbytesread, t.niopubmessages))
+        lines.append("(times in ms over the last {} cells)".format(len(timings)))
+        for p in [50, 90, 99, 100]:
+            cols = [ ]
+            for c in columns:
+                vals = [ t.total if c == "total" else t.stage(c)  for t in timings ]
+                vals = [ v  for v in vals  if v is not None ]
+                cols.append(fmtms(percentile(vals, p) if vals else None))
+            lines.append("{:30s} {}".format("max" if p == 100 else "p{}".format(p), " ".join(cols)))
+        return "\n".join(lines) + "\n"
@@ -1,54 +1,101 @@
-import logging, sys, time, os, re, binascii, subprocess
-import serial, socket, serial.tools.list_ports, select
+import logging, sys, time, os, re, binascii, subprocess, struct, zlib, codecs
+import serial, socket
 import websocket  # the old non async one
+from .transports import serialtimeout, SerialTransport, SocketTransport, WebsocketTransport, BackgroundReader, FrameDemux
+from .serialports import PortIndex
+from . import espflash
+from .devicevars import DeviceVar
+from .namespaceindex import NamespaceIndex
+from .devicefiles import DeviceFileIndex
+from . import devicehelper
+
+logger = logging.getLogger(__name__)
+logger.setLevel(logging.INFO)
 
-serialtimeout = 0.5
 serialtimeoutcount = 10
+reconnecttimeout = 10   # seconds allowed for a board that has reset or been replugged to come back
+webreplputminsize = 16384   # files in a batch this big go by the webrepl file protocol (it costs two round trips per file)
+rawreplchunksize, rawreplblocksize = 30, 570   # the fixed sizes (10 statements of 30 bytes) used on a link with no flow control at all
+rawreplwritesize, rawreplwritepause = 256, 0.01   # a program written to a plain raw REPL goes in pieces this big, as in pyboard.py
+compresswbits = 10   # 1k window, as the decompressor on the device allocates 2**wbits bytes
+rawreplprompt = b'raw REPL; CTRL-B to exit\r\n>'
+friendlyprompt = b'\r\n>>> '
+
+wifimessageignore = re.compile(r"(\x1b\[[\d;]*m)?[WI] \(\d+\) (wifi|system_api|modsocket|phy|event|cpu_start|heap_init|network|wpa): ")
+wifimessageignoreb = re.compile(wifimessageignore.pattern.encode())   # for matching lines still in bytes
+wifimessageprefix = re.compile(r"\x1b(\[[\d;]*)?$|(\x1b\[[\d;]*m)?([WI]( (\((\d+(\) ?[a-z_]*:?)?)?)?)?)?$")   # the start of a line that could still turn out to be one of these
 
-wifimessageignore = re.compile("(\x1b\[[\d;]*m)?[WI] \(\d+\) (wifi|system_api|modsocket|phy|event|cpu_start|heap_init|network|wpa): ")
+serialportindex = PortIndex()
 
 # this should take account of the operating system
 def guessserialport():  
-    lp = list(serial.tools.list_ports.grep(""))
-    lp.sort(key=lambda X: (X.hwid == "n/a", X.device))  # n/a could be good evidence that the port is non-existent
-    return [x.device  for x in lp]
+    return serialportindex.guessports()
+
+# Decodes the chunks from the device into text as they come, with a utf8 character 
+# split between two chunks held over until the rest of it arrives, and drops the 
+# esp log lines matched by wifimessageignore.  Lines are matched once, when they are 
+# complete (or far enough in to tell); only the start of a line that could still be 
+# a log line is held back, and everything else passes straight through.
+class OutputDecoder:
+    def __init__(self):
+        self.decoder = codecs.getincrementaldecoder("utf8")(errors="replace")
+        self.blinestart = True    # the next text starts a line
+        self.pending = ""         # start of a line that may be a log line
+        self.bdropping = False    # in the rest of a log line
+
+    def feed(self, b):
+        text = self.decoder.decode(b)
+        if not text:
+            return text
+        i = text.find("\n")
+        if not (self.pending or self.bdropping) and (i == -1 or i == len(text) - 1) and not (self.blinestart and text[0] in "WI\x1b"):
+            self.blinestart = (i != -1)
+            return text
+        res = [ ]
+        i = 0
+        while i < len(text):
+            j = text.find("\n", i) + 1 or len(text)
+            piece = text[i:j]
+            i = j
+            if self.bdropping:
+                self.bdropping = not piece.endswith("\n")
+                self.blinestart = not self.bdropping
+            elif self.blinestart or self.pending:
+                self.pending += piece
+                if wifimessageignore.match(self.pending):
+                    self.bdropping = not piece.endswith("\n")
+                    self.blinestart = not self.bdropping
+                    self.pending = ""
+                elif piece.endswith("\n") or not wifimessageprefix.match(self.pending):
+                    res.append(self.pending)
+                    self.blinestart = piece.endswith("\n")
+                    self.pending = ""
+            else:
+                res.append(piece)
+                self.blinestart = piece.endswith("\n")
+        return "".join(res)
+
+    # what is being held back, at the end of a stream (or before the error stream after \x04)
+    def flush(self):
+        res = self.pending
+        if res:
+            self.pending = ""
+            self.blinestart = False
+        return res
+
 
 # merge uncoming serial stream and break at OK, \x04, >, \r\n, and long delays 
-# (must make this a member function so does not have to switch on the type of s)
-def yieldserialchunk(s):
-    res = [ ]
+# Data is read in blocks of whatever is available and split with a single 
+# regex search per boundary, rather than looping in python over every byte.
+chunkboundary = re.compile(b"OK|\x04|>|\r\n")
+
+def yieldserialchunk(transport):
+    readavailable = transport.read_available   # one call per block, whatever the kind of connection
+    res = bytearray()
     n = 0
-    wsresbuffer = b""
-    wsresbufferI = 0
     while True:
         try:
-            if type(s) == serial.Serial:
-                b = s.read()
-            elif type(s) == socket.socket:
-                r,w,e = select.select([s], [], [], serialtimeout)
-                if r:
-                    b = s._sock.recv(1)
-                else:
-                    b = b''
-                    
-            else:  # websocket (break down to individual bytes)
-                if wsresbufferI >= len(wsresbuffer):
-                    r,w,e = select.select([s], [], [], serialtimeout)
-                    if r:
-                        wsresbuffer = s.recv()  # this comes as batches of strings, which beed to be broken to characters
-                        if type(wsresbuffer) == str:
-                            wsresbuffer = wsresbuffer.encode("utf8")   # handle fact that strings come back from this interface
-                    else:
-                        wsresbuffer = b''
-                    wsresbufferI = 0
-                    
-                if len(wsresbuffer) > 0:
-                    b = wsresbuffer[wsresbufferI:wsresbufferI+1]
-                    wsresbufferI += 1
-                else:
-                    b = b''
-
-                    
+            b = readavailable()
         except serial.SerialException as e:
             yield b"\r\n**[ys] "
             yield str(type(e)).encode("utf8")
@@ -58,29 +105,31 @@ def yieldserialchunk(s):
             break
             
         if not b:
-            if res and (res[0] != 'O' or len(res) > 3):
-                yield b''.join(res)
+            if res:
+                yield bytes(res)
                 res.clear()
             else:
                 n += 1
                 if (n%serialtimeoutcount) == 0:
                     yield b''   # yield a blank line every (serialtimeout*serialtimeoutcount) seconds
-                
-        elif b == b'K' and len(res) >= 1 and res[-1] == b'O':
-            if len(res) > 1:
-                yield b''.join(res[:-1])
-            yield b'OK'
-            res.clear()
-        elif b == b'\x04' or b == b'>':
-            if res:
-                yield b''.join(res)
-            yield b
-            res.clear()
-        else:
-            res.append(b)
-            if b == b'\n' and len(res) >= 2 and res[-2] == b'\r':
-                yield b''.join(res)
-                res.clear()
+            continue
+
+        i = max(0, len(res)-1)   # an OK or \r\n can straddle the end of the previous block
+        res += b
+        j = 0                    # start of the chunk being assembled
+        while True:
+            m = chunkboundary.search(res, i)
+            if not m:
+                break
+            k, i = m.span()
+            if res[k] == 0x0d:   # \r\n stays on the end of its line
+                yield bytes(res[j:i])
+            else:
+                if k > j:
+                    yield bytes(res[j:k])
+                yield bytes(res[k:i])
+            j = i
+        del res[:j]
 
 
 class DeviceConnector:
@@ -89,40 +138,52 @@ class DeviceConnector:
         self.workingsocket = None
         self.workingwebsocket = None
         self.workingserialchunk = None
+        self.transport = None            # all the reading and writing goes through this (see transports.py)
+        self.rawpastesupported = None    # None until the raw-paste mode has been tried on this connection
+        self.linkmeasurement = None      # (roundtrip seconds, device free memory) 
+        self.devicecompressor = None     # (decompressing module, can compress) once it has been checked
+        self.namespaceindex = NamespaceIndex()   # dir() of the device's globals for completion
+        self.devicefileindex = DeviceFileIndex()   # directories listed by %ls
+        self.bdevicehelper = False       # the _k module is on the device at our version (checked once per connection)
+        self.backgroundreader = None     # BackgroundReader (wrapping the transport) when the connection is drained on a thread
+        self.framedemux = None           # FrameDemux (under any background reader) taking out the frames for %stream
+        self.celltiming = None           # CellTiming of the cell running on this device, for %timing
+        self.outputdecoder = OutputDecoder()   # text of the device's output, shared by everything that prints it
+        self.serialreconnect = None      # (portname, board key, baudrate) for reopening the same board if it goes away
         self.sres = sres   # two output functions borrowed across
         self.sresSYS = sresSYS
-        self._esptool_command = None
 
-    def workingserialreadall(self):  # usually used to clear the incoming buffer, results are printed out rather than used
-        if self.workingserial:
-            return self.workingserial.read_all()
+    def marktime(self, name, blast=False):
+        if self.celltiming:
+            self.celltiming.mark(name, blast)
 
-        if self.workingwebsocket:
-            res = [ ]
-            while True:
-                r,w,e = select.select([self.workingwebsocket],[],[],0.2)  # add a timeout to the webrepl, which can be slow
-                if not r:
-                    break
-                res.append(self.workingwebsocket.recv())
-            return "".join(res) # this is returning a text array, not bytes
-                                # though a binary frame can be stipulated according to websocket.ABNF.OPCODE_MAP
-                                # fix this when we see it
+    def workingserialreadall(self):  # usually used to clear the incoming buffer, results are printed out rather than used
+        return self.transport.read_all()
 
-        # socket case, get it all down
-        res = [ ]
-        while True:
-            r,w,e = select.select([self.workingsocket._sock],[],[],0)
-            if not r:
-                break
-            res.append(self.workingsocket._sock.recv(1000))
-            self.sres("Selected socket {}  {}\n".format(len(res), len(res[-1])))
-        return b"".join(res)
+    # decoded and filtered text of bytes read outside the chunker (eg by workingserialreadall)
+    def outputtext(self, b):
+        return self.outputdecoder.feed(b) + self.outputdecoder.flush()
 
-    def disconnect(self, raw=False, verbose=False):
+    def disconnect(self, raw=False, verbose=False, bkeepstream=False):
         if not raw:
             self.exitpastemode(verbose)   # this doesn't seem to do any good (paste mode is left on disconnect anyway)
 
+        self.stopbackgroundreader()
+        if self.framedemux and not bkeepstream:   # (reconnect carries the sink over to the new connection)
+            self.framedemux.sink.close()
+        self.framedemux = None
         self.workingserialchunk = None
+        if self.transport is not None:
+            self.transport.close()
+            self.transport = None
+        self.rawpastesupported = None
+        self.linkmeasurement = None
+        self.devicecompressor = None
+        self.namespaceindex = NamespaceIndex()
+        self.devicefileindex = DeviceFileIndex()
+        self.bdevicehelper = False
+        self.outputdecoder = OutputDecoder()
+        self.serialreconnect = None
         if self.workingserial is not None:
             if verbose:
                 self.sresSYS("\nClosing serial {}\n".format(str(self.workingserial)))
@@ -137,6 +198,40 @@ class DeviceConnector:
             self.workingwebsocket.close()
             self.workingwebsocket = None
 
+    def startbackgroundreader(self, maxbytes):
+        if self.backgroundreader:
+            self.backgroundreader.maxbytes = maxbytes
+            return
+        self.backgroundreader = self.transport = BackgroundReader(self.transport, maxbytes)
+        self.workingserialchunk = None   # rebuilt to read from the background reader
+
+    def stopbackgroundreader(self):
+        if self.backgroundreader:
+            self.transport = self.backgroundreader.stop()   # anything unread is pushed back for the next chunker
+            self.backgroundreader = None
+            self.workingserialchunk = None
+
+    # the frames of streamframe() go to the sink rather than the output (read on the 
+    # background reader's thread as well when it is running, which stays on top)
+    def startstream(self, sink):
+        self.stopstream()
+        backgroundmaxbytes = self.backgroundreader.maxbytes if self.backgroundreader else None
+        self.stopbackgroundreader()
+        self.framedemux = self.transport = FrameDemux(self.transport, sink)
+        self.workingserialchunk = None
+        if backgroundmaxbytes:
+            self.startbackgroundreader(backgroundmaxbytes)
+
+    def stopstream(self):
+        if self.framedemux:
+            backgroundmaxbytes = self.backgroundreader.maxbytes if self.backgroundreader else None
+            self.stopbackgroundreader()
+            self.transport = self.framedemux.stop()
+            self.framedemux = None
+            self.workingserialchunk = None
+            if backgroundmaxbytes:
+                self.startbackgroundreader(backgroundmaxbytes)
+
     def serialconnect(self, portname, baudrate, verbose):
         assert not  self.workingserial
         if type(portname) is int:
@@ -153,6 +248,7 @@ class DeviceConnector:
         self.sresSYS("Connecting to --port={} --baud={} ".format(portname, baudrate))
         try:
             self.workingserial = serial.Serial(portname, baudrate, timeout=serialtimeout)
+            self.transport = SerialTransport(self.workingserial)
         except serial.SerialException as e:
             self.sres(e.strerror)
             self.sres("\n")
@@ -164,9 +260,10 @@ class DeviceConnector:
             return
 
         for i in range(5001):
-            if self.workingserial.isOpen():
+            if self.workingserial.isOpen():   # (is normally open as soon as Serial() returns)
                 break
             time.sleep(0.01)
+        self.serialreconnect = (portname, serialportindex.boardkey(portname), baudrate)
         if verbose:
             self.sresSYS(" [connected]")
         self.sres("\n")
@@ -179,6 +276,45 @@ class DeviceConnector:
 
 
 
+    # Reopens the board after the serial port has failed (a reset or replug, which can 
+    # bring it back on a different port, found by its vid:pid and serial number) and 
+    # re-enters the raw REPL, or gives up after reconnecttimeout seconds
+    def reconnect(self):
+        if not self.serialreconnect:
+            return False
+        portname, boardkey, baudrate = self.serialreconnect
+        backgroundmaxbytes = self.backgroundreader.maxbytes if self.backgroundreader else None
+        streamsink = self.framedemux.sink if self.framedemux else None
+        t0 = time.time()
+        self.sresSYS("\n[serial connection lost, reconnecting]\n")
+        self.disconnect(raw=True, bkeepstream=True)
+        while time.time() < t0 + reconnecttimeout:
+            newportname = serialportindex.findboard(boardkey) if boardkey else portname
+            if newportname:
+                try:
+                    self.workingserial = serial.Serial(newportname, baudrate, timeout=serialtimeout)
+                    self.transport = SerialTransport(self.workingserial)
+                except serial.SerialException:
+                    pass
+                else:
+                    if self.enterpastemode(verbose=False):
+                        break
+                    self.disconnect(raw=True)
+            time.sleep(0.05)
+        else:
+            self.sres("[board did not come back within {}s]\n".format(reconnecttimeout), 31)
+            if streamsink:
+                streamsink.close()
+            return False
+        self.serialreconnect = (newportname, boardkey, baudrate)
+        if streamsink:
+            self.startstream(streamsink)
+        if backgroundmaxbytes:
+            self.startbackgroundreader(backgroundmaxbytes)
+        logger.info("reconnected to %s in %.3fs", newportname, time.time() - t0)
+        self.sresSYS("[reconnected to {} in {:.2f}s]\n".format(newportname, time.time() - t0))
+        return True
+
     def socketconnect(self, ipnumber, portnumber):
         self.disconnect(verbose=True)
 
@@ -189,6 +325,7 @@ class DeviceConnector:
             s.connect(socket.getaddrinfo(ipnumber, portnumber)[0][-1])
             self.sres("Doing makefile\n")
             self.workingsocket = s.makefile('rwb', 0)
+            self.transport = SocketTransport(s)
         except OSError as e:
             self.sres("Socket OSError {}".format(str(e)))
         except ConnectionRefusedError as e:
@@ -200,6 +337,7 @@ class DeviceConnector:
         try:
             self.workingwebsocket = websocket.create_connection(websocketurl, 5)
             self.workingwebsocket.settimeout(serialtimeout)
+            self.transport = WebsocketTransport(self.workingwebsocket, websocketurl)
         except socket.timeout:
             self.sres("Websocket Timeout after 5 seconds {}\n".format(websocketurl))
         except ValueError as e:
@@ -212,48 +350,39 @@ class DeviceConnector:
             self.sres("WebSocketException {}\n".format(str(e)))
 
 
-    def esptool(self, espcommand, portname, binfile):
+    # flashes (or erases) the boards on all the ports at once, each at the fastest rate that works for the chip
+    def esptool(self, espcommand, portnames, binfile, baud=None):
         self.disconnect(verbose=True)
-        if type(portname) is int:
-            possibleports = guessserialport()
-            if possibleports:
-                portname = possibleports[portname]
-                if len(possibleports) > 1:
-                    self.sres("Found serial ports {}: \n".format(", ".join(possibleports)))
+        ports = [ ]
+        for portname in portnames:
+            if portname == "all":
+                ports.extend(serialportindex.usbports())
+            elif type(portname) is int:
+                possibleports = guessserialport()
+                if possibleports:
+                    ports.append(possibleports[portname])
+                    if len(possibleports) > 1:
+                        self.sres("Found serial ports {}: \n".format(", ".join(possibleports)))
+                else:
+                    self.sres("No possible ports found")
+                    ports.append("COM4" if sys.platform == "win32" else "/dev/ttyUSB0")
             else:
-                self.sres("No possible ports found")
-                portname = ("COM4" if sys.platform == "win32" else "/dev/ttyUSB0")
-
-        if self._esptool_command is None:  # this section for finding what the name of the command function is; may print junk into the jupyter logs
-            for command in ("esptool.py", "esptool"):  
-                try:
-                    subprocess.check_call([command, "version"])
-                    self._esptool_command = command
-                    break
-                except (subprocess.CalledProcessError, OSError):
-                    pass
-            if self._esptool_command is None:
-                self.sres("esptool not found on path\n")
-                return
+                ports.append(portname)
+        if not ports:
+            self.sres("No USB serial ports found\n", 31)
+            return
 
-        pargs = [self._esptool_command, "--port", portname]
-        if espcommand == "erase":
-            pargs.append("erase_flash")
-        if espcommand == "esp32":
-            pargs.extend(["--chip", "esp32", "write_flash", "-z", "0x1000"])
-            pargs.append(binfile)
-        if espcommand == "esp8266":
-            pargs.extend(["--baud", "460800", "write_flash", "--flash_size=detect", "-fm", "dio", "0"])
-            pargs.append(binfile)
-        self.sresSYS("Executing:\n  {}\n\n".format(" ".join(pargs)))
-        process = subprocess.Popen(pargs, stdout=subprocess.PIPE, stderr=subprocess.PIPE)
-        for line in process.stdout:
-            x = line.decode()
-            self.sres(x)
-            if x[:12] == "Connecting..":
-                self.sresSYS("[Press the PRG button now if required]\n")
-        for line in process.stderr:
-            self.sres(line.decode(), n04count=1)
+        bauds = [ baud ] if baud else espflash.flashbauds[espcommand]
+        jobs = [ espflash.FlashJob(espcommand, portname, binfile, bauds, self.sres, "[{}] ".format(portname) if len(ports) > 1 else "")  for portname in ports ]
+        for portname in ports:
+            self.sresSYS("Executing{}:\n  esptool {}\n".format(" in-process" if espflash.esptool else "", " ".join(espflash.esptoolargs(espcommand, portname, binfile, bauds[0]))))
+        self.sres("\n")
+        t0 = time.time()
+        espflash.flashboards(jobs)
+        for job in jobs:
+            self.sres("{} {} in {:.1f}s at {} baud\n".format(job.portname, "done" if job.bok else "FAILED", job.duration, job.baud), None if job.bok else 31)
+        if len(jobs) > 1:
+            self.sresSYS("{} boards in {:.1f}s\n".format(len(jobs), time.time() - t0))
 
     def mpycross(self, mpycrossexe, pyfile):
         pargs = [mpycrossexe, pyfile]
@@ -264,13 +393,17 @@ class DeviceConnector:
         for line in process.stderr:
             self.sres(line.decode(), n04count=1)
 
-    def receivestream(self, bseekokay, bwarnokaypriors=True, b5secondtimeout=False, bfetchfilecapture_nchunks=0):
+    # with bfetchfilecapture_nchunks the printed lines are collected (or passed to fetchlinefunc as bytes) instead of displayed
+    def receivestream(self, bseekokay, bwarnokaypriors=True, b5secondtimeout=False, bfetchfilecapture_nchunks=0, fetchlinefunc=None):
         n04count = 0
         brebootdetected = False
         res = [ ]
+        fetchline = bytearray()   # need to rejoin lines that have been split on b"OK" or b">" by the chunker
+        nfetchlines = 0
+        outputdecoder = self.outputdecoder
         for j in range(2):  # for restarting the chunking when interrupted
             if self.workingserialchunk is None:
-                self.workingserialchunk = yieldserialchunk(self.workingserial or self.workingsocket or self.workingwebsocket)
+                self.workingserialchunk = yieldserialchunk(self.transport)
 
             indexprevgreaterthansign = -1
             index04line = -1
@@ -283,17 +416,22 @@ class DeviceConnector:
 
                 # the main interpreting loop
                 if rline == b'OK' and bseekokay:
+                    self.marktime("ok")
                     if i != 0 and bwarnokaypriors:
                         self.sres("\n\n[Late OK]\n\n")
                     bseekokay = False
 
                 # one of 2 Ctrl-Ds in the return from execute in paste mode
                 elif rline == b'\x04':
+                    ur = outputdecoder.flush()
+                    if ur:
+                        self.sres(ur, n04count=n04count)
                     n04count += 1
                     index04line = i
 
                 # leaving condition where OK...x04...x04...> has been found in paste mode
                 elif rline == b'>' and n04count >= 2 and not bseekokay:
+                    self.marktime("end", True)
                     if n04count != 2:
                         self.sres("[too many x04s %d]" % n04count)
                     break
@@ -302,15 +440,20 @@ class DeviceConnector:
                     if b5secondtimeout:
                         self.sres("[Timed out waiting for recognizable response]\n", 31)
                         return False
+                    ur = outputdecoder.flush()   # (a line start held back while the device is quiet)
+                    if ur:
+                        self.sres(ur, n04count=n04count)
                     self.sres(".")  # dot holding position to prove it's alive
 
                 elif rline == b'Type "help()" for more information.\r\n':
                     brebootdetected = True
-                    self.sres(rline.decode(), n04count=n04count)
+                    self.sres(outputdecoder.feed(rline), n04count=n04count)
 
                 elif rline == b'>':
                     indexprevgreaterthansign = i
-                    self.sres('>', n04count=n04count)
+                    ur = outputdecoder.feed(rline)
+                    if ur:
+                        self.sres(ur, n04count=n04count)
 
                 # looks for ">>> "
                 elif rline == b' ' and brebootdetected and indexprevgreaterthansign == i-1:
@@ -319,187 +462,578 @@ class DeviceConnector:
                     self.sres(' ', n04count=n04count)
                     break
 
+                # lines captured from the output (not the error stream) when fetching
+                elif bfetchfilecapture_nchunks and n04count == 0:
+                    self.marktime("firstoutput")
+                    fetchline += rline
+                    if fetchline[-2:] == b"\r\n":
+                        if not wifimessageignoreb.match(fetchline):
+                            if fetchlinefunc:
+                                fetchlinefunc(bytes(fetchline))
+                            else:
+                                res.append(fetchline.decode())
+                            nfetchlines += 1
+                            if (nfetchlines%10) == 0 and bfetchfilecapture_nchunks > 0:
+                                self.sres("%d%% fetched\n" % int(nfetchlines/bfetchfilecapture_nchunks*100 + 0.5), clear_output=True)
+                        fetchline.clear()
+
                 # normal processing of the string of bytes that have come in
                 else:
-                    try:
-                        ur = rline.decode()
-                    except UnicodeDecodeError:
-                        ur = str(rline)
-                    if not wifimessageignore.match(ur):
-                        if bfetchfilecapture_nchunks:
-                            if res and res[-1][-2:] != "\r\n":
-                                res[-1] = res[-1] + ur   # need to rejoin strings that have been split on the b"OK" string by the lexical parser
-                            else:
-                                res.append(ur)
-                            if (i%10) == 0:
-                                self.sres("%d%% fetched\n" % int(len(res)/bfetchfilecapture_nchunks*100 + 0.5), clear_output=True)
-                        else:
-                            self.sres(ur, n04count=n04count)
+                    self.marktime("firstoutput")
+                    ur = outputdecoder.feed(rline)
+                    if ur:
+                        self.sres(ur, n04count=n04count)
 
             # else on the for-loop, means the generator has ended at a stop iteration
-            # this happens with Keyboard interrupt, and generator needs to be rebuilt
+            # this happens when the port fails (a SerialException in yieldserialchunk), and 
+            # the generator is rebuilt if the connection is still there
             else:  # of the for-command
                 self.workingserialchunk = None
-                continue
+                if not self.reconnect():   # (if the board comes back the cell it was running is gone)
+                    if self.transport is not None:
+                        continue
+                    self.sres("\n\n***Connection broken\nYou may need to reconnect\n", 31)   # (reconnect gave up and disconnected)
 
             break   # out of the for loop
+
+        ur = outputdecoder.flush()
+        if ur:
+            self.sres(ur, n04count=n04count)
+        if fetchline:   # unterminated last line
+            if fetchlinefunc:
+                fetchlinefunc(bytes(fetchline))
+            else:
+                res.append(fetchline.decode())
         return res if bfetchfilecapture_nchunks else True
 
 
-    def sendtofile(self, destinationfilename, bmkdir, bappend, bbinary, bquiet, filecontents):
-        if not (self.workingserial or self.workingwebsocket):
+    # executes a block of program on the device and waits for it to finish, using the 
+    # flow-controlled raw-paste mode when it's available on a serial line.  (The raw-paste 
+    # window of a couple of hundred bytes per round trip is no limit on a serial line, 
+    # but it is on the webrepl, where TCP already does the flow control.)
+    def execprogram(self, programbytes, bfetchfilecapture_nchunks=0):
+        if self.transport.brawpaste and self.rawpastewrite(programbytes):
+            return self.receivestream(bseekokay=False, bfetchfilecapture_nchunks=bfetchfilecapture_nchunks)
+        sswrite = self.transport.write_all
+        self.marktime("firstwrite")
+        if self.transport.bflowcontrol:
+            sswrite(programbytes)
+        else:   # (so that a long program doesn't overrun the device's input buffer)
+            for i in range(0, len(programbytes), rawreplwritesize):
+                if i:
+                    time.sleep(rawreplwritepause)
+                sswrite(programbytes[i:i+rawreplwritesize])
+        sswrite(b'\r\x04')
+        self.marktime("lastwrite", True)
+        return self.receivestream(bseekokay=True, bfetchfilecapture_nchunks=bfetchfilecapture_nchunks)
+
+    # The _k module that the transfers call into (see devicehelper.py), checked and 
+    # sent if it's not there at this version, in one execution once per connection
+    def devicehelper(self):
+        if not self.bdevicehelper:
+            program = devicehelper.deviceinstall.format(version=devicehelper.helperversion, source=devicehelper.helpersource, filename=devicehelper.helperfilename, dirname=devicehelper.helperdir)
+            res = "".join(self.execprogram(program.encode(), bfetchfilecapture_nchunks=-1)).split()
+            self.bdevicehelper = (len(res) == 2 and res[0] == devicehelper.helperversion)
+            if self.bdevicehelper:
+                logger.info("device helper %s %s", devicehelper.helperversion, "already installed" if res[1] == "True" else "installed")
+            else:
+                self.sres("Could not install the transfer helper on the device {}\n".format(" ".join(res)), 31)
+        return self.bdevicehelper
+
+    def removedevicehelper(self):
+        self.execprogram(devicehelper.deviceremove.format(filename=devicehelper.helperfilename).encode())
+        self.bdevicehelper = False
+
+    # round trip time and free memory on the device, used for sizing the transfers
+    # (kept for the connection, as it is one extra round trip per file otherwise)
+    def measurelink(self):
+        if self.linkmeasurement is None:
+            sswrite = self.transport.write_all
+            t0 = time.time()
+            sswrite(b"import gc; gc.collect(); print(gc.mem_free())\r\x04")
+            res = self.receivestream(bseekokay=True, bfetchfilecapture_nchunks=-1)
+            rtt = time.time() - t0
+            try:
+                memfree = int("".join(res))
+            except ValueError:
+                memfree = 0
+            self.linkmeasurement = (rtt, memfree)
+        return self.linkmeasurement
+
+    # chunk (bytes per statement) and block (bytes of program per execution) sizes 
+    # are set so the statements stay well inside the free RAM when compiled, 
+    # and a block takes long enough to send that the round trip is a small fraction of it
+    def transfersizes(self):
+        rtt, memfree = self.measurelink()
+        memfree = memfree or 16000
+        chunksize = max(48, min(1536, memfree//48))//3*3
+        maxblocksize = max(512, min(32768, memfree//6))
+        blocksize = max(1024, min(maxblocksize, int(self.transport.linkrate*rtt*10)))
+        if not (self.transport.bflowcontrol or (self.transport.brawpaste and self.rawpastesupported)):
+            chunksize = rawreplchunksize
+            blocksize = maxblocksize = rawreplblocksize
+        return chunksize, blocksize, maxblocksize, rtt
+
+    # sends the payload as one makestatement(chunk) per chunk, executed in 
+    # blocks that double in size while the round trip is still a big part of their time
+    def streamstatements(self, payload, makestatement, bquiet):
+        chunksize, blocksize, maxblocksize, rtt = self.transfersizes()
+        clear_output = True  # set this to False to help with debugging
+        t0 = time.time()
+        nchunks = (len(payload) + chunksize - 1)//chunksize
+        nblocks = 0
+        block = bytearray()
+        for i in range(nchunks):
+            block += makestatement(payload[i*chunksize:(i+1)*chunksize])
+            if len(block) >= blocksize or i == nchunks-1:
+                tb = time.time()
+                self.execprogram(bytes(block))
+                block.clear()
+                nblocks += 1
+                tb = time.time() - tb
+                if tb < rtt*10 and blocksize < maxblocksize:
+                    blocksize = min(maxblocksize, blocksize*2)
+                if not bquiet:
+                    self.sres("{}%, chunk {}, {:.0f} bytes/s".format(int((i+1)/nchunks*100), i+1, min(len(payload), (i+1)*chunksize)/max(time.time()-t0, 1e-3)), clear_output=clear_output)
+        return nchunks, nblocks
+
+    def sendtofile(self, destinationfilename, bmkdir, bappend, bbinary, bquiet, filecontents, breport=True):
+        if not self.transport.brepl:
             self.sres("File transfers not implemented for sockets\n", 31)
             return
+        self.namespaceindex.invalidatefile(destinationfilename)
+        self.devicefileindex.invalidateall()
 
-        if not bbinary:
-            lines = filecontents.splitlines(True)
-            maxlinelength = max(map(len, lines), default=0)
-            if maxlinelength > 250:
-                self.sres("Line length {} exceeds maximum for line ascii files, try --binary\n".format(maxlinelength), 31)
-                return
-
-        sswrite = self.workingserial.write  if self.workingserial  else self.workingwebsocket.send
-        #def sswrite(x):  self.sres(str(x)); lsswrite(x)
+        if bbinary and type(filecontents) == str:
+            filecontents = filecontents.encode()
+        if not bbinary and bappend:
+            filecontents = "\n" + filecontents   # avoid line concattenation on appends
+        if self.transport.bfileprotocol and not bappend and len(destinationfilename.encode()) <= 64:
+            if bmkdir:
+                self.makedirs([destinationfilename])
+            return self.webreplputfile(destinationfilename, filecontents if bbinary else filecontents.encode(), bquiet)
 
+        if not self.devicehelper():
+            return
+        setup = [ "import _k\n" ]
         if bmkdir:
-            dseq = [ d  for d in destinationfilename.split("/")[:-1]  if d]
-            if dseq:
-                sswrite(b'import os\r\n')
-                for i in range(len(dseq)):
-                    sswrite('try:  os.mkdir({})\r\n'.format(repr("/".join(dseq[:i+1]))).encode())
-                    sswrite(b'except OSError:  pass\r\n')
-
+            setup.append("_k.md({})\n".format(repr(self.devicedirs([destinationfilename]))))
         fmodifier = ("a" if bappend else "w")+("b" if bbinary else "")
+        setup.append("_k.op({}, '{}')\n".format(repr(destinationfilename), fmodifier))
+        self.execprogram("".join(setup).encode())
+
+        t0 = time.time()
         if bbinary:
-            sswrite(b"import ubinascii; O6 = ubinascii.a2b_base64\r\n")
-        sswrite("O=open({}, '{}')\r\n".format(repr(destinationfilename), fmodifier).encode())
-        sswrite(b'\r\x04')  # intermediate execution
-        self.receivestream(bseekokay=True)
-        clear_output = True  # set this to False to help with debugging
-        if bbinary:
-            if type(filecontents) == str:
-                filecontents = filecontents.encode()
-                
-            chunksize = 30
-            nchunks = int(len(filecontents)/chunksize)
-
-            for i in range(nchunks+1):
-                bchunk = filecontents[i*chunksize:(i+1)*chunksize]
-                sswrite(b'O.write(O6("')
-                sswrite(binascii.b2a_base64(bchunk)[:-1])
-                sswrite(b'"))\r\n')
-                if (i%10) == 9:
-                    sswrite(b'\r\x04')  # intermediate executions
-                    self.receivestream(bseekokay=True)
-                    if not bquiet:
-                        self.sres("{}%, chunk {}".format(int((i+1)/(nchunks+1)*100), i+1), clear_output=clear_output)
-            self.sres("Sent {} bytes in {} chunks to {}.\n".format(len(filecontents), i+1, destinationfilename), clear_output=not bquiet)
-            
+            makestatement = lambda chunk: b'_k.w("' + binascii.b2a_base64(chunk)[:-1] + b'")\n'
         else:
-            i = -1
-            linechunksize = 5
-
-            if bappend:
-                sswrite("O.write('\\n')\r\n".encode())   # avoid line concattenation on appends
-            for i, line in enumerate(lines):
-                sswrite("O.write({})\r\n".format(repr(line)).encode())
-                if (i%linechunksize) == linechunksize-1:
-                    sswrite(b'\r\x04')  # intermediate executions
-                    self.receivestream(bseekokay=True)
-                    if not bquiet:
-                        self.sres("{}%, line {}\n".format(int((i+1)/(len(lines)+1)*100), i+1), clear_output=clear_output)
-            self.sres("Sent {} lines ({} bytes) to {}.\n".format(i+1, len(filecontents), destinationfilename), clear_output=(clear_output and not bquiet))
-
-        sswrite("O.close()\r\n".encode())
-        sswrite("del O\r\n".encode())
-        sswrite(b'\r\x04')
-        self.receivestream(bseekokay=True)
+            makestatement = lambda chunk: "_k.t({})\n".format(repr(chunk)).encode()
+        nchunks, nblocks = self.streamstatements(filecontents, makestatement, bquiet)
+        self.execprogram(b"_k.cl()\n")
+        dt = max(time.time() - t0, 1e-3)
+        if breport:
+            self.sres("Sent {} bytes in {} chunks ({} blocks) to {} at {:.0f} bytes/s.\n".format(len(filecontents), nchunks, nblocks, destinationfilename, len(filecontents)/dt), clear_output=not bquiet)
 
-    def fetchfile(self, sourcefilename, bbinary, bquiet):
-        if not (self.workingserial or self.workingwebsocket):
+    # Sends many files as one stream of frames (name length, data length, name, data) 
+    # that an unpacker object on the device writes out as they arrive, after 
+    # making every directory needed just once.  files is a list of (destinationfilename, bytes)
+    def sendfilebatch(self, files, bquiet):
+        if not self.transport.brepl:
             self.sres("File transfers not implemented for sockets\n", 31)
+            return
+        for fn, fc in files:
+            self.namespaceindex.invalidatefile(fn)
+        self.devicefileindex.invalidateall()
+        if self.transport.bfileprotocol:   # big files go as raw bytes, the small ones are quicker in the one stream below
+            bigfiles = [ fn  for fn, fc in files  if len(fc) >= webreplputminsize and len(fn.encode()) <= 64 ]
+            if bigfiles:
+                self.makedirs(bigfiles)
+                for fn, fc in files:
+                    if fn in bigfiles and not self.webreplputfile(fn, fc, bquiet):
+                        return
+                files = [ (fn, fc)  for fn, fc in files  if fn not in bigfiles ]
+                if not files:
+                    return
+        if not self.devicehelper():
+            return
+        self.execprogram("import _k\n_k.md({})\n_k.ub()\n".format(repr(self.devicedirs([ fn  for fn, fc in files ]))).encode())
+
+        payload = b"".join(struct.pack("<HI", len(fn.encode()), len(fc)) + fn.encode() + fc  for fn, fc in files)
+        t0 = time.time()
+        nchunks, nblocks = self.streamstatements(payload, lambda chunk: b'_k.uf("' + binascii.b2a_base64(chunk)[:-1] + b'")\n', bquiet)
+        self.execprogram(b"_k.ue()\n")
+        dt = max(time.time() - t0, 1e-3)
+        self.sres("Sent {} files ({} bytes) in {} blocks at {:.0f} bytes/s.\n".format(len(files), sum(len(fc)  for fn, fc in files), nblocks, len(payload)/dt), clear_output=not bquiet)
+
+    # every directory needed for the files, to be made in one go (shortest first)
+    def devicedirs(self, filenames):
+        dirs = set()
+        for destinationfilename in filenames:
+            dseq = [ d  for d in destinationfilename.split("/")[:-1]  if d]
+            for i in range(len(dseq)):
+                dirs.add(("/" if destinationfilename[:1] == "/" else "") + "/".join(dseq[:i+1]))
+        return sorted(dirs, key=len)
+
+    def makedirs(self, filenames):
+        if self.devicehelper():
+            self.execprogram("import _k\n_k.md({})\n".format(repr(self.devicedirs(filenames))).encode())
+
+    # The webrepl has its own file protocol in binary frames, which takes raw bytes 
+    # without the base64 expansion or any REPL round trips.  A request header starting "WA" 
+    # (put=1 or get=2, the size and the filename of up to 64 bytes) is answered by "WB" 
+    # and a 2 byte status, as in webrepl_cli.py
+    def webreplrequest(self, op, filename, size):
+        fname = filename.encode()
+        rec = struct.pack("<2sBBQLH64s", b"WA", op, 0, 0, size, len(fname), fname)
+        self.transport.write_binary(rec[:10])   # (split like webrepl_cli does)
+        self.transport.write_binary(rec[10:])
+        return self.webreplstatus()
+
+    def webreplstatus(self):
+        r = self.transport.read_binary(4)
+        if len(r) != 4 or r[:2] != b"WB":
+            self.sres("[webrepl file protocol reply unrecognized {}]\n".format(repr(r)), 31)
+            return -1
+        return struct.unpack("<H", r[2:])[0]
+
+    def webreplputfile(self, destinationfilename, filecontents, bquiet):
+        t0 = time.time()
+        if self.webreplrequest(1, destinationfilename, len(filecontents)) != 0:
+            self.sres("Cannot write {} over the webrepl\n".format(destinationfilename), 31)
+            return False
+        self.marktime("firstwrite")
+        for i in range(0, len(filecontents), 1024):
+            self.transport.write_binary(filecontents[i:i+1024])
+        self.marktime("lastwrite", True)
+        if self.webreplstatus() != 0:
+            self.sres("Failed writing {} over the webrepl\n".format(destinationfilename), 31)
+            return False
+        self.marktime("end", True)
+        if not bquiet:
+            self.sres("Sent {} bytes to {} over the webrepl file protocol at {:.0f} bytes/s.\n".format(len(filecontents), destinationfilename, len(filecontents)/max(time.time() - t0, 1e-3)))
+        return True
+
+    # Each \0 sent asks the device for the next block, and one too many would 
+    # be taken as the start of a new request, so once the size of the file and the 
+    # blocks is known, all the requests for the rest of it are sent at once 
+    # rather than waiting a round trip for each block
+    def webreplgetfile(self, sourcefilename, bbinary, bquiet, destinationfilename):
+        t0 = time.time()
+        nbytes = self.devicefilesize(sourcefilename)
+        if nbytes == -1 or self.webreplrequest(2, sourcefilename, 0) != 0:
+            self.sres("Cannot read {} over the webrepl\n".format(sourcefilename), 31)
+            return None
+        fout = open(destinationfilename, "wb") if destinationfilename else None
+        res = bytearray()
+        pos = 0
+        blocksize = 0
+        nrequested = 0
+        try:
+            while True:
+                if nrequested == 0:
+                    nrequested = max(1, -(-(nbytes - pos)//blocksize)) if (blocksize and nbytes is not None) else 1
+                    self.transport.write_binary(b"\0"*nrequested)
+                r = self.transport.read_binary(2)
+                if len(r) != 2:
+                    self.sres("[webrepl file protocol timed out]\n", 31)
+                    return None
+                nrequested -= 1
+                sz = struct.unpack("<H", r)[0]
+                if sz == 0:
+                    break
+                blocksize = max(blocksize, sz)
+                self.marktime("firstoutput")
+                b = self.transport.read_binary(sz)
+                if fout:
+                    fout.write(b)
+                else:
+                    res += b
+                pos += len(b)
+        finally:
+            if fout:
+                fout.close()
+        if self.webreplstatus() != 0:
+            self.sres("Failed reading {} over the webrepl\n".format(sourcefilename), 31)
+        self.marktime("end", True)
+        if not bquiet:
+            self.sres("Fetched {} bytes from {} over the webrepl file protocol at {:.0f} bytes/s.\n".format(pos, sourcefilename, pos/max(time.time()-t0, 1e-3)), clear_output=True)
+        if fout:
+            return pos
+        return bytes(res) if bbinary else res.decode(errors="replace")
+
+    def devicefilesize(self, filename):   # -1 if it's not there
+        if not self.devicehelper():
             return None
-        sswrite = self.workingserial.write  if self.workingserial  else self.workingwebsocket.send
+        self.transport.write_all("import _k\r\nprint(_k.sz({}))\r\n\r\x04".format(repr(filename)).encode())
+        res = self.receivestream(bseekokay=True, bfetchfilecapture_nchunks=-1)
+        try:
+            return int("".join(res))
+        except ValueError:
+            return None
+
+    # The device prints the file as lines of base64, which are decoded as they arrive 
+    # into a preallocated bytearray, or straight to destinationfilename if given.
+    # Text files come across the same way and are returned decoded.
+    def fetchfile(self, sourcefilename, bbinary, bquiet, destinationfilename=None):
+        if not self.transport.brepl:
+            self.sres("File transfers not implemented for sockets\n", 31)
+            return None
+        if self.transport.bfileprotocol and len(sourcefilename.encode()) <= 64:
+            return self.webreplgetfile(sourcefilename, bbinary, bquiet, destinationfilename)
+        if not self.devicehelper():
+            return None
+        sswrite = self.transport.write_all
         
-        if bbinary:
-            chunksize = 30
-            sswrite(b"import sys, os; O7=sys.stdout.write\r\n")
-            sswrite(b"import ubinascii; O8 = ubinascii.b2a_base64\r\n")
-            sswrite("O=open({}, 'rb')\r\n".format(repr(sourcefilename)).encode())
-            sswrite(b"O9=bytearray(%d)\r\n" % chunksize)
-            sswrite("O4=os.stat({})[6]\r\n".format(repr(sourcefilename)).encode())
-            sswrite(b"print(O4)\r\n")
-            sswrite(b'\r\x04')   # intermediate execution to get chunk size
-            chunkres = self.receivestream(bseekokay=True, bfetchfilecapture_nchunks=-1)
+        rtt, memfree = self.measurelink()
+        chunksize = max(30, min(3072, (memfree or 16000)//24))//3*3
+        sswrite("import _k\r\n_k.op({}, 'rb'); print(_k.sz({}))\r\n".format(repr(sourcefilename), repr(sourcefilename)).encode())
+        sswrite(b'\r\x04')   # intermediate execution to get file size
+        chunkres = self.receivestream(bseekokay=True, bfetchfilecapture_nchunks=-1)
+        try:
+            nbytes = int("".join(chunkres))
+        except ValueError:
+            self.sres(str(chunkres))
+            return None
+
+        fout = open(destinationfilename, "wb") if destinationfilename else None
+        res = bytearray(nbytes) if fout is None else None
+        pos = 0
+        def fetchlinefunc(line):
+            nonlocal pos
             try:
-                nbytes = int("".join(chunkres))
-            except ValueError:
-                self.sres(str(chunkres))
-                return None
-                
-            sswrite(b"O7(O8(O.read(O4%%%d)))\r\n" % chunksize)  # get sub-block
-            sswrite(b"while O.readinto(O9):  O7(O8(O9))\r\n")
-            sswrite(b"O.close(); del O, O7, O8, O9, O4\r\n")
+                b = binascii.a2b_base64(line)
+            except binascii.Error as e:
+                self.sres(str(e))
+                self.sres(str([line]))
+                return
+            if fout:
+                fout.write(b)
+            else:
+                res[pos:pos+len(b)] = b
+            pos += len(b)
+
+        t0 = time.time()
+        sswrite(b"_k.rd(%d, %d)\r\n" % (nbytes, chunksize))   # a first sub-block, then whole chunks
+        sswrite(b'\r\x04')
+        try:
+            self.receivestream(bseekokay=True, bfetchfilecapture_nchunks=nbytes//chunksize+1, fetchlinefunc=fetchlinefunc)
+        finally:
+            if fout:
+                fout.close()
+        if not bquiet:
+            self.sres("Fetched {}={} bytes from {} at {:.0f} bytes/s.\n".format(pos, nbytes, sourcefilename, pos/max(time.time()-t0, 1e-3)), clear_output=True)
+        if fout:
+            return pos
+        if pos < len(res):
+            del res[pos:]
+        return bytes(res) if bbinary else res.decode(errors="replace")
+
+
+    # The variable (any expression) comes back through memoryview() of it as lines of base64 
+    # like in fetchfile, after a line giving its typecode, itemsize, length and byteorder.
+    # Lists and tuples of numbers are packed into an array on the device first.
+    def getvar(self, varname, bquiet):
+        if not self.transport.brepl:
+            self.sres("Variable transfers not implemented for sockets\n", 31)
+            return None
+        if not self.devicehelper():
+            return None
+        sswrite = self.transport.write_all
+        
+        rtt, memfree = self.measurelink()
+        chunksize = max(30, min(3072, (memfree or 16000)//24))//3*3
+        sswrite("import _k\r\n_k.vd({})\r\n".format(varname).encode())
+        sswrite(b'\r\x04')   # intermediate execution to get the type and size
+        res = "".join(self.receivestream(bseekokay=True, bfetchfilecapture_nchunks=-1)).split()
+        if len(res) != 4 or not res[2].isdigit():
+            if res:   # (the traceback of a name that isn't there, or of something that isn't a buffer, has already been printed)
+                self.sres(" ".join(res) + "\n", 31)
+            return None
+        typecode, itemsize, nitems, byteorder = res[0], int(res[1]), int(res[2]), res[3]
+
+        data = bytearray(nitems*itemsize)
+        pos = 0
+        def fetchlinefunc(line):
+            nonlocal pos
+            try:
+                b = binascii.a2b_base64(line)
+            except binascii.Error as e:
+                self.sres(str(e))
+                self.sres(str([line]))
+                return
+            data[pos:pos+len(b)] = b
+            pos += len(b)
+
+        t0 = time.time()
+        nchunkitems = max(1, chunksize//itemsize)
+        sswrite(b"_k.vr(%d)\r\n" % nchunkitems)
+        sswrite(b'\r\x04')
+        self.receivestream(bseekokay=True, bfetchfilecapture_nchunks=nitems//nchunkitems+1, fetchlinefunc=fetchlinefunc)
+        if pos != len(data):
+            self.sres("Fetched {} of {} bytes of {}\n".format(pos, len(data), varname), 31)
+            return None
+        devicevar = DeviceVar(varname, typecode, itemsize, byteorder, bytes(data))
+        if not bquiet:
+            self.sres("Fetched {}: {} at {:.0f} bytes/s.\n".format(varname, devicevar.description(), pos/max(time.time()-t0, 1e-3)), clear_output=True)
+        return devicevar
+
+    # which of deflate (micropython 1.21+), zlib or uzlib the device has for decompressing, 
+    # and whether it can compress (only deflate, when built with MICROPY_PY_DEFLATE_COMPRESS)
+    def checkdevicecompressor(self):
+        if self.devicecompressor is None:
+            sswrite = self.transport.write_all
+            sswrite(b"import io\r\n")
+            sswrite(b"O1=''; O3=None\r\n")
+            sswrite(b"for O2 in ('deflate', 'zlib', 'uzlib'):\r\n")
+            sswrite(b" try:\r\n")
+            sswrite(b"  O3=__import__(O2)\r\n")
+            sswrite(b"  if O2=='deflate' or hasattr(O3, 'DecompIO'):  O1=O2; break\r\n")
+            sswrite(b" except ImportError:  pass\r\n")
+            sswrite(b"O4=0\r\n")
+            sswrite(b"try:  O3.DeflateIO(io.BytesIO(), O3.RAW).write(b'x'); O4=1\r\n")
+            sswrite(b"except Exception:  pass\r\n")
+            sswrite(b"print(O1 or 'none', O4); del O1, O2, O3, O4\r\n")
             sswrite(b'\r\x04')
-            chunks = self.receivestream(bseekokay=True, bfetchfilecapture_nchunks=nbytes//chunksize+1)
-            rres = [ ]
-            for ch in chunks:
-                try:
-                    rres.append(binascii.a2b_base64(ch))
-                except binascii.Error as e:
-                    self.sres(str(e))
-                    self.sres(str([ch]))
-            res = b"".join(rres)
-            if not bquiet:
-                self.sres("Fetched {}={} bytes from {}.\n".format(len(res), nbytes, sourcefilename), clear_output=True)
-            return res
-        self.sres("non-binary mode not implemented")
-        return None
+            res = "".join(self.receivestream(bseekokay=True, bfetchfilecapture_nchunks=-1)).split()
+            if len(res) == 2:
+                self.devicecompressor = (res[0] if res[0] != "none" else None, res[1] == "1")
+            else:
+                self.devicecompressor = (None, False)
+        return self.devicecompressor
 
+    # Deflates on the host, sends that to a temporary file, and then decompresses 
+    # it into the destination on the device in one pass through a DecompIO/DeflateIO stream
+    def sendtofilecompressed(self, destinationfilename, bmkdir, bappend, bbinary, bquiet, filecontents):
+        decompressor, bcancompress = self.checkdevicecompressor()
+        if decompressor is None:
+            self.sres("No zlib/deflate module on device, sending uncompressed\n", 31)
+            return self.sendtofile(destinationfilename, bmkdir, bappend, bbinary, bquiet, filecontents)
+
+        if not bbinary:
+            filecontents = (("\n" if bappend else "") + filecontents).encode()   # avoid line concattenation on appends
+        elif type(filecontents) == str:
+            filecontents = filecontents.encode()
+        compressor = zlib.compressobj(9, zlib.DEFLATED, -compresswbits)
+        compressed = compressor.compress(filecontents) + compressor.flush()
+
+        t0 = time.time()
+        tmpfilename = destinationfilename + ".z"
+        self.sendtofile(tmpfilename, bmkdir, False, True, True, compressed, breport=False)   # (reported below as the file it becomes)
+        if decompressor == "deflate":
+            opendecompio = "import deflate; O2=deflate.DeflateIO(O1, deflate.RAW, {})".format(compresswbits)
+        else:
+            opendecompio = "import {} as O2; O2=O2.DecompIO(O1, -{})".format(decompressor, compresswbits)
+        self.execprogram("\n".join([ "import os", 
+            "O1=open({}, 'rb')".format(repr(tmpfilename)), opendecompio, 
+            "O=open({}, '{}b'); O9=bytearray(512); O8=memoryview(O9)".format(repr(destinationfilename), "a" if bappend else "w"),
+            "while True:", " n=O2.readinto(O9)", " if not n:  break", " O.write(O8[:n])", 
+            "O.close(); O1.close(); os.remove({})".format(repr(tmpfilename)), 
+            "del O, O1, O2, O8, O9", "" ]).encode())
+        dt = max(time.time() - t0, 1e-3)
+        self.sres("Sent {} bytes compressed to {} ({:.1f}x smaller) to {} at an effective {:.0f} bytes/s.\n".format(len(filecontents), len(compressed), len(filecontents)/max(1, len(compressed)), destinationfilename, len(filecontents)/dt), clear_output=not bquiet)
+
+    # the mirror of sendtofilecompressed for firmware that can compress
+    def fetchfilecompressed(self, sourcefilename, bbinary, bquiet, destinationfilename=None):
+        decompressor, bcancompress = self.checkdevicecompressor()
+        if not bcancompress:
+            self.sres("Device firmware cannot compress, fetching uncompressed\n", 31)
+            return self.fetchfile(sourcefilename, bbinary, bquiet, destinationfilename)
+
+        t0 = time.time()
+        tmpfilename = sourcefilename + ".z"
+        self.execprogram("\n".join([ "import deflate", 
+            "O=open({}, 'rb'); O1=open({}, 'wb')".format(repr(sourcefilename), repr(tmpfilename)), 
+            "O2=deflate.DeflateIO(O1, deflate.RAW, {}); O9=bytearray(512); O8=memoryview(O9)".format(compresswbits), 
+            "while True:", " n=O.readinto(O9)", " if not n:  break", " O2.write(O8[:n])", 
+            "O2.close(); O1.close(); O.close()", "del O, O1, O2, O8, O9", "" ]).encode())
+        compressed = self.fetchfile(tmpfilename, True, True)
+        self.removefiles([tmpfilename])
+        if compressed is None:
+            return None
+        try:
+            res = zlib.decompress(compressed, -compresswbits)
+        except zlib.error as e:
+            self.sres("Decompression failed {}\n".format(str(e)), 31)
+            return None
+        dt = max(time.time() - t0, 1e-3)
+        if not bquiet:
+            self.sres("Fetched {} bytes compressed to {} ({:.1f}x smaller) from {} at an effective {:.0f} bytes/s.\n".format(len(res), len(compressed), len(res)/max(1, len(compressed)), sourcefilename, len(res)/dt), clear_output=True)
+        if destinationfilename:
+            fout = open(destinationfilename, "wb")
+            fout.write(res)
+            fout.close()
+            return len(res)
+        return res if bbinary else res.decode(errors="replace")
+
+    # (relpath, bdir, size, hash) of what's in devicedir (and below it if brecursive) in one 
+    # exchange, or none when it's all held from before; None if the directory isn't there
+    def listdevicefiles(self, devicedir, brecursive, bhashes, bforce=False):
+        if bforce or not self.devicefileindex.cached(devicedir, brecursive, bhashes):
+            if not self.devicehelper():
+                return None
+            self.transport.write_all(self.devicefileindex.deviceprogram(devicedir, brecursive, bhashes).replace("\n", "\r\n").encode())
+            self.transport.write_all(b'\r\x04')
+            if not self.devicefileindex.update(self.receivestream(bseekokay=True, bfetchfilecapture_nchunks=-1), bhashes):
+                return None
+        return list(self.devicefileindex.entries(devicedir, brecursive))
 
+    # size and sha256 of every file below devicedir, as {relpath: (size, hexdigest)}
+    # (listed afresh, as the device's own code could have changed them)
+    def devicefilehashes(self, devicedir):
+        entries = self.listdevicefiles(devicedir, True, True, bforce=True) or [ ]   # (directory not there yet)
+        return { relpath:(size, hash)  for relpath, bdir, size, hash in entries  if not bdir }
+
+    # the namespace index brought up to date in one round trip
+    def refreshnamespaceindex(self):
+        self.transport.write_all(self.namespaceindex.deviceprogram().replace("\n", "\r\n").encode())
+        self.transport.write_all(b'\r\x04')
+        self.namespaceindex.update(self.receivestream(bseekokay=True, bfetchfilecapture_nchunks=-1))
+
+    def removefiles(self, filenames):
+        self.devicefileindex.invalidateall()
+        sswrite = self.transport.write_all
+        sswrite(b"import os\r\n")
+        sswrite("for f in {}:  os.remove(f)\r\n".format(repr(list(filenames))).encode())
+        sswrite(b'\r\x04')
+        self.receivestream(bseekokay=True)
+
+    # Goes on as soon as the device has answered with the raw REPL prompt, rather than 
+    # sleeping a fixed time for it; the timeouts are only upper bounds, for a board that 
+    # is still booting (eg reset by the port opening) and missed the first Ctrl-C and Ctrl-A
     def enterpastemode(self, verbose=True):         # I don't think we ever make a connection and it's still in paste mode (this is revoked on connection break, but I am trying to use exitpastemode to make it better)
-        # now sort out connection situation
-        if self.workingserial or self.workingwebsocket:
-            sswrite = self.workingserial.write  if self.workingserial  else self.workingwebsocket.send
-            
-            time.sleep(0.2)   # try to give a moment to connect before issuing the Ctrl-C
-            sswrite(b'\x03')    # ctrl-C: kill off running programs
-            time.sleep(0.1)
-            l = self.workingserialreadall()
-            if l[-6:] == b'\r\n>>> ':
+        t0 = time.time()
+        if self.transport.brepl:
+            sswrite = self.transport.write_all
+            for timeout in [1, 1, 3]:
+                sswrite(b'\r\x03')    # ctrl-C: kill off running programs
+                #self.workingserial.write(b'\r\x02')        # ctrl-B: leave paste mode if still in it <-- doesn't work as when not in paste mode it reboots the device
+                sswrite(b'\r\x01')    # ctrl-A: enter raw REPL (or reset it if already there)
+                l = self.readrawuntil(rawreplprompt, timeout)
                 if verbose:
-                    self.sres('repl is in normal command mode\n')
-                    self.sres('[\\r\\x03\\x03] ')
+                    self.sres('repl is in normal command mode\n' if friendlyprompt in l else 'normal repl mode not detected\n')
+                    self.sres('[\\r\\x03\\r\\x01] ')
                     self.sres(str(l))
-            else:
-                if verbose:
-                    self.sres('normal repl mode not detected ')
-                    self.sres(str(l))
-                    self.sres('\nnot command mode\n')
-                    
-                
-            #self.workingserial.write(b'\r\x02')        # ctrl-B: leave paste mode if still in it <-- doesn't work as when not in paste mode it reboots the device
-            sswrite(b'\r\x01')        # ctrl-A: enter raw REPL
-            time.sleep(0.1)
-            l = self.workingserialreadall()
+                    self.sres('\n')
+                if l.endswith(rawreplprompt):
+                    break
+            l = self.workingserialreadall()   # a late answer to an earlier attempt
             if verbose and l:
-                self.sres('\n[\\r\\x01] ')
                 self.sres(str(l))
             sswrite(b'1\x04')         # single character program to run so receivestream works
         else:
-            self.workingsocket.write(b'1\x04')         # single character program "1" to run so receivestream works
+            self.transport.write_all(b'1\x04')         # single character program "1" to run so receivestream works
             
-        return self.receivestream(bseekokay=True, bwarnokaypriors=False, b5secondtimeout=True)
+        res = self.receivestream(bseekokay=True, bwarnokaypriors=False, b5secondtimeout=True)
+        logger.info("raw REPL %s in %.3fs on %s", "entered" if res else "not entered", time.time() - t0, self.transport.description())
+        return res
         
 
         
     def exitpastemode(self, verbose):   # try to make it clean
-        if self.workingserial or self.workingwebsocket:
-            sswrite = self.workingserial.write  if self.workingserial  else self.workingwebsocket.send
+        if self.transport and self.transport.brepl:
+            sswrite = self.transport.write_all
             try:
                 sswrite(b'\r\x03\x02')    # ctrl-C; ctrl-B to exit paste mode
-                time.sleep(0.1)
-                l = self.workingserialreadall()
+                l = self.readrawuntil(friendlyprompt, 0.5)
             except serial.SerialException as e:
                 self.sres("serial exception on close {}\n".format(str(e)))
                 return
@@ -510,39 +1044,92 @@ class DeviceConnector:
                 self.sres(str(l))
         
 
+    # direct reads that bypass the chunker, for the handshakes in the raw-paste protocol
+    def readrawbytes(self, n, timeout=serialtimeout):
+        return self.transport.read(n, timeout)
+
+    # a byte at a time, so nothing after the ending is taken from the chunker
+    def readrawuntil(self, ending, timeout):
+        res = bytearray()
+        tend = time.time() + timeout
+        while not res.endswith(ending) and time.time() < tend:
+            res += self.readrawbytes(1, max(0, tend - time.time()))
+        return bytes(res)
+
+    def rawbyteswaiting(self):
+        return self.transport.in_waiting()
+
+    # Sends a whole program using the raw-paste mode (Ctrl-E A Ctrl-A) of the raw REPL, 
+    # where the device advertises a window size and sends \x01 each time it has 
+    # room for another window, so we can write in big blocks without overrunning its buffer.
+    # Returns False (with the device still in the normal raw REPL) if the firmware 
+    # doesn't support it, and the caller should fall back to the old way.
+    # On success the device is compiling/executing and receivestream(bseekokay=False) 
+    # picks up the output\x04error\x04> that follows.
+    def rawpastewrite(self, programbytes):
+        if not (self.transport and self.transport.brepl) or self.rawpastesupported is False:
+            return False
+        sswrite = self.transport.write_all
+
+        sswrite(b'\x05A\x01')
+        r = self.readrawbytes(2)
+        if r != b'R\x01':
+            if r != b'R\x00':   # older firmware, which treats it as a Ctrl-A and re-enters raw REPL
+                l = self.readrawuntil(b'w REPL; CTRL-B to exit\r\n>', 2)
+                if not l.endswith(b'w REPL; CTRL-B to exit\r\n>'):
+                    self.sres("[raw-paste handshake unrecognized {}]\n".format(repr(r+l)), 31)
+            self.rawpastesupported = False
+            return False
+        self.rawpastesupported = True
+        windowsize = struct.unpack("<H", self.readrawbytes(2))[0]
+        windowremain = windowsize
+
+        self.marktime("firstwrite")
+        i = 0
+        while i < len(programbytes):
+            while windowremain == 0 or self.rawbyteswaiting():
+                b = self.readrawbytes(1)
+                if b == b'\x01':      # device can take another window of data
+                    windowremain += windowsize
+                elif b == b'\x04':    # device has ended it early (eg syntax error), acknowledge it
+                    sswrite(b'\x04')
+                    return True
+                elif b:
+                    self.sres("[unexpected byte during raw-paste {}]".format(repr(b)), 31)
+            b = programbytes[i:i+windowremain]
+            sswrite(b)
+            windowremain -= len(b)
+            i += len(b)
+
+        sswrite(b'\x04')   # end of data
+        self.marktime("lastwrite", True)
+        l = self.readrawuntil(b'\x04', 5)   # acknowledgement, then it compiles and runs the program
+        if not l.endswith(b'\x04'):
+            self.sres("[raw-paste end not acknowledged {}]\n".format(repr(l)), 31)
+        self.marktime("ok")
+        return True
+
     def writebytes(self, bytestosend):
-        if self.workingserial:
-            nbyteswritten = self.workingserial.write(bytestosend)
-            return ("serial.write {} bytes to {} at baudrate {}\n".format(nbyteswritten, self.workingserial.port, self.workingserial.baudrate))
-        elif self.workingwebsocket:
-            nbyteswritten = self.workingwebsocket.send(bytestosend)
-            return ("serial.write {} bytes to {}\n".format(nbyteswritten, "websocket"))  # don't worry; it always includes more bytes than you think
-        else:
-            nbyteswritten = self.workingsocket.write(bytestosend)
-            return ("serial.write {} bytes to {}\n".format(nbyteswritten, str(self.workingsocket)))
+        nbyteswritten = self.transport.write_all(bytestosend)
+        return ("serial.write {} bytes to {}\n".format(nbyteswritten, self.transport.description()))  # (on the websocket it always includes more bytes than you think)
 
     def sendrebootmessage(self):
-        if self.workingserial:
-            self.workingserial.write(b"\x03\r")  # quit any running program
-            self.workingserial.write(b"\x02\r")  # exit the paste mode with ctrl-B
-            self.workingserial.write(b"\x04\r")  # soft reboot code
-        elif self.workingwebsocket:
-            self.workingwebsocket.send(b"\x03\r")  # quit any running program
-            self.workingwebsocket.send(b"\x02\r")  # exit the paste mode with ctrl-B
-            self.workingwebsocket.send(b"\x04\r")  # soft reboot code
+        self.namespaceindex.invalidateall()
+        self.bdevicehelper = False   # (gone if it was only in RAM)
+        if self.transport.brepl:
+            self.transport.write_all(b"\x03\r")  # quit any running program
+            self.transport.write_all(b"\x02\r")  # exit the paste mode with ctrl-B
+            self.transport.write_all(b"\x04\r")  # soft reboot code
 
     def writeline(self, line):
-        if self.workingserial:
-            self.workingserial.write(line.encode("utf8"))
-            self.workingserial.write(b'\r\n')
-        elif self.workingwebsocket:
-            self.workingwebsocket.send(line.encode("utf8"))
-            self.workingwebsocket.send(b'\r\n')
-        else:
-            self.workingsocket.write(line.encode("utf8"))
-            self.workingsocket.write(b'\r\n')
+        self.transport.write_all(line.encode("utf8") + b'\r\n')
 
     def serialexists(self):
-        return self.workingserial or self.workingsocket or self.workingwebsocket
+        return self.transport
+
+    def connectiondescription(self):
+        if self.transport:
+            return self.transport.description()
+        return "not connected"
         
         
@@ -0,0 +1,73 @@
+import logging, re
+from .devicehelper import helperfilename
+
+logger = logging.getLogger(__name__)
+
+# code in a cell that could change the files on the device, so the listings held have to go
+filewritingcode = re.compile(r"\b(open|remove|rename|mkdir|rmdir|mount|umount|unlink|format|mkfs)\s*\(")
+
+def normpath(devicepath):
+    return devicepath.rstrip("/") if devicepath.strip("/") else ""
+
+# the kernel's own helper module, not to be listed or taken for an orphan by %syncdir
+# (the directory listed can be relative or absolute, and under /flash on some boards)
+def ishelperfile(devicepath):
+    devicepath = devicepath.lstrip("/")
+    return devicepath == helperfilename or devicepath == "flash/" + helperfilename
+
+
+# The directories listed so far on this connection, as { path:{ name:(bdir, size, hash) } },
+# so that %ls of somewhere already seen needs no exchange with the device at all.  Everything
+# goes when the kernel writes to the device, or a cell looks like it could have.
+class DeviceFileIndex:
+    def __init__(self):
+        self.dirs = { }
+        self.hashed = set()   # the directories listed with their hashes
+
+    def invalidateall(self):
+        self.dirs.clear()
+        self.hashed.clear()
+
+    def invalidatecell(self, code):
+        if filewritingcode.search(code):
+            self.invalidateall()
+
+    # walks the tree with os.ilistdir (which gives the sizes without a stat on most ports) in
+    # one execution, printing each directory as a "D path" line followed by a "d 0 - name" or
+    # "f size hash name" line for each entry (with "-" for no hash), or "E" if it isn't there
+    def deviceprogram(self, devicedir, brecursive, bhashes):
+        return "import _k\n_k.ls({!r}, {}, {})\n".format(normpath(devicedir), int(brecursive), int(bhashes))
+
+    # returns False if the directory was not there
+    def update(self, lines, bhashes):
+        entries = None
+        for line in lines:
+            line = line.rstrip("\r\n")
+            if line == "E":
+                return False
+            if line[:2] == "D ":
+                entrydir = normpath(line[2:])
+                entries = self.dirs[entrydir] = { }
+                if bhashes:
+                    self.hashed.add(normpath(line[2:]))
+            elif entries is not None and line[:2] in ("d ", "f "):
+                ls = line.split(" ", 3)
+                if len(ls) == 4 and ishelperfile(entrydir + "/" + ls[3]):
+                    continue
+                if len(ls) == 4 and ls[1].isdigit():
+                    entries[ls[3]] = (ls[0] == "d", int(ls[1]), ls[2] if ls[2] != "-" else None)
+        return True
+
+    def cached(self, devicedir, brecursive, bhashes):
+        devicedir = normpath(devicedir)
+        if devicedir not in self.dirs or (bhashes and devicedir not in self.hashed):
+            return False
+        return not brecursive or all(self.cached(devicedir + "/" + name, True, bhashes)  for name, (bdir, size, hash) in self.dirs[devicedir].items()  if bdir)
+
+    # (relpath, bdir, size, hash) below devicedir from what's held
+    def entries(self, devicedir, brecursive, prefix=""):
+        devicedir = normpath(devicedir)
+        for name, (bdir, size, hash) in sorted(self.dirs.get(devicedir, { }).items()):
+            yield prefix + name, bdir, size, hash
+            if bdir and brecursive:
+                yield from self.entries(devicedir + "/" + name, True, prefix + name + "/")
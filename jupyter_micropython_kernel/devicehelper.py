@@ -0,0 +1,142 @@
+import logging, hashlib
+
+logger = logging.getLogger(__name__)
+
+helperdir = "lib"   # (relative, as the working directory is /flash on some boards; lib is on sys.path either way)
+helperfilename = helperdir + "/_k.py"
+
+# The module the transfers call into on the device, so that each chunk is a short
+# call like _k.w(b"...") instead of statements that set up the same names every time.
+# It stays on the device's filesystem, and is only sent again when its version
+# (the hash of this source) differs from the one the kernel has.
+helpersource = """# helper for the jupyter_micropython_kernel's file transfers (it is sent again if missing)
+import os, sys, struct, ubinascii
+try:  import uhashlib as hashlib
+except ImportError:  import hashlib
+a=ubinascii.a2b_base64; b=ubinascii.b2a_base64; o=sys.stdout.write
+f=None; u=None; m=None
+
+def md(ds):
+ for d in ds:
+  try:  os.mkdir(d)
+  except OSError:  pass
+
+def op(n, k):
+ global f
+ f=open(n, k)
+
+def w(d):  f.write(a(d))
+def t(s):  f.write(s)
+
+def cl():
+ global f
+ f.close(); f=None
+
+def sz(n):
+ try:  return os.stat(n)[6]
+ except OSError:  return -1
+
+def rd(n, k):
+ o(b(f.read(n%k))); c=bytearray(k)
+ while f.readinto(c):  o(b(c))
+ cl()
+
+class U:
+ def __init__(s):  s.b=b''; s.f=None; s.n=0
+ def feed(s, d):
+  s.b+=d
+  while True:
+   if s.f is None:
+    if len(s.b)<6:  return
+    k, s.n=struct.unpack('<HI', s.b[:6])
+    if len(s.b)<6+k:  return
+    s.f=open(s.b[6:6+k].decode(), 'wb'); s.b=s.b[6+k:]
+   if s.n:
+    if not s.b:  return
+    x=s.b[:s.n]; s.f.write(x); s.n-=len(x); s.b=s.b[len(x):]
+   if not s.n:  s.f.close(); s.f=None
+
+def ub():
+ global u
+ u=U()
+
+def uf(d):  u.feed(a(d))
+
+def ue():
+ global u
+ u=None
+
+def hs(p):
+ h=hashlib.sha256(); c=bytearray(1024); v=memoryview(c); g=open(p, 'rb')
+ while True:
+  k=g.readinto(c)
+  if not k:  break
+  h.update(v[:k])
+ g.close()
+ return ubinascii.hexlify(h.digest()).decode()
+
+def ls(d, r, h):
+ try:  ls1(d, r, h)
+ except OSError:  print('E')
+
+def ls1(d, r, h):
+ print('D', d or '/'); s=[]
+ for e in os.ilistdir(d or '/'):
+  p=d+'/'+e[0]
+  if e[1]&0x4000:  print('d 0 -', e[0]); s.append(p); continue
+  print('f', e[3] if len(e)>3 and e[3]>=0 else os.stat(p)[6], hs(p) if h else '-', e[0])
+ if r:
+  for p in s:  ls1(p, r, h)
+
+def vd(x):
+ global m
+ try:  import array
+ except ImportError:  import uarray as array
+ c='B'
+ if isinstance(x, str):  x=x.encode(); c='s'
+ elif isinstance(x, array.array):  c=repr(x[:0])[7]
+ elif isinstance(x, (list, tuple)):
+  try:  x=array.array('i', x); c='i'
+  except (OverflowError, TypeError):  x=array.array('f', x); c='f'
+ m=memoryview(x)
+ print(c, len(bytes(array.array(c, [0]))) if c not in 'sB' else 1, len(m), sys.byteorder)
+
+def vr(k):
+ global m
+ for i in range(0, len(m), k):  o(b(m[i:i+k]))
+ m=None
+"""
+
+helperversion = hashlib.sha256(helpersource.encode()).hexdigest()[:16]
+helpersource += "V={!r}\n".format(helperversion)
+
+# checks the version of the installed module, and writes a new one over it if it differs
+# (or, if the filesystem can't be written, runs it from RAM until the next soft reboot)
+deviceinstall = """import sys, os
+try:
+ import _k; O1=_k.V
+except Exception:  O1=None
+if O1!={version!r}:
+ O2={source!r}
+ try:
+  try:  os.mkdir({dirname!r})
+  except OSError:  pass
+  O3=open({filename!r}, 'w'); O3.write(O2); O3.close()
+  sys.modules.pop('_k', None); import _k
+ except (OSError, ImportError):
+  O3={{}}; exec(O2, O3)
+  class _k:  pass
+  for O4 in O3:  setattr(_k, O4, O3[O4])
+  sys.modules['_k']=_k; del O4
+ del O2, O3
+print(_k.V, O1=={version!r})
+del O1
+"""
+
+deviceremove = """import os, sys
+try:  os.remove({filename!r})
+except OSError:  pass
+sys.modules.pop('_k', None)
+try:  del _k
+except NameError:  pass
+"""
@@ -0,0 +1,68 @@
+import logging, struct, json
+
+logger = logging.getLogger(__name__)
+
+try:
+    import numpy   # optional, pip install numpy (only needed for --as npy)
+except ImportError:
+    numpy = None
+
+# struct letters by element kind and size, as the sizes of the array typecodes
+# on the device (eg 'l' or 'i') depend on its port, so it sends the itemsize
+structletters = { ("i", 1):"b", ("i", 2):"h", ("i", 4):"i", ("i", 8):"q",
+                  ("u", 1):"B", ("u", 2):"H", ("u", 4):"I", ("u", 8):"Q",
+                  ("f", 4):"f", ("f", 8):"d" }
+
+def typecodekind(typecode):
+    if typecode in "fd":
+        return "f"
+    return "u" if typecode.isupper() or typecode == "s" else "i"
+
+
+# The contents of a device variable as one raw buffer (from memoryview() of it on
+# the device) with what's needed to reinterpret it on the host without parsing each
+# element: the array typecode ('s' for a str, 'B' for bytes), itemsize and byteorder.
+class DeviceVar:
+    def __init__(self, name, typecode, itemsize, byteorder, data):
+        self.name = name
+        self.typecode = typecode
+        self.itemsize = itemsize
+        self.byteorder = byteorder
+        self.data = data
+
+    def __len__(self):
+        return len(self.data)//self.itemsize
+
+    def structformat(self):
+        return ("<" if self.byteorder == "little" else ">") + structletters[(typecodekind(self.typecode), self.itemsize)]
+
+    def dtype(self):
+        return numpy.dtype(self.structformat())
+
+    def values(self):
+        if self.typecode == "s":
+            return self.data.decode(errors="replace")
+        if self.typecode == "B":
+            return bytes(self.data)
+        return [ v  for v, in struct.iter_unpack(self.structformat(), self.data) ]
+
+    def array(self):
+        return numpy.frombuffer(self.data, self.dtype())
+
+    def description(self):
+        if self.typecode == "s":
+            return "str of {} bytes".format(len(self.data))
+        if self.typecode == "B":
+            return "{} bytes".format(len(self.data))
+        return "array('{}') of {} items ({} bytes)".format(self.typecode, len(self), len(self.data))
+
+    # fmt is npy, json or bin (the raw buffer)
+    def save(self, filename, fmt):
+        if fmt == "npy":
+            numpy.save(filename, self.array())
+        elif fmt == "json":
+            with open(filename, "w") as fout:
+                json.dump({ "name":self.name, "typecode":self.typecode, "values":list(self.data) if self.typecode == "B" else self.values() }, fout)
+        else:
+            with open(filename, "wb") as fout:
+                fout.write(self.data)
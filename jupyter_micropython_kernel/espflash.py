@@ -0,0 +1,143 @@
+import logging, sys, time, re, threading, shutil, subprocess
+
+logger = logging.getLogger(__name__)
+
+try:
+    import esptool   # run in-process when it's installed alongside the kernel
+except ImportError:
+    esptool = None
+
+# fastest first, stepping down if a flash fails at that rate
+flashbauds = { "esp32":[921600, 460800, 115200],
+               "esp8266":[460800, 115200],
+               "erase":[115200] }
+
+progressline = re.compile(r"(\d+)(?:\.\d+)? ?%")
+
+def esptoolargs(espcommand, portname, binfile, baud):
+    pargs = ["--port", portname, "--baud", str(baud)]
+    if espcommand == "erase":
+        pargs.append("erase_flash")
+    if espcommand == "esp32":
+        pargs.extend(["--chip", "esp32", "write_flash", "-z", "0x1000", binfile])
+    if espcommand == "esp8266":
+        pargs.extend(["write_flash", "--flash_size=detect", "-fm", "dio", "0", binfile])
+    return pargs
+
+def esptoolcommand():
+    return shutil.which("esptool.py") or shutil.which("esptool")
+
+threadjobs = threading.local()   # the FlashJob of each thread running esptool in-process
+
+# stands in for sys.stdout or sys.stderr while esptool runs in-process,
+# so what each flashing thread prints goes to its own board's output
+class ThreadOutput:
+    def __init__(self, stream, berr):
+        self.stream = stream
+        self.berr = berr
+
+    def write(self, s):
+        job = getattr(threadjobs, "job", None)
+        if job is None:
+            return self.stream.write(s)
+        job.output(s, self.berr)
+        return len(s)
+
+    def flush(self):
+        self.stream.flush()
+
+    def isatty(self):
+        return False
+
+    def __getattr__(self, name):
+        return getattr(self.stream, name)
+
+
+# one board being erased or flashed on a thread.  Its output is printed a line at a time
+# with the port in front, and the progress lines only at every 10%
+class FlashJob:
+    def __init__(self, espcommand, portname, binfile, bauds, sres, label):
+        self.espcommand = espcommand
+        self.portname = portname
+        self.binfile = binfile
+        self.bauds = bauds
+        self.sres = sres
+        self.label = label
+        self.line = ""
+        self.lastpercent = -10
+        self.bprgprompted = False
+        self.bok = False
+        self.baud = None
+        self.duration = 0
+
+    def output(self, s, berr):
+        self.line += s
+        *lines, self.line = re.split("[\r\n]", self.line)
+        for line in lines:
+            if not line.strip():
+                continue
+            m = progressline.search(line)
+            if m:
+                percent = int(m.group(1))
+                if percent < self.lastpercent + 10 and percent != 100:
+                    continue
+                self.lastpercent = percent
+            self.sres("{}{}\n".format(self.label, line), n04count=1 if berr else 0)
+        if self.line[:12] == "Connecting.." and not self.bprgprompted:
+            self.sres("{}[Press the PRG button now if required]\n".format(self.label), 34)
+            self.bprgprompted = True
+
+    def run(self):
+        threadjobs.job = self
+        t0 = time.time()
+        if not (esptool or esptoolcommand()):
+            self.output("esptool not found on path (or installed with pip)\n", True)
+            return
+        for baud in self.bauds:
+            self.baud = baud
+            self.lastpercent = -10
+            if self.runesptool(esptoolargs(self.espcommand, self.portname, self.binfile, baud)):
+                self.bok = True
+                break
+            self.output("\n", True)
+        self.output("\n", False)
+        self.duration = time.time() - t0
+        logger.info("esptool %s on %s %s in %.1fs at %d baud", self.espcommand, self.portname, "done" if self.bok else "failed", self.duration, self.baud)
+
+    def runesptool(self, pargs):
+        if esptool:
+            try:
+                esptool.main(pargs)
+                return True
+            except SystemExit as e:
+                self.output("exit {}\n".format(e.code), True)
+            except Exception as e:   # esptool.FatalError, or a SerialException on opening the port
+                self.output("{}\n".format(e), True)
+            return False
+
+        process = subprocess.Popen([esptoolcommand()] + pargs, stdout=subprocess.PIPE, stderr=subprocess.PIPE)
+        errthread = threading.Thread(target=self.pump, args=(process.stderr, True), daemon=True)
+        errthread.start()
+        self.pump(process.stdout, False)
+        errthread.join()
+        return process.wait() == 0
+
+    def pump(self, stream, berr):
+        for b in iter(lambda: stream.read1(1024), b""):
+            self.output(b.decode(errors="replace"), berr)
+
+
+# flashes the boards in parallel, returning once all of them have finished
+def flashboards(jobs):
+    threads = [ threading.Thread(target=job.run, name="esptool", daemon=True)  for job in jobs ]
+    stdout, stderr = sys.stdout, sys.stderr
+    if esptool:
+        sys.stdout, sys.stderr = ThreadOutput(stdout, False), ThreadOutput(stderr, True)
+    try:
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            while thread.is_alive():
+                thread.join(0.1)   # (with a timeout so a KeyboardInterrupt gets through)
+    finally:
+        sys.stdout, sys.stderr = stdout, stderr
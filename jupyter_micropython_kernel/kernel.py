@@ -1,13 +1,21 @@
 from ipykernel.kernelbase import Kernel
 
-import logging, sys, time, os, re
+import logging, sys, time, os, re, json, hashlib, subprocess, shutil, threading
+from concurrent.futures import ThreadPoolExecutor
 import serial, socket, serial.tools.list_ports, select
 import websocket  # only for WebSocketConnectionClosedException
 from . import deviceconnector
+from .capturesink import CaptureSink, parsesize, parseduration
+from .celltimings import CellTiming, CellTimings
+from . import samplestream
+from . import devicevars
 
 logger = logging.getLogger(__name__)
 logger.setLevel(logging.INFO)
 
+iopubflushsize = 8192      # stream text is coalesced into one iopub message up to this many characters
+iopubflushtime = 0.05      # or for this many seconds since the first buffered piece
+
 serialtimeout = 0.5
 serialtimeoutcount = 10
 
@@ -19,20 +27,42 @@ ap_serialconnect.add_argument('--raw', help='Just open connection', action='stor
 ap_serialconnect.add_argument('--port', type=str, default=0)
 ap_serialconnect.add_argument('--baud', type=int, default=115200)
 ap_serialconnect.add_argument('--verbose', action='store_true')
+ap_serialconnect.add_argument('--name', type=str, help="name for this connection, so several devices can be open at once")
 
 ap_socketconnect = argparse.ArgumentParser(prog="%socketconnect", add_help=False)
 ap_socketconnect.add_argument('--raw', help='Just open connection', action='store_true')
 ap_socketconnect.add_argument('ipnumber', type=str)
 ap_socketconnect.add_argument('portnumber', type=int)
+ap_socketconnect.add_argument('--name', type=str, help="name for this connection, so several devices can be open at once")
 
 ap_disconnect = argparse.ArgumentParser(prog="%disconnect", add_help=False)
 ap_disconnect.add_argument('--raw', help='Close connection without exiting paste mode', action='store_true')
+ap_disconnect.add_argument('--remove-helper', help="delete the kernel's _k.py transfer helper from the device first", action='store_true')
 
 ap_websocketconnect = argparse.ArgumentParser(prog="%websocketconnect", add_help=False)
 ap_websocketconnect.add_argument('--raw', help='Just open connection', action='store_true')
 ap_websocketconnect.add_argument('websocketurl', type=str, default="ws://192.168.4.1:8266", nargs="?")
 ap_websocketconnect.add_argument("--password", type=str)
 ap_websocketconnect.add_argument('--verbose', action='store_true')
+ap_websocketconnect.add_argument('--name', type=str, help="name for this connection, so several devices can be open at once")
+
+ap_device = argparse.ArgumentParser(prog="%device", description="switch the device that cells run on, or list the named connections", add_help=False)
+ap_device.add_argument('name', type=str, nargs="?")
+
+ap_broadcast = argparse.ArgumentParser(prog="%%broadcast", description="run the rest of the cell (code or %-commands) on several devices at once", add_help=False)
+ap_broadcast.add_argument('names', type=str, nargs="*", help="devices to run on (default all connected)")
+
+ap_timing = argparse.ArgumentParser(prog="%timing", description="report where the time of recent cells went (upload, acknowledgement, first output, run)", add_help=False)
+ap_timing.add_argument('-n', type=int, default=10, help="number of recent cells")
+ap_timing.add_argument('--log', type=str, help="also append the timings of each cell to this JSON-lines file")
+ap_timing.add_argument('--log-off', action='store_true')
+ap_timing.add_argument('--clear', action='store_true')
+
+ap_stream = argparse.ArgumentParser(prog="%stream", description="decode binary records sent by streamframe(bytes) on the device into a numpy array or .npy file", add_help=False)
+ap_stream.add_argument('dtype', type=str, nargs="?", help="numpy dtype of a record, eg '<i2' or '<u4,<f4,<f4'")
+ap_stream.add_argument('--out', type=str, help=".npy file the records are appended to (can be opened with numpy.load(mmap_mode='r') as it grows)")
+ap_stream.add_argument('--save', type=str, help="save the records received so far to a .npy file")
+ap_stream.add_argument('--off', action='store_true')
 
 ap_writebytes = argparse.ArgumentParser(prog="%writebytes", add_help=False)
 ap_writebytes.add_argument('--binary', '-b', action='store_true')
@@ -42,11 +72,18 @@ ap_writebytes.add_argument('stringtosend', type=str)
 ap_readbytes = argparse.ArgumentParser(prog="%readbytes", add_help=False)
 ap_readbytes.add_argument('--binary', '-b', action='store_true')
 
+ap_backgroundreader = argparse.ArgumentParser(prog="%backgroundreader", description="read the device continuously on a thread so output between cells is kept", add_help=False)
+ap_backgroundreader.add_argument('--forward', '-f', action='store_true', help="print output arriving between cells as it comes (otherwise it is shown with its times at the start of the next cell)")
+ap_backgroundreader.add_argument('--size', type=float, default=16, help="megabytes held before the oldest is dropped")
+ap_backgroundreader.add_argument('--off', action='store_true')
+
 ap_sendtofile = argparse.ArgumentParser(prog="%sendtofile", description="send a file to the microcontroller's file system", add_help=False)
 ap_sendtofile.add_argument('--append', '-a', action='store_true')
 ap_sendtofile.add_argument('--mkdir', '-d', action='store_true')
 ap_sendtofile.add_argument('--binary', '-b', action='store_true')
 ap_sendtofile.add_argument('--execute', '-x', action='store_true')
+ap_sendtofile.add_argument('--compress', '-z', action='store_true', help="deflate and decompress on the device")
+ap_sendtofile.add_argument('--mpy', action='store_true', help="send a directory's .py files compiled with mpy-cross")
 ap_sendtofile.add_argument('--source', help="source file", type=str, default="<<cellcontents>>", nargs="?")
 ap_sendtofile.add_argument('--quiet', '-q', action='store_true')
 ap_sendtofile.add_argument('--QUIET', '-Q', action='store_true')
@@ -55,30 +92,61 @@ ap_sendtofile.add_argument('destinationfilename', type=str, nargs="?")
 ap_fetchfile = argparse.ArgumentParser(prog="%fetchfile", description="fetch a file from the microcontroller's file system", add_help=False)
 ap_fetchfile.add_argument('--binary', '-b', action='store_true')
 ap_fetchfile.add_argument('--print', '-p', action="store_true")
+ap_fetchfile.add_argument('--compress', '-z', action='store_true', help="compress on the device (needs the deflate module with compression)")
 ap_fetchfile.add_argument('--quiet', '-q', action='store_true')
 ap_fetchfile.add_argument('--QUIET', '-Q', action='store_true')
 ap_fetchfile.add_argument('sourcefilename', type=str)
 ap_fetchfile.add_argument('destinationfilename', type=str, nargs="?")
 
+ap_getvar = argparse.ArgumentParser(prog="%getvar", description="fetch a bytearray, array, str or list of numbers from the device as one buffer", add_help=False)
+ap_getvar.add_argument('--as', dest="fmt", choices=["npy", "json", "bin"], help="file format (otherwise from the destination's extension, or bin)")
+ap_getvar.add_argument('--quiet', '-q', action='store_true')
+ap_getvar.add_argument('varname', type=str, help="variable (or expression) on the device")
+ap_getvar.add_argument('destinationfilename', type=str, nargs="?")
+
+ap_ls = argparse.ArgumentParser(prog="%ls", description="list the files on the device (held from the last listing until the kernel or a cell writes to it)", add_help=False)
+ap_ls.add_argument('-R', dest="recursive", action='store_true', help="the whole tree below the directory")
+ap_ls.add_argument('--hash', action='store_true', help="with the sha256 of each file")
+ap_ls.add_argument('--refresh', action='store_true', help="list it again from the device")
+ap_ls.add_argument('devicedir', type=str, nargs="?", default="")
+
+ap_syncdir = argparse.ArgumentParser(prog="%syncdir", description="send only the files that differ from those on the device", add_help=False)
+ap_syncdir.add_argument('--delete', action='store_true', help="remove files on the device that are not in the source")
+ap_syncdir.add_argument('--quiet', '-q', action='store_true')
+ap_syncdir.add_argument('--mpy', action='store_true', help="send the .py files compiled with mpy-cross")
+ap_syncdir.add_argument('sourcedir', type=str)
+ap_syncdir.add_argument('destinationdir', type=str, nargs="?", default="")
+
 ap_mpycross = argparse.ArgumentParser(prog="%mpy-cross", add_help=False)
 ap_mpycross.add_argument('--set-exe', type=str)
-ap_mpycross.add_argument('pyfile', type=str, nargs="?")
+ap_mpycross.add_argument('--march', type=str, help="architecture for native code, eg xtensa, xtensawin, armv6m")
+ap_mpycross.add_argument('pyfile', type=str, nargs="?", help=".py file, or directory to compile all its .py files in parallel")
 
 ap_esptool = argparse.ArgumentParser(prog="%esptool", add_help=False)
-ap_esptool.add_argument('--port', type=str, default=0)
+ap_esptool.add_argument('--port', type=str, nargs="+", default=[0], help="one or more ports to flash in parallel, or all for every USB serial port")
+ap_esptool.add_argument('--baud', type=int, help="instead of the fastest that works for the chip")
 ap_esptool.add_argument('espcommand', choices=['erase', 'esp32', 'esp8266'])
 ap_esptool.add_argument('binfile', type=str, nargs="?")
 
 ap_capture = argparse.ArgumentParser(prog="%capture", description="capture output printed by device and save to a file", add_help=False)
 ap_capture.add_argument('--quiet', '-q', action='store_true')
 ap_capture.add_argument('--QUIET', '-Q', action='store_true')
-ap_capture.add_argument('outputfilename', type=str)
+ap_capture.add_argument('--compress', type=str, choices=["gzip", "zstd"], help="compress the file (also chosen by a .gz or .zst ending)")
+ap_capture.add_argument('--rotate-size', type=str, help="start a new numbered file after this size, eg 50M")
+ap_capture.add_argument('--rotate-time', type=str, help="start a new numbered file after this time, eg 1h")
+ap_capture.add_argument('--keep', type=int, default=0, help="number of rotated files to keep")
+ap_capture.add_argument('--background', '-b', action='store_true', help="keep capturing across cells until --stop")
+ap_capture.add_argument('--stop', action='store_true', help="stop a background capture")
+ap_capture.add_argument('outputfilename', type=str, nargs="?")
 
 ap_writefilepc = argparse.ArgumentParser(prog="%%writefile", description="write contents of cell to file on PC", add_help=False)
 ap_writefilepc.add_argument('--append', '-a', action='store_true')
 ap_writefilepc.add_argument('--execute', '-x', action='store_true')
 ap_writefilepc.add_argument('destinationfilename', type=str)
  
+# the %commands for completion, and their parsers for inspection
+magicparsers = { ap.prog:ap  for ap in list(globals().values())  if isinstance(ap, argparse.ArgumentParser) }
+magiccommands = sorted(set(magicparsers) | { "%comment", "%lsmagic", "%rebootdevice", "%reboot", "%writefile", "%serialdisconnect", "%sendbytes" })
 
 def parseap(ap, percentstringargs1):
     try:
@@ -86,6 +154,96 @@ def parseap(ap, percentstringargs1):
     except SystemExit:  # argparse throws these because it assumes you only want to do the command line
         return None  # should be a default one
         
+cachedir = os.path.join(os.path.expanduser("~"), ".cache", "jupyter_micropython_kernel")
+
+# (relpath, path) of the files to send from a directory, skipping .py files that have a compiled .mpy beside them
+# (or, when the .py files are to be compiled through the cache, skipping the .mpy, as it could be older than the source)
+def sourcefilelist(sourcedir, bcompile=False):
+    res = [ ]
+    for root, dirs, files in os.walk(sourcedir):
+        for fn in files:
+            fp = os.path.join(root, fn)
+            if bcompile and fn.endswith('.mpy') and os.path.exists(fp[:-4] + '.py'):
+                continue
+            if not bcompile and fn.endswith('.py') and os.path.exists(fp[:-3] + '.mpy'):
+                continue
+            res.append((os.path.relpath(fp, sourcedir).replace('\\', '/'), fp))
+    return res
+
+# {relpath: (size, sha256)} of the files, using the hashes in the manifest cache 
+# from the previous sync where the modification time and size haven't changed
+def hostfilehashes(sourcedir, files):
+    manifestfile = os.path.join(cachedir, "syncmanifest-{}.json".format(hashlib.sha256(os.path.abspath(sourcedir).encode()).hexdigest()[:16]))
+    try:
+        manifest = json.load(open(manifestfile))
+    except (OSError, ValueError):
+        manifest = { }
+    res = { }
+    newmanifest = { }
+    for relpath, fp in files:
+        st = os.stat(fp)
+        m = manifest.get(relpath)
+        if m and m[0] == st.st_mtime_ns and m[1] == st.st_size:
+            hexdigest = m[2]
+        else:
+            hexdigest = hashlib.sha256(open(fp, "rb").read()).hexdigest()
+        res[relpath] = (st.st_size, hexdigest)
+        newmanifest[relpath] = [st.st_mtime_ns, st.st_size, hexdigest]
+    try:
+        os.makedirs(cachedir, exist_ok=True)
+        json.dump(newmanifest, open(manifestfile, "w"))
+    except OSError:
+        pass
+    return res
+
+mpycrossversions = { }
+def mpycrossversion(mpycrossexe):
+    if mpycrossexe not in mpycrossversions:
+        try:
+            mpycrossversions[mpycrossexe] = subprocess.run([mpycrossexe, "--version"], stdout=subprocess.PIPE, stderr=subprocess.STDOUT).stdout.decode().strip()
+        except OSError:
+            return None
+    return mpycrossversions[mpycrossexe]
+
+# Compiles the .py files from the list of (relpath, path) in parallel (a pool of threads each 
+# running an mpy-cross process) into a cache keyed by the hash of the source, its name, 
+# the mpy-cross version and the flags, so unchanged modules are never recompiled.
+# Returns the list with the cached .mpy files in place of the .py files (except for
+# boot.py and main.py which have to stay as source), the errors, and the counts
+def mpycrossfiles(mpycrossexe, mpycrossflags, files):
+    version = mpycrossversion(mpycrossexe)
+    if version is None:
+        return files, ["{} not found".format(mpycrossexe)], 0, 0
+    mpydir = os.path.join(cachedir, "mpy")
+    os.makedirs(mpydir, exist_ok=True)
+
+    def compile1(relpath, fp):
+        key = hashlib.sha256(b"\0".join([open(fp, "rb").read(), relpath.encode(), version.encode(), " ".join(mpycrossflags).encode()])).hexdigest()
+        mpyfile = os.path.join(mpydir, key + ".mpy")
+        if os.path.exists(mpyfile):
+            return mpyfile, True, None
+        tmpfile = "{}.{}.tmp".format(mpyfile, os.getpid())
+        process = subprocess.run([mpycrossexe] + mpycrossflags + ["-s", relpath, "-o", tmpfile, fp], stdout=subprocess.PIPE, stderr=subprocess.PIPE)
+        if process.returncode != 0:
+            return None, False, process.stderr.decode()
+        os.replace(tmpfile, mpyfile)
+        return mpyfile, False, None
+
+    tocompile = [ (relpath, fp)  for relpath, fp in files  if relpath.endswith(".py") and os.path.basename(relpath) not in ("boot.py", "main.py") ]
+    with ThreadPoolExecutor(max_workers=os.cpu_count() or 4) as pool:
+        compiled = dict(zip(tocompile, pool.map(lambda f: compile1(*f), tocompile)))
+    res, errors, ncached = [ ], [ ], 0
+    for relpath, fp in files:
+        mpyfile, bcached, error = compiled.get((relpath, fp), (None, False, None))
+        if mpyfile:
+            res.append((relpath[:-3] + ".mpy", mpyfile))
+            ncached += bcached
+        else:
+            res.append((relpath, fp))
+            if error:
+                errors.append(error)
+    return res, errors, len(tocompile), ncached
+
 
 # Complete streaming of data to file with a quiet mode (listing number of lines)
 # Set this up for pulse reading and plotting in a second jupyter page
@@ -128,15 +286,92 @@ class MicroPythonKernel(Kernel):
     def __init__(self, **kwargs):
         Kernel.__init__(self, **kwargs)
         self.silent = False
+        self.threadlocal = threading.local()   # dc and output label of a %%broadcast worker thread
         self.dc = deviceconnector.DeviceConnector(self.sres, self.sresSYS)
+        self.devices = { "default":self.dc }   # named connections, of which self.dc is the active one
         self.mpycrossexe = None
+        self.mpycrossflags = [ ]
 
         self.srescapturemode = 0            # 0 none, 1 print lines, 2 print on-going line count (--quiet), 3 print only final line count (--QUIET)
-        self.srescapturedoutputfile = None  # used by %capture command
-        self.srescapturedlinecount = 0
+        self.srescapturedoutputfile = None  # CaptureSink used by %capture command
         self.srescapturedlasttime = 0       # to control the frequency of capturing reported
+        self.srescapturelock = threading.RLock()   # the %%broadcast workers all write to the one CaptureSink
+
+        self.iopubbuffer = [ ]              # pieces of stream text waiting to go out as a single message
+        self.iopubbuffername = None         # "stdout" or "stderr", flushed whenever it changes so the order is kept
+        self.iopubbufferlen = 0
+        self.iopubtimer = None              # flushes the buffer if the device goes quiet
+        self.iopublock = threading.Lock()
+        self.iopubnpieces = 0               # counters of what was coalesced (logged at the end of each cell)
+        self.iopubnmessages = 0
+        self.backgroundforward = False      # output read between cells by the background reader goes straight out
+        self.celltimings = CellTimings()    # for %timing
         
-        
+    # the device commands act on; within a %%broadcast worker it is that worker's device
+    @property
+    def dc(self):
+        return getattr(self.threadlocal, "dc", None) or self.activedc
+
+    @dc.setter
+    def dc(self, dc):
+        self.activedc = dc
+
+    def namedevice(self, name):
+        if name is not None:
+            if name not in self.devices:
+                self.devices[name] = deviceconnector.DeviceConnector(self.sres, self.sresSYS)
+            self.dc = self.devices[name]
+
+    def listdevices(self):
+        for name, dc in self.devices.items():
+            self.sres("{} {:10s} {}\n".format("*" if dc is self.dc else " ", name, dc.connectiondescription()), 32 if dc is self.dc else None)
+
+    # runs the cell on each device in its own thread, with the output of each labelled by its name
+    def broadcast(self, names, cellcontents):
+        names = names or [ name  for name, dc in self.devices.items()  if dc.serialexists() ]
+        unknown = [ name  for name in names  if name not in self.devices ]
+        if unknown:
+            self.sres("Unknown devices: {}\n".format(", ".join(unknown)), 31)
+            self.listdevices()
+            return
+        if not names:
+            self.sres("No devices connected\n", 31)
+            return
+
+        def runondevice(name):
+            self.threadlocal.dc = self.devices[name]
+            self.threadlocal.label = name
+            self.threadlocal.pending = ""
+            t0 = time.time()
+            try:
+                self.sendcommand(cellcontents)
+            except OSError as e:
+                self.sres("\n***OSError [%s]\n" % str(e.strerror), 31)
+            finally:
+                self.sresSYS("[finished in {:.1f}s]\n".format(time.time() - t0))
+                if self.threadlocal.pending:
+                    self.sres("\n")   # (the unfinished last line, labelled and captured like the rest)
+                self.threadlocal.__dict__.clear()
+
+        t0 = time.time()
+        pool = ThreadPoolExecutor(max_workers=len(names))
+        try:
+            list(pool.map(runondevice, names))
+        except KeyboardInterrupt:
+            self.sresSYS("\n\n*** Sending Ctrl-C to {}\n\n".format(", ".join(names)))
+            for name in names:
+                if self.devices[name].serialexists():
+                    self.devices[name].writebytes(b'\r\x03')
+        pool.shutdown(wait=True)
+        self.sresSYS("Broadcast to {} devices in {:.1f}s\n".format(len(names), time.time() - t0))
+
+    # output from a %%broadcast worker is collected into whole lines so the devices' lines don't interleave
+    def labellines(self, output):
+        lines = (self.threadlocal.pending + output).split("\n")
+        self.threadlocal.pending = lines.pop()
+        label = self.threadlocal.label
+        return "".join("[{}] {}\n".format(label, line)  for line in lines)
+
     def interpretpercentline(self, percentline, cellcontents):
         try:
             percentstringargs = shlex.split(percentline)
@@ -149,6 +384,7 @@ class MicroPythonKernel(Kernel):
 
         if percentcommand == ap_serialconnect.prog:
             apargs = parseap(ap_serialconnect, percentstringargs[1:])
+            self.namedevice(apargs.name)
             
             self.dc.disconnect(apargs.verbose)
             self.dc.serialconnect(apargs.port, apargs.baud, apargs.verbose)
@@ -170,6 +406,7 @@ class MicroPythonKernel(Kernel):
             if apargs.password is None and not apargs.raw:
                 self.sres(ap_websocketconnect.format_help())
                 return None
+            self.namedevice(apargs.name)
             self.dc.websocketconnect(apargs.websocketurl)
             if self.dc.workingwebsocket: 
                 self.sresSYS("** WebSocket connected **\n", 32)
@@ -180,7 +417,7 @@ class MicroPythonKernel(Kernel):
                         self.dc.workingwebsocket.send(apargs.password)
                         self.dc.workingwebsocket.send("\r\n")
                         res = self.dc.workingserialreadall()
-                        self.sres(res)  # '\r\nWebREPL connected\r\n>>> '
+                        self.sres(res.decode(errors="replace"))  # '\r\nWebREPL connected\r\n>>> '
                         if not apargs.raw:
                             if self.dc.enterpastemode(apargs.verbose):
                                 self.sresSYS("Ready.\n")
@@ -196,6 +433,7 @@ class MicroPythonKernel(Kernel):
         # this is the direct socket kind, not attached to a webrepl
         if percentcommand == ap_socketconnect.prog:   
             apargs = parseap(ap_socketconnect, percentstringargs[1:])
+            self.namedevice(apargs.name)
             self.dc.socketconnect(apargs.ipnumber, apargs.portnumber)
             if self.dc.workingsocket:
                 self.sres("\n ** Socket connected **\n\n", 32)
@@ -206,10 +444,45 @@ class MicroPythonKernel(Kernel):
                 #    self.dc.enterpastemode()
             return cellcontents.strip() and cellcontents or None
 
+        if percentcommand == ap_device.prog:
+            apargs = parseap(ap_device, percentstringargs[1:])
+            if apargs and apargs.name:
+                if apargs.name in self.devices:
+                    self.dc = self.devices[apargs.name]
+                else:
+                    self.sres("No device named {}\n".format(apargs.name), 31)
+            if apargs:
+                self.listdevices()
+            return cellcontents.strip() and cellcontents or None
+
+        if percentcommand == ap_timing.prog:
+            apargs = parseap(ap_timing, percentstringargs[1:])
+            if apargs:
+                if apargs.clear:
+                    self.celltimings.timings.clear()
+                if apargs.log_off:
+                    self.celltimings.logfilename = None
+                elif apargs.log:
+                    self.celltimings.logfilename = apargs.log
+                    self.sresSYS("Appending cell timings to {}\n".format(apargs.log))
+                if not apargs.clear:
+                    self.sres(self.celltimings.report(apargs.n))
+            else:
+                self.sres(ap_timing.format_help())
+            return cellcontents.strip() and cellcontents or None
+
+        if percentcommand == ap_broadcast.prog:
+            apargs = parseap(ap_broadcast, percentstringargs[1:])
+            if apargs and cellcontents.strip():
+                self.broadcast(apargs.names, cellcontents)
+            else:
+                self.sres(ap_broadcast.format_help())
+            return None
+
         if percentcommand == ap_esptool.prog:
             apargs = parseap(ap_esptool, percentstringargs[1:])
             if apargs and (apargs.espcommand == "erase" or apargs.binfile):
-                self.dc.esptool(apargs.espcommand, apargs.port, apargs.binfile)
+                self.dc.esptool(apargs.espcommand, apargs.port, apargs.binfile, apargs.baud)
             else:
                 self.sres(ap_esptool.format_help())
                 self.sres("Please download the bin file from https://micropython.org/download/#{}".format(apargs.espcommand if apargs else ""))
@@ -236,16 +509,19 @@ class MicroPythonKernel(Kernel):
 
         if percentcommand == "%mpy-cross":
             apargs = parseap(ap_mpycross, percentstringargs[1:])
+            if apargs and apargs.march:
+                self.mpycrossflags = ["-march={}".format(apargs.march)]
             if apargs and apargs.set_exe:
                 self.mpycrossexe = apargs.set_exe
-            elif apargs.pyfile:
-                if self.mpycrossexe:
-                    self.dc.mpycross(self.mpycrossexe, apargs.pyfile)
+            elif apargs and apargs.pyfile:
+                self.mpycrossexe = self.mpycrossexe or shutil.which("mpy-cross")
+                if not self.mpycrossexe:
+                    self.sres("Cross compiler executable not yet set (and no mpy-cross on the path)\n", 31)
+                    self.sres("try: %mpy-cross --set-exe /path/to/micropython/mpy-cross/build/mpy-cross\n")
+                elif os.path.isdir(apargs.pyfile):   # into the cache, from where --mpy on %sendtofile and %syncdir takes them
+                    self.mpycrossbuild([ (relpath, fp)  for relpath, fp in sourcefilelist(apargs.pyfile, bcompile=True)  if fp.endswith(".py") ])
                 else:
-                    self.sres("Cross compiler executable not yet set\n", 31)
-                    self.sres("try: %mpy-cross --set-exe /home/julian/extrepositories/micropython/mpy-cross/mpy-cross\n")
-                if self.mpycrossexe:
-                    self.mpycrossexe = "/home/julian/extrepositories/micropython/mpy-cross/mpy-cross"
+                    self.dc.mpycross(self.mpycrossexe, apargs.pyfile)
             else:
                 self.sres(ap_mpycross.format_help())
             return cellcontents.strip() and cellcontents or None
@@ -255,8 +531,14 @@ class MicroPythonKernel(Kernel):
             return cellcontents.strip() and cellcontents or None
             
         if percentcommand == "%lsmagic":
+            self.sres(re.sub("usage: ", "", ap_backgroundreader.format_usage()))
+            self.sres("    keeps reading the device between cells\n\n")
+            self.sres(re.sub("usage: ", "", ap_broadcast.format_usage()))
+            self.sres("    runs the rest of the cell on several named devices at once\n\n")
             self.sres(re.sub("usage: ", "", ap_capture.format_usage()))
             self.sres("    records output to a file\n\n")
+            self.sres(re.sub("usage: ", "", ap_device.format_usage()))
+            self.sres("    switches the device cells run on, or lists the connections\n\n")
             self.sres("%comment\n    print this into output\n\n")
             self.sres(re.sub("usage: ", "", ap_disconnect.format_usage()))
             self.sres("    disconnects from web/serial connection\n\n")
@@ -264,6 +546,8 @@ class MicroPythonKernel(Kernel):
             self.sres("    commands for flashing your esp-device\n\n")
             self.sres(re.sub("usage: ", "", ap_fetchfile.format_usage()))
             self.sres("    fetch and save a file from the device\n\n")
+            self.sres(re.sub("usage: ", "", ap_getvar.format_usage()))
+            self.sres("    fetch a buffer or list of numbers from the device in one transfer, and save it to a .npy, .json or raw file\n\n")
             self.sres("%lsmagic\n    list magic commands\n\n")
             self.sres(re.sub("usage: ", "", ap_mpycross.format_usage()))
             self.sres("    cross-compile a .py file to a .mpy file\n\n")
@@ -275,6 +559,14 @@ class MicroPythonKernel(Kernel):
             self.sres("    send cell contents or file/direcectory to the device\n\n")
             self.sres(re.sub("usage: ", "", ap_serialconnect.format_usage()))
             self.sres("    connects to a device over USB wire\n\n")
+            self.sres(re.sub("usage: ", "", ap_stream.format_usage()))
+            self.sres("    takes the binary records sent by streamframe() out of the output into a numpy array\n\n")
+            self.sres(re.sub("usage: ", "", ap_timing.format_usage()))
+            self.sres("    shows where the time went in recent cells, with percentiles\n\n")
+            self.sres(re.sub("usage: ", "", ap_ls.format_usage()))
+            self.sres("    list the files on the device in one exchange\n\n")
+            self.sres(re.sub("usage: ", "", ap_syncdir.format_usage()))
+            self.sres("    send only the files of a directory that differ from those on the device\n\n")
             self.sres(re.sub("usage: ", "", ap_socketconnect.format_usage()))
             self.sres("    connects to a socket of a device over wifi\n\n")
             self.sres("%suppressendcode\n    doesn't send x04 or wait to read after sending the contents of the cell\n")
@@ -291,6 +583,8 @@ class MicroPythonKernel(Kernel):
 
         if percentcommand == ap_disconnect.prog:
             apargs = parseap(ap_disconnect, percentstringargs[1:])
+            if apargs.remove_helper and self.dc.serialexists() and self.dc.transport.brepl:
+                self.dc.removedevicehelper()
             self.dc.disconnect(raw=apargs.raw, verbose=True)
             return None
         
@@ -299,15 +593,27 @@ class MicroPythonKernel(Kernel):
             return cellcontents
 
         if percentcommand == ap_capture.prog:
-            apargs = parseap(ap_capture, percentstringargs[1:])
-            if apargs:
-                self.sres("Writing output to file {}\n\n".format(apargs.outputfilename), asciigraphicscode=32)
-                self.srescapturedoutputfile = open(apargs.outputfilename, "w")
-                self.srescapturemode = (3 if apargs.QUIET else (2 if apargs.quiet else 1))
-                self.srescapturedlinecount = 0
-            else:
-                self.sres(ap_capture.format_help())
-            return cellcontents
+            with self.srescapturelock:
+                apargs = parseap(ap_capture, percentstringargs[1:])
+                if apargs and apargs.stop:
+                    if self.srescapturedoutputfile:
+                        self.srescapturedoutputfile.bbackground = False   # closed at the end of this cell
+                    else:
+                        self.sres("No capture running\n", 31)
+                elif apargs and apargs.outputfilename:
+                    if self.srescapturedoutputfile:
+                        self.closecapture()
+                    try:
+                        self.srescapturedoutputfile = CaptureSink(apargs.outputfilename, apargs.compress, rotatesize=(parsesize(apargs.rotate_size) if apargs.rotate_size else 0), 
+                                                                  rotatetime=(parseduration(apargs.rotate_time) if apargs.rotate_time else 0), keep=apargs.keep, bbackground=apargs.background)
+                    except (ImportError, OSError, ValueError) as e:
+                        self.sres("Cannot capture: {}\n".format(e), 31)
+                        return cellcontents
+                    self.sres("Writing output to file {}\n\n".format(self.srescapturedoutputfile.currentfilename()), asciigraphicscode=32)
+                    self.srescapturemode = (3 if apargs.QUIET else (2 if apargs.quiet else 1))
+                else:
+                    self.sres(ap_capture.format_help())
+                return cellcontents
 
         if percentcommand == ap_writebytes.prog:
             # (not effectively using the --binary setting)
@@ -321,6 +627,56 @@ class MicroPythonKernel(Kernel):
                 self.sres(ap_writebytes.format_help())
             return cellcontents.strip() and cellcontents or None
 
+        if percentcommand == ap_backgroundreader.prog:
+            apargs = parseap(ap_backgroundreader, percentstringargs[1:])
+            if apargs and apargs.off:
+                self.dc.stopbackgroundreader()
+                self.backgroundforward = False
+            elif apargs:
+                self.dc.startbackgroundreader(int(apargs.size*1e6))
+                self.backgroundforward = apargs.forward
+                self.sresSYS("Reading device in the background ({} output between cells)\n".format("printing" if apargs.forward else "keeping"))
+            else:
+                self.sres(ap_backgroundreader.format_help())
+            return cellcontents.strip() and cellcontents or None
+
+        if percentcommand == ap_stream.prog:
+            apargs = parseap(ap_stream, percentstringargs[1:])
+            sink = self.dc.framedemux.sink if self.dc.framedemux else None
+            if not apargs:
+                self.sres(ap_stream.format_help())
+            elif samplestream.numpy is None:
+                self.sres("%stream needs numpy (pip install numpy)\n", 31)
+            elif apargs.save or apargs.off:
+                if not sink:
+                    self.sres("Not streaming\n", 31)
+                if sink and apargs.save:
+                    sink.save(apargs.save)
+                    self.sresSYS("Saved {} records to {}\n".format(sink.nrecords, apargs.save))
+                if sink and apargs.off:
+                    self.dc.stopstream()
+                    sink.close()
+                    self.sresSYS(sink.summary())
+            elif apargs.dtype:
+                if not self.dc.serialexists():
+                    self.sres("No serial connected\n", 31)
+                    return None
+                try:
+                    newsink = samplestream.SampleStream(apargs.dtype, apargs.out)
+                except (TypeError, ValueError, OSError) as e:
+                    self.sres("{}\n".format(e), 31)
+                    return None
+                if sink:
+                    sink.close()
+                self.dc.startstream(newsink)
+                self.dc.execprogram(samplestream.devicestreamframe.encode())
+                self.sresSYS("Streaming records of {}{}; call streamframe(bytes) on the device\n".format(newsink.dtype, " to {}".format(apargs.out) if apargs.out else ""))
+            elif sink:
+                self.sres(sink.summary())
+            else:
+                self.sres(ap_stream.format_help())
+            return cellcontents.strip() and cellcontents or None
+
         if percentcommand == ap_readbytes.prog:
             # (not effectively using the --binary setting)
             apargs = parseap(ap_readbytes, percentstringargs[1:])
@@ -328,10 +684,8 @@ class MicroPythonKernel(Kernel):
             l = self.dc.workingserialreadall()
             if apargs.binary:
                 self.sres(repr(l))
-            elif type(l) == bytes:
-                self.sres(l.decode(errors="ignore"))
             else:
-                self.sres(l)   # strings come back from webrepl
+                self.sres(self.dc.outputtext(l))
             return cellcontents.strip() and cellcontents or None
             
         if percentcommand == "%rebootdevice":
@@ -369,25 +723,48 @@ class MicroPythonKernel(Kernel):
 
         if percentcommand == ap_fetchfile.prog:
             apargs = parseap(ap_fetchfile, percentstringargs[1:])
-            if apargs:
-                fetchedcontents = self.dc.fetchfile(apargs.sourcefilename, apargs.binary, apargs.quiet)
-                if apargs.print:
-                    self.sres(fetchedcontents.decode() if type(fetchedcontents)==bytes else fetchedcontents, clear_output=True)
-                if (apargs.destinationfilename or not apargs.print) and fetchedcontents:
-                    fout = open(apargs.destinationfilename or apargs.sourcefilename, "wb" if apargs.binary else "w")
+            fetchfile = apargs and (self.dc.fetchfilecompressed if apargs.compress else self.dc.fetchfile)
+            if apargs and not apargs.print:   # straight to disk without holding it in memory
+                fetchfile(apargs.sourcefilename, apargs.binary, apargs.quiet, apargs.destinationfilename or apargs.sourcefilename)
+            elif apargs:
+                fetchedcontents = fetchfile(apargs.sourcefilename, apargs.binary, apargs.quiet)
+                if fetchedcontents is not None:
+                    self.sres(fetchedcontents.decode(errors="replace") if type(fetchedcontents)==bytes else fetchedcontents, clear_output=True)
+                if apargs.destinationfilename and fetchedcontents is not None:
+                    fout = open(apargs.destinationfilename, "wb" if apargs.binary else "w")
                     fout.write(fetchedcontents)
                     fout.close()
             else:
                 self.sres(ap_fetchfile.format_help())
             return None
 
+        if percentcommand == ap_getvar.prog:
+            apargs = parseap(ap_getvar, percentstringargs[1:])
+            if not apargs:
+                self.sres(ap_getvar.format_help())
+                return None
+            fmt = apargs.fmt or os.path.splitext(apargs.destinationfilename or "")[1][1:]
+            fmt = fmt if fmt in ["npy", "json"] else "bin"
+            if apargs.destinationfilename and fmt == "npy" and devicevars.numpy is None:
+                self.sres("Saving as .npy needs numpy (pip install numpy)\n", 31)
+                return None
+            devicevar = self.dc.getvar(apargs.varname, apargs.quiet)
+            if devicevar is not None and apargs.destinationfilename:
+                devicevar.save(apargs.destinationfilename, fmt)
+                if not apargs.quiet:
+                    self.sresSYS("Saved to {} as {}\n".format(apargs.destinationfilename, fmt))
+            elif devicevar is not None:
+                values = devicevar.values()
+                self.sres("{}{}\n".format(repr(values[:20]), " ..." if len(values) > 20 else ""))
+            return None
+
         if percentcommand == ap_sendtofile.prog:
             apargs = parseap(ap_sendtofile, percentstringargs[1:])
             if apargs and not (apargs.source == "<<cellcontents>>" and not apargs.destinationfilename) and (apargs.source != None):
 
                 destfn = apargs.destinationfilename
                 def sendtofile(filename, contents):
-                    self.dc.sendtofile(filename, apargs.mkdir, apargs.append, apargs.binary, apargs.quiet, contents)
+                    (self.dc.sendtofilecompressed if apargs.compress else self.dc.sendtofile)(filename, apargs.mkdir, apargs.append, apargs.binary, apargs.quiet, contents)
 
                 if apargs.source == "<<cellcontents>>":
                     filecontents = cellcontents
@@ -411,34 +788,104 @@ class MicroPythonKernel(Kernel):
                     elif os.path.isdir(apargs.source):
                         if apargs.execute:
                             self.sres("Cannot excecute folder\n", 31)
-                        for root, dirs, files in os.walk(apargs.source):
-                            for fn in files:
-                                skip = False
-                                fp = os.path.join(root, fn)
-                                relpath = os.path.relpath(fp, apargs.source)
-                                if relpath.endswith('.py'):
-                                    # Check for compiled copy, skip py if exists
-                                    if os.path.exists(fp[:-3] + '.mpy'):
-                                        skip = True
-                                if not skip:
-                                    destpath = os.path.join(destfn, relpath).replace('\\', '/')
-                                    filecontents = open(os.path.join(root, fn), mode).read()
-                                    sendtofile(destpath, filecontents)
+                        sourcefiles = self.sourcefiles(apargs.source, apargs.mpy)
+                        files = [ (os.path.join(destfn, relpath).replace('\\', '/'), open(fp, "rb" if relpath.endswith(".mpy") else mode).read())  for relpath, fp in sourcefiles ]
+                        if apargs.append or apargs.compress:
+                            for destpath, filecontents in files:
+                                sendtofile(destpath, filecontents)
+                        else:   # all in one stream
+                            self.dc.sendfilebatch([ (destpath, filecontents if type(filecontents) == bytes else filecontents.encode())  for destpath, filecontents in files ], apargs.quiet)
             else:
                 self.sres(ap_sendtofile.format_help())
             return cellcontents   # allows for repeat %sendtofile in same cell
 
+        if percentcommand == ap_ls.prog:
+            apargs = parseap(ap_ls, percentstringargs[1:])
+            if not apargs:
+                self.sres(ap_ls.format_help())
+            elif not (self.dc.serialexists() and self.dc.transport.brepl):
+                self.sres("No serial connected\n", 31)
+            else:
+                entries = self.dc.listdevicefiles(apargs.devicedir, apargs.recursive, apargs.hash, apargs.refresh)
+                if entries is None:
+                    self.sres("No directory {} on the device\n".format(apargs.devicedir or "/"), 31)
+                else:
+                    for relpath, bdir, size, hash in entries:
+                        self.sres("{:>9s} {}{}{}\n".format("" if bdir else str(size), (hash[:16] + "  ") if hash else "", relpath, "/" if bdir else ""))
+                    nfiles = sum(not bdir  for relpath, bdir, size, hash in entries)
+                    self.sres("{} files, {} directories, {} bytes\n".format(nfiles, len(entries) - nfiles, sum(size  for relpath, bdir, size, hash in entries  if not bdir)))
+            return None
+
+        if percentcommand == ap_syncdir.prog:
+            apargs = parseap(ap_syncdir, percentstringargs[1:])
+            if apargs and os.path.isdir(apargs.sourcedir):
+                self.syncdir(apargs.sourcedir, apargs.destinationdir, apargs.delete, apargs.mpy, apargs.quiet)
+            else:
+                self.sres(ap_syncdir.format_help())
+            return cellcontents.strip() and cellcontents or None
+
 
         self.sres("Unrecognized percentline {}\n".format([percentline]), 31)
         return cellcontents
         
+    def syncdir(self, sourcedir, destinationdir, bdelete, bmpy, bquiet):
+        t0 = time.time()
+        files = self.sourcefiles(sourcedir, bmpy)
+        hosthashes = hostfilehashes(sourcedir, files)
+        devicehashes = self.dc.devicefilehashes(destinationdir)
+        destprefix = destinationdir.rstrip("/") + "/"
+
+        sources = dict(files)
+        changed = [ relpath  for relpath in sorted(hosthashes)  if hosthashes[relpath] != devicehashes.get(relpath) ]
+        if changed:
+            self.dc.sendfilebatch([ (destprefix + relpath, open(sources[relpath], "rb").read())  for relpath in changed ], bquiet)
+
+        orphans = sorted(set(devicehashes) - set(hosthashes))
+        if orphans and bdelete:
+            self.dc.removefiles([ destprefix + relpath  for relpath in orphans ])
+
+        nbytessent = sum(hosthashes[relpath][0]  for relpath in changed)
+        nbytesskipped = sum(hosthashes[relpath][0]  for relpath in hosthashes) - nbytessent
+        self.sres("Synced {} to {} in {:.1f}s: {} files sent ({} bytes), {} unchanged ({} bytes skipped)".format(sourcedir, destprefix, time.time() - t0, len(changed), nbytessent, len(hosthashes) - len(changed), nbytesskipped), clear_output=not bquiet)
+        if orphans:
+            self.sres(", {} {}".format(len(orphans), "deleted" if bdelete else "on device only (--delete to remove)"))
+        self.sres("\n")
+        
+    # the files to send from a directory, with the .py files compiled through the cache for --mpy
+    # (without a cross compiler, any .mpy built beside its .py is sent in its place, as for no --mpy)
+    def sourcefiles(self, sourcedir, bmpy):
+        if bmpy and (self.mpycrossexe or shutil.which("mpy-cross")):
+            return self.mpycrossbuild(sourcefilelist(sourcedir, bcompile=True))
+        if bmpy:
+            self.sres("Cross compiler executable not yet set (%mpy-cross --set-exe), sending the files as they are\n", 31)
+        return sourcefilelist(sourcedir)
+
+    # the files list with .py files swapped for their compiled .mpy from the cache
+    def mpycrossbuild(self, files):
+        self.mpycrossexe = self.mpycrossexe or shutil.which("mpy-cross")
+        if not self.mpycrossexe:
+            self.sres("Cross compiler executable not yet set (%mpy-cross --set-exe), sending .py files\n", 31)
+            return files
+        t0 = time.time()
+        res, errors, ncompile, ncached = mpycrossfiles(self.mpycrossexe, self.mpycrossflags, files)
+        for error in errors:
+            self.sres(error, 31)
+        self.sresSYS("Compiled {} modules ({} cached, {} errors) in {:.0f}ms on {} workers\n".format(ncompile, ncached, len(errors), (time.time() - t0)*1000, os.cpu_count() or 4))
+        return res
+
     def runnormalcell(self, cellcontents, bsuppressendcode):
         cmdlines = cellcontents.splitlines(True)
         r = self.dc.workingserialreadall()
         if r:
             self.sres('[priorstuff] ')
-            self.sres(str(r))
-            
+            self.sres(self.dc.outputtext(r))
+
+        # whole cell in flow-controlled blocks where the firmware supports raw-paste mode
+        if not bsuppressendcode and self.dc.rawpastewrite(cellcontents.encode("utf8")):
+            self.dc.receivestream(bseekokay=False)
+            return
+
+        self.dc.marktime("firstwrite")
         for line in cmdlines:
             if line:
                 if line[-2:] == '\r\n':
@@ -449,19 +896,21 @@ class MicroPythonKernel(Kernel):
                 r = self.dc.workingserialreadall()
                 if r:
                     self.sres('[duringwriting] ')
-                    self.sres(str(r))
+                    self.sres(self.dc.outputtext(r))
                     
         if not bsuppressendcode:
             self.dc.writebytes(b'\r\x04')
+            self.dc.marktime("lastwrite", True)
             self.dc.receivestream(bseekokay=True)
         
     def sendcommand(self, cellcontents):
         bsuppressendcode = False  # can't yet see how to get this signal through
         
-        if self.srescapturedoutputfile:
-            self.srescapturedoutputfile.close()   # shouldn't normally get here
-            self.sres("closing stuck open srescapturedoutputfile\n")
-            self.srescapturedoutputfile = None
+        with self.srescapturelock:   # (a %%broadcast worker runs inside the cell that opened the capture)
+            if self.srescapturedoutputfile and not self.srescapturedoutputfile.bbackground and getattr(self.threadlocal, "label", None) is None:
+                self.srescapturedoutputfile.close()   # shouldn't normally get here
+                self.srescapturedoutputfile = None
+                self.sres("closing stuck open srescapturedoutputfile\n")
             
         # extract any %-commands we have here at the start (or ending?), tolerating pure comment lines and white space before the first % (if there's no %-command in there, then no lines at the front get dropped due to being comments)
         while True:
@@ -483,34 +932,137 @@ class MicroPythonKernel(Kernel):
         if cellcontents:
             self.runnormalcell(cellcontents, bsuppressendcode)
             
+    # between cells the background reader's output goes to the notebook as it arrives
+    def idleforward(self):
+        if self.dc.backgroundreader and self.backgroundforward:
+            self.dc.backgroundreader.setidlecallback(lambda b: self.sres(self.dc.outputdecoder.feed(b)))   # (a character split across blocks is kept for the next)
+        if self.dc.framedemux:
+            self.dc.framedemux.sink.flush()
+
+    # at the end of a cell rather than on the keystroke, so that completion never waits on the link
+    def refreshnamespaceindex(self):
+        if self.dc.namespaceindex.bstale and self.dc.serialexists() and self.dc.transport.brepl:
+            t0 = time.time()
+            try:
+                self.dc.refreshnamespaceindex()
+            except (OSError, KeyboardInterrupt, websocket.WebSocketConnectionClosedException) as e:
+                logger.warning("namespace index not refreshed %s", e)
+                return
+            logger.debug("namespace index refreshed in %.3fs", time.time() - t0)
+
+    def do_complete(self, code, cursor_pos):
+        namespaceindex = self.dc.namespaceindex
+        namespaceindex.bused = True
+        line = code[:cursor_pos].rsplit("\n", 1)[-1]
+        m = re.match(r"\s*(%%?[\w-]*)$", line)
+        if m:
+            matches = [ c  for c in magiccommands  if c.startswith(m.group(1)) ]
+            return {'status': 'ok', 'matches': matches, 'cursor_start': cursor_pos - len(m.group(1)), 'cursor_end': cursor_pos, 'metadata': {}}
+        if not namespaceindex.bfetched:   # (the one time it waits for the device)
+            self.refreshnamespaceindex()
+        matches, cursor_start = namespaceindex.complete(code, cursor_pos)
+        return {'status': 'ok', 'matches': matches, 'cursor_start': cursor_start, 'cursor_end': cursor_pos, 'metadata': {}}
+
+    def do_inspect(self, code, cursor_pos, detail_level=0, omit_sections=()):
+        m = re.search(r"%%?[\w-]+$|[A-Za-z_][\w.]*$", code[:cursor_pos] + re.match(r"[\w-]*", code[cursor_pos:]).group(0))
+        text = None
+        if m and m.group(0) in magicparsers:
+            text = magicparsers[m.group(0)].format_help()
+        elif m and m.group(0)[0] != "%":
+            text = self.dc.namespaceindex.inspect(m.group(0).rstrip("."))
+        if text is None:
+            return {'status': 'ok', 'found': False, 'data': {}, 'metadata': {}}
+        return {'status': 'ok', 'found': True, 'data': {'text/plain': text}, 'metadata': {}}
+
+    def finishcelltiming(self, celltiming):
+        for dc in self.devices.values():
+            if dc.celltiming is celltiming:
+                dc.celltiming = None
+        celltiming.finish(self.dc.transport, (self.iopubnpieces, self.iopubnmessages))
+        self.celltimings.add(celltiming)
+
+    def closecapture(self):
+        with self.srescapturelock:
+            if self.srescapturemode == 2:
+                self.send_response(self.iopub_socket, 'clear_output', {"wait":True})
+            if self.srescapturemode == 2 or self.srescapturemode == 3:
+                output = "{} lines captured.".format(self.srescapturedoutputfile.nlines)  # finish off by updating with the correct number captured
+                stream_content = {'name': "stdout", 'text': output }
+                self.send_response(self.iopub_socket, 'stream', stream_content)
+                
+            self.srescapturedoutputfile.close()
+            self.srescapturedoutputfile = None
+            self.srescapturemode = 0
+
     def sresSYS(self, output, clear_output=False):   # system call
         self.sres(output, asciigraphicscode=34, clear_output=clear_output)
     # 1=bold, 31=red, 32=green, 34=blue; from http://ascii-table.com/ansi-escape-sequences.php
     def sres(self, output, asciigraphicscode=None, n04count=0, clear_output=False):
         if self.silent:
             return
-            
-        if self.srescapturedoutputfile and (n04count == 0) and not asciigraphicscode:
-            self.srescapturedoutputfile.write(output)
-            self.srescapturedlinecount += len(output.split("\n"))-1
-            if self.srescapturemode == 3:            # 0 none, 1 print lines, 2 print on-going line count (--quiet), 3 print only final line count (--QUIET)
+
+        blabelled = getattr(self.threadlocal, "label", None) is not None
+        if blabelled:   # (before the capture, so that it gets whole labelled lines from each device)
+            if asciigraphicscode:   # coloured a line at a time so each labelled line stands alone
+                output = "\n".join(("\x1b[{}m{}\x1b[0m".format(asciigraphicscode, piece) if piece else "")  for piece in output.split("\n"))
+            output = self.labellines(output)
+            if not output:
                 return
-                
-            # changes the printing out to a lines captured statement every 1second.  
-            if self.srescapturemode == 2:  # (allow stderrors to drop through to normal printing
-                srescapturedtime = time.time()
-                if srescapturedtime < self.srescapturedlasttime + 1:   # update no more frequently than once a second
+            
+        with self.srescapturelock:
+            if self.srescapturedoutputfile and (n04count == 0) and not asciigraphicscode:
+                self.srescapturedoutputfile.write(output)
+                if self.srescapturemode == 3:            # 0 none, 1 print lines, 2 print on-going line count (--quiet), 3 print only final line count (--QUIET)
                     return
-                self.srescapturedlasttime = srescapturedtime
-                clear_output = True
-                output = "{} lines captured".format(self.srescapturedlinecount)
+                    
+                # changes the printing out to a lines captured statement every 1second.  
+                if self.srescapturemode == 2:  # (allow stderrors to drop through to normal printing
+                    srescapturedtime = time.time()
+                    if srescapturedtime < self.srescapturedlasttime + 1:   # update no more frequently than once a second
+                        return
+                    self.srescapturedlasttime = srescapturedtime
+                    clear_output = True
+                    output = "{} lines captured".format(self.srescapturedoutputfile.nlines)
 
+        if clear_output and blabelled:
+            clear_output = False   # would wipe the other devices' output
         if clear_output:  # used when updating lines printed
+            self.iopubflush()
             self.send_response(self.iopub_socket, 'clear_output', {"wait":True})
-        if asciigraphicscode:
+        if asciigraphicscode and not blabelled:
             output = "\x1b[{}m{}\x1b[0m".format(asciigraphicscode, output)
-        stream_content = {'name': ("stdout" if n04count == 0 else "stderr"), 'text': output }
-        self.send_response(self.iopub_socket, 'stream', stream_content)
+        self.iopubwrite("stdout" if n04count == 0 else "stderr", output)
+
+    # buffers stream text so that a device printing fast doesn't produce a message per chunk
+    def iopubwrite(self, name, text):
+        with self.iopublock:
+            if self.iopubbuffername != name:
+                self.iopubflushlocked()
+                self.iopubbuffername = name
+            self.iopubbuffer.append(text)
+            self.iopubbufferlen += len(text)
+            self.iopubnpieces += 1
+            if self.iopubbufferlen >= iopubflushsize:
+                self.iopubflushlocked()
+            elif self.iopubtimer is None:
+                self.iopubtimer = threading.Timer(iopubflushtime, self.iopubflush)
+                self.iopubtimer.daemon = True
+                self.iopubtimer.start()
+
+    def iopubflush(self):
+        with self.iopublock:
+            self.iopubflushlocked()
+
+    def iopubflushlocked(self):
+        if self.iopubtimer is not None:
+            self.iopubtimer.cancel()
+            self.iopubtimer = None
+        if self.iopubbuffer:
+            stream_content = {'name': self.iopubbuffername, 'text': "".join(self.iopubbuffer) }
+            self.iopubbuffer.clear()
+            self.iopubbufferlen = 0
+            self.iopubnmessages += 1
+            self.send_response(self.iopub_socket, 'stream', stream_content)
 
     def do_execute(self, code, silent, store_history=True, user_expressions=None, allow_stdin=False):
         self.silent = silent
@@ -518,9 +1070,26 @@ class MicroPythonKernel(Kernel):
             return {'status': 'ok', 'execution_count': self.execution_count, 'payload': [], 'user_expressions': {}}
 
         interrupted = False
+        self.dc.namespaceindex.invalidatecell(code)
+        self.dc.devicefileindex.invalidatecell(code)
+        celltiming = CellTiming(code, self.dc.transport, (self.iopubnpieces, self.iopubnmessages))
+        self.dc.celltiming = celltiming
+        if self.dc.backgroundreader:
+            self.dc.backgroundreader.setidlecallback(None)
         
         # clear buffer out before executing any commands (except the readbytes one)
-        if self.dc.serialexists() and not re.match("\s*%readbytes|\s*%disconnect|\s*%serialconnect|\s*websocketconnect", code):
+        if self.dc.backgroundreader and not re.match("\s*%readbytes", code):
+            if self.dc.backgroundreader.ndropped:
+                self.sres("[{} bytes dropped from the full background buffer]\n".format(self.dc.backgroundreader.ndropped), 31)
+                self.dc.backgroundreader.ndropped = 0
+            for t, pbline in self.dc.backgroundreader.readlines():   # output kept from between cells, with the times it arrived
+                pbline = self.dc.outputtext(pbline).rstrip("\r\n")
+                if pbline:
+                    self.sres('[leftinbuffer {}] '.format(time.strftime("%H:%M:%S", time.localtime(t))))
+                    self.sres(str([pbline]))
+                    self.sres('\n')
+
+        elif self.dc.serialexists() and not re.match("\s*%readbytes|\s*%disconnect|\s*%serialconnect|\s*websocketconnect", code):
             priorbuffer = None
             try:
                 priorbuffer = self.dc.workingserialreadall()
@@ -528,9 +1097,10 @@ class MicroPythonKernel(Kernel):
                 interrupted = True
             except OSError as e:
                 priorbuffer = []
-                self.sres("\n\n***Connection broken [%s]\n" % str(e.strerror), 31)
-                self.sres("You may need to reconnect")
-                self.dc.disconnect(raw=True, verbose=True)
+                if not self.dc.reconnect():
+                    self.sres("\n\n***Connection broken [%s]\n" % str(e.strerror), 31)
+                    self.sres("You may need to reconnect")
+                    self.dc.disconnect(raw=True, verbose=True)
                 
             except websocket.WebSocketConnectionClosedException as e:
                 priorbuffer = []
@@ -539,15 +1109,7 @@ class MicroPythonKernel(Kernel):
                 self.dc.disconnect(raw=True, verbose=True)
                 
             if priorbuffer:
-                if type(priorbuffer) == bytes:
-                    try:
-                        priorbuffer = priorbuffer.decode()
-                    except UnicodeDecodeError:
-                        priorbuffer = str(priorbuffer)
-                
-                for pbline in priorbuffer.splitlines():
-                    if deviceconnector.wifimessageignore.match(pbline):
-                        continue   # filter out boring wifi status messages
+                for pbline in self.dc.outputtext(priorbuffer).splitlines():   # (with the boring wifi status messages filtered out)
                     if pbline:
                         self.sres('[leftinbuffer] ')
                         self.sres(str([pbline]))
@@ -564,17 +1126,13 @@ class MicroPythonKernel(Kernel):
         #    self.sres(self.asyncmodule.before + 'Restarting Bash')
         #    self.startasyncmodule()
 
-        if self.srescapturedoutputfile:
-            if self.srescapturemode == 2:
-                self.send_response(self.iopub_socket, 'clear_output', {"wait":True})
-            if self.srescapturemode == 2 or self.srescapturemode == 3:
-                output = "{} lines captured.".format(self.srescapturedlinecount)  # finish off by updating with the correct number captured
-                stream_content = {'name': "stdout", 'text': output }
-                self.send_response(self.iopub_socket, 'stream', stream_content)
-                
-            self.srescapturedoutputfile.close()
-            self.srescapturedoutputfile = None
-            self.srescapturemode = 0
+        self.iopubflush()
+        with self.srescapturelock:
+            if self.srescapturedoutputfile:
+                if self.srescapturedoutputfile.bbackground:
+                    self.srescapturedoutputfile.flush()
+                else:
+                    self.closecapture()
             
         if interrupted:
             self.sresSYS("\n\n*** Sending Ctrl-C\n\n")
@@ -587,9 +1145,17 @@ class MicroPythonKernel(Kernel):
                     self.sres("\n\nKeyboard interrupt while waiting response on Ctrl-C\n\n")
                 except OSError as e:
                     self.sres("\n\n***OSError while issuing a Ctrl-C [%s]\n\n" % str(e.strerror))
+            self.iopubflush()
+            self.finishcelltiming(celltiming)
+            self.idleforward()
             return {'status': 'abort', 'execution_count': self.execution_count}
             
         # everything already gone out with send_response(), but could detect errors (text between the two \x04s
+        logger.debug("iopub: %d stream pieces sent in %d messages", self.iopubnpieces, self.iopubnmessages)
+        self.finishcelltiming(celltiming)
+        if self.dc.namespaceindex.bused:
+            self.refreshnamespaceindex()
+        self.idleforward()
 
         return {'status': 'ok', 'execution_count': self.execution_count, 'payload': [], 'user_expressions': {}}
                     
@@ -0,0 +1,106 @@
+import logging, re, keyword, os
+
+logger = logging.getLogger(__name__)
+
+# names that a cell binds, whose cached attributes have to be fetched again
+bindingstatement = re.compile(r"^\s*([\w\s.,*()\[\]]+?)\s*(?:[-+*/%&|^@]|//|>>|<<|\*\*)?=(?!=)", re.M)
+bindingkeyword = re.compile(r"\b(?:import|as|def|class|for|del|global)\s+([\w\s.,*()]+)")
+rootname = re.compile(r"(?<![\w.])[A-Za-z_]\w*")
+dottedname = re.compile(r"[A-Za-z_][\w.]*$|$")
+
+# Run on the device to list the globals with their types, and the attributes (two levels
+# down, for the classes in a module) of those that aren't in the known roots already held.
+# Printed as lines of "path name typename", with "." as the path of the globals.
+devicenamespace = """O1=globals(); O2={!r}; O6=('int', 'float', 'bool', 'NoneType', 'function', 'bound_method', 'closure')
+def O5(p, o, d):
+ for n in dir(o):
+  try:  t=type(getattr(o, n)).__name__
+  except Exception:  t='?'
+  print(p, n, t)
+  if d and t=='type' and n[0]!='_':  O5(p+'.'+n, getattr(o, n), 0)
+for O3 in list(O1):
+ if O3[0]=='O' and O3[1:].isdigit():  continue
+ O4=O1[O3]; print('.', O3, type(O4).__name__)
+ if O3 not in O2 and O3[0]!='_' and type(O4).__name__ not in O6:  O5(O3, O4, 1)
+if 'builtins' not in O2:
+ try:  import builtins; O5('builtins', builtins, 0)
+ except ImportError:  pass
+del O1, O2, O3, O4, O5, O6
+"""
+
+# The dir() of the globals and of what's in them, held on the host so that completion
+# and inspection (called on every keystroke) never wait on the device.  It's fetched
+# in one round trip, and after that only the globals list and the roots that a cell
+# has rebound (or a sent file could have replaced) are fetched again, at the end of
+# the cell, and only once completion has been used on this connection.
+class NamespaceIndex:
+    def __init__(self):
+        self.attrs = { }       # path ("." for the globals) -> { name:typename }
+        self.bfetched = False
+        self.bused = False
+        self.bstale = True
+
+    def roots(self):
+        return set(path.split(".")[0]  for path in self.attrs  if path != ".")
+
+    def invalidateroot(self, root):
+        for path in [ path  for path in self.attrs  if path == root or path.startswith(root + ".") ]:
+            del self.attrs[path]
+
+    def invalidatecell(self, code):
+        self.bstale = True
+        bound = set()
+        for m in bindingstatement.finditer(code):
+            bound.update(rootname.findall(m.group(1)))
+        for m in bindingkeyword.finditer(code):
+            bound.update(rootname.findall(re.split(r"\bin\b", m.group(1))[0]))
+        for root in bound & self.roots():
+            self.invalidateroot(root)
+
+    def invalidatefile(self, filename):   # a module sent to the device can be imported again under the name of the file (or its package)
+        self.bstale = True
+        self.invalidateroot(os.path.splitext(filename.strip("/").split("/")[0])[0])
+
+    def invalidateall(self):
+        self.attrs.clear()
+        self.bstale = True
+
+    def deviceprogram(self):
+        return devicenamespace.format(sorted(self.roots()))
+
+    def update(self, lines):
+        self.attrs.pop(".", None)
+        for line in lines:
+            ls = line.split()
+            if len(ls) == 3:
+                self.attrs.setdefault(ls[0], { })[ls[1]] = ls[2]
+        for root in self.roots() - set(self.attrs.get(".", { })) - { "builtins" }:   # (globals since deleted)
+            self.invalidateroot(root)
+        self.bfetched = True
+        self.bstale = False
+
+    def names(self, path):
+        if path:
+            return self.attrs.get(path, { })
+        res = dict.fromkeys(keyword.kwlist, "keyword")
+        res.update(self.attrs.get("builtins", { }))
+        res.update(self.attrs.get(".", { }))
+        return res
+
+    # (matches, cursor_start) for the dotted name ending at cursor_pos
+    def complete(self, code, cursor_pos):
+        token = dottedname.search(code[:cursor_pos]).group(0)
+        path, _, prefix = token.rpartition(".")
+        matches = sorted(name  for name in self.names(path)  if name.startswith(prefix) and (prefix[:1] == "_" or name[:1] != "_"))
+        return matches, cursor_pos - len(prefix)
+
+    def inspect(self, name):
+        path, _, last = name.rpartition(".")
+        typename = self.names(path).get(last)
+        if typename is None:
+            return None
+        res = "{}: {}\n".format(name, typename)
+        attrs = [ "{} ({})".format(n, t)  for n, t in sorted(self.attrs.get(name, { }).items())  if n[:1] != "_" ]
+        if attrs:
+            res += "\n" + "\n".join(attrs) + "\n"
+        return res
@@ -0,0 +1,128 @@
+import logging, time, struct, threading
+
+logger = logging.getLogger(__name__)
+
+try:
+    import numpy   # optional, pip install numpy (only %stream needs it)
+except ImportError:
+    numpy = None
+
+headerupdatetime = 1         # seconds between rewrites of the .npy header while it grows
+
+# Defined on the device by %stream.  Each call sends one block of records (bytes,
+# or anything with the buffer protocol like an array) raw, in a frame that the 
+# FrameDemux (in transports.py) takes out of the output before the REPL sees it.
+# (It has to be written raw, as sys.stdout itself turns \n into \r\n, and no bigger 
+# than the maxframesize there, or the FrameDemux would pass it through as text.)
+devicestreamframe = """import sys, struct
+def streamframe(b, _w=getattr(getattr(sys.stdout, "buffer", None), "write", None), _s=[0]):
+    if _w is None:
+        raise OSError("no sys.stdout.buffer to write frames to")
+    if not isinstance(b, (bytes, bytearray)):
+        b = bytes(b)
+    if len(b) > 16384:
+        raise ValueError("frame of %d bytes is over 16384" % len(b))
+    _w(struct.pack("<2sHH", b"\\xff\\xfe", len(b), _s[0] & 0xffff))
+    _w(b)
+    _s[0] += 1
+"""
+
+# the header of a .npy file (version 1.0) padded to headerlen, so it can be rewritten in place as the count grows
+def npyheader(dtype, nrecords, headerlen=None):
+    d = "{{'descr': {!r}, 'fortran_order': False, 'shape': ({},), }}".format(numpy.lib.format.dtype_to_descr(dtype), nrecords)
+    headerlen = headerlen or -(-(10 + len(d) + 1)//64)*64   # (total aligned to 64 bytes)
+    return b"\x93NUMPY\x01\x00" + struct.pack("<H", headerlen - 10) + d.encode("latin1").ljust(headerlen - 11) + b"\n"
+
+
+# Records from the frames decoded with numpy.frombuffer into an array held in the
+# kernel (doubling in size as it fills), or appended to a .npy file that can be
+# opened with numpy.load(mmap_mode="r") while it is still growing, as its header
+# is kept up to date with the number of records written so far.
+class SampleStream:
+    def __init__(self, dtype, outputfilename=None):
+        self.dtype = numpy.dtype(dtype)
+        self.outputfilename = outputfilename
+        self.data = numpy.empty(1024, self.dtype) if not outputfilename else None
+        self.nrecords = 0
+        self.nframes = 0
+        self.nbytes = 0
+        self.ndropped = 0       # frames missing from the sequence numbers
+        self.nbadframes = 0     # payload not a whole number of records
+        self.lastseq = None
+        self.starttime = None
+        self.lasttime = None
+        self.fout = None
+        self.lock = threading.Lock()   # (frames can arrive on the background reader's thread)
+        if outputfilename:
+            self.fout = open(outputfilename, "wb")
+            self.headerlen = len(npyheader(self.dtype, 10**15))   # room for any count we'll reach
+            self.fout.write(npyheader(self.dtype, 0, self.headerlen))
+            self.headertime = time.time()
+
+    def addframe(self, seq, payload):
+        with self.lock:
+            self.addrecords(seq, payload)
+
+    def addrecords(self, seq, payload):
+        self.lasttime = time.time()
+        if self.starttime is None:
+            self.starttime = self.lasttime
+        if self.lastseq is not None:
+            self.ndropped += (seq - self.lastseq - 1) & 0xffff
+        self.lastseq = seq
+        self.nframes += 1
+        if len(payload) % self.dtype.itemsize:
+            self.nbadframes += 1
+            return
+        n = len(payload)//self.dtype.itemsize
+        if self.fout:
+            self.fout.write(payload)   # (already in the byte layout of the dtype)
+            if self.lasttime > self.headertime + headerupdatetime:
+                self.updateheader(self.nrecords + n)
+        else:
+            if self.nrecords + n > len(self.data):
+                self.data = numpy.resize(self.data, max(len(self.data)*2, self.nrecords + n))
+            self.data[self.nrecords:self.nrecords + n] = numpy.frombuffer(payload, self.dtype)
+        self.nrecords += n
+        self.nbytes += len(payload)
+
+    # brings the .npy file up to date, at the end of each cell
+    def flush(self):
+        with self.lock:
+            if self.fout:
+                self.updateheader(self.nrecords)
+
+    def updateheader(self, nrecords):
+        self.fout.flush()
+        pos = self.fout.tell()
+        self.fout.seek(0)
+        self.fout.write(npyheader(self.dtype, nrecords, self.headerlen))
+        self.fout.seek(pos)
+        self.fout.flush()
+        self.headertime = time.time()
+
+    def array(self):
+        if self.outputfilename:
+            self.flush()
+            return numpy.load(self.outputfilename, mmap_mode="r")
+        return self.data[:self.nrecords]
+
+    def save(self, filename):
+        numpy.save(filename, self.array())
+
+    def close(self):
+        self.flush()
+        with self.lock:
+            if self.fout:
+                self.fout.close()
+                self.fout = None
+
+    def summary(self):
+        dt = (self.lasttime - self.starttime) if self.nframes > 1 else 0
+        res = "{} records of {} in {} frames ({} bytes{})".format(self.nrecords, self.dtype, self.nframes, self.nbytes, ", {:.0f} records/s".format(self.nrecords/dt) if dt else "")
+        res += ", {} frames dropped, {} bad".format(self.ndropped, self.nbadframes)
+        if self.outputfilename:
+            res += ", in {}".format(self.outputfilename)
+        if self.nrecords:
+            res += "\nlast: {}".format(self.array()[-1])
+        return res + "\n"
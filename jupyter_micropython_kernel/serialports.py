@@ -0,0 +1,56 @@
+import logging, os, time
+import serial.tools.list_ports
+
+logger = logging.getLogger(__name__)
+
+portsrescantime = 2   # seconds a scan is kept for where there is no /dev to watch (Windows)
+
+# The serial ports and the boards on them, rescanned only when something has been
+# added to or removed from /dev (seen from its modification time), as a full
+# list_ports enumeration reads through sysfs (or the registry) for every port.
+# A board is known by its USB vid, pid and serial number, which stay the same
+# when it comes back under a different /dev/ttyUSB* after a reset or replug.
+class PortIndex:
+    def __init__(self):
+        self.ports = [ ]
+        self.signature = None
+        self.scantime = 0
+
+    def devsignature(self):
+        try:
+            return os.stat("/dev").st_mtime_ns
+        except OSError:
+            return None
+
+    def refresh(self, bforce=False):
+        signature = self.devsignature()
+        if bforce or signature != self.signature or (signature is None and time.time() > self.scantime + portsrescantime):
+            t0 = time.time()
+            self.ports = list(serial.tools.list_ports.grep(""))
+            self.signature = signature
+            self.scantime = time.time()
+            logger.debug("scanned %d serial ports in %.3fs", len(self.ports), self.scantime - t0)
+        return self.ports
+
+    # port names in order of likelihood
+    def guessports(self):
+        lp = sorted(self.refresh(), key=lambda X: (X.hwid == "n/a", X.device))  # n/a could be good evidence that the port is non-existent
+        return [x.device  for x in lp]
+
+    def usbports(self):
+        return sorted(x.device  for x in self.refresh()  if x.vid is not None)
+
+    # (vid, pid, serial number) of the board on the port, or None if it's not a USB device
+    # (from the ports held, with a rescan only if the port isn't among them)
+    def boardkey(self, portname):
+        for bforce in (False, True):
+            for x in self.refresh(bforce):
+                if x.device == portname or os.path.realpath(portname) == x.device:
+                    return (x.vid, x.pid, x.serial_number) if x.vid is not None else None
+        return None
+
+    def findboard(self, key):
+        for x in self.refresh():
+            if x.vid is not None and (x.vid, x.pid, x.serial_number) == key:
+                return x.device
+        return None
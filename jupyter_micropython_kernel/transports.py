@@ -0,0 +1,426 @@
+import logging, time, threading, collections, struct
+import serial, select
+import websocket
+
+logger = logging.getLogger(__name__)
+
+serialtimeout = 0.5   # how long a read blocks when nothing is coming in
+
+framemagic = b"\xff\xfe"              # never in utf8 text, so a frame can't be confused with printed output
+frameheader = struct.Struct("<2sHH")   # magic, payload length, sequence number
+maxframesize = 16384
+
+# One connection to a device behind the same bulk interface, so the REPL
+# protocol in DeviceConnector makes a single call per block read or written
+# rather than branching on the kind of connection.
+# A transport reads from its pushback (bytes that a handshake read past) before
+# the connection itself, and can be tuned separately (eg the linkrate
+# used for sizing the file transfer blocks).
+class Transport:
+    brepl = True           # passes the REPL control characters (Ctrl-A/B/C/D/E) through
+    brawpaste = False      # raw-paste flow control is worth using (it limits a high-latency link)
+    bflowcontrol = True    # the link itself holds back what the device hasn't read yet (as TCP does)
+    linkrate = 20000       # bytes per second assumed when sizing the transfers
+    readallwait = 0        # seconds to wait for more data when clearing the buffer
+    bfileprotocol = False  # has write_binary() and read_binary() for the webrepl file protocol
+
+    def __init__(self):
+        self.pushback = bytearray()
+        self.nbyteswritten = 0   # totals over the connection, for the %timing of cells
+        self.nbytesread = 0
+
+    # whatever has arrived, blocking for up to serialtimeout if nothing has (returning b'')
+    def read_available(self):
+        if self.pushback:
+            b = bytes(self.pushback)
+            self.pushback.clear()
+            return b
+        return self.readconnection()
+
+    def wait_readable(self, timeout):
+        raise NotImplementedError
+
+    def readconnection(self):
+        raise NotImplementedError
+
+    def write_all(self, b):
+        raise NotImplementedError
+
+    # up to n bytes, waiting until there are n or the timeout is up
+    def read(self, n, timeout=serialtimeout):
+        tend = time.time() + timeout
+        while len(self.pushback) < n and self.wait_readable(max(0, tend - time.time())):
+            self.pushback += self.readconnection()
+        res = bytes(self.pushback[:n])
+        del self.pushback[:n]
+        return res
+
+    def in_waiting(self):
+        if not self.pushback and self.wait_readable(0):
+            self.pushback += self.readconnection()
+        return len(self.pushback)
+
+    # everything that's come in without blocking, usually to clear out the incoming buffer
+    def read_all(self):
+        res = bytearray(self.pushback)
+        self.pushback.clear()
+        while self.wait_readable(self.readallwait):
+            b = self.readconnection()
+            if not b:
+                break
+            res += b
+        return bytes(res)
+
+    def close(self):
+        pass
+
+    def description(self):
+        return self.__class__.__name__
+
+    def bytecounts(self):
+        return (self.nbyteswritten, self.nbytesread)
+
+
+class SerialTransport(Transport):
+    brawpaste = True
+    bflowcontrol = False   # (a plain raw REPL can overrun the device's input buffer)
+
+    def __init__(self, s):
+        Transport.__init__(self)
+        self.s = s
+        self.linkrate = s.baudrate/10   # 8N1
+
+    def readconnection(self):
+        b = self.s.read(self.s.in_waiting or 1)   # blocks for up to serialtimeout when nothing is waiting
+        self.nbytesread += len(b)
+        return b
+
+    def wait_readable(self, timeout):   # (select doesn't work on serial ports under Windows)
+        tend = time.time() + timeout
+        while not (self.pushback or self.s.in_waiting):
+            if time.time() >= tend:
+                return False
+            time.sleep(0.002)
+        return True
+
+    def read(self, n, timeout=serialtimeout):   # the port's own timeout is serialtimeout
+        if len(self.pushback) < n:
+            b = self.s.read(n - len(self.pushback))
+            self.nbytesread += len(b)
+            self.pushback += b
+        return Transport.read(self, n, 0)
+
+    def in_waiting(self):
+        return len(self.pushback) + self.s.in_waiting
+
+    def read_all(self):
+        b = self.s.read_all()
+        self.nbytesread += len(b)
+        res = bytes(self.pushback) + b
+        self.pushback.clear()
+        return res
+
+    def write_all(self, b):
+        self.nbyteswritten += len(b)
+        return self.s.write(b)
+
+    def close(self):
+        self.s.close()
+
+    def description(self):
+        return "serial {} {}".format(self.s.port, self.s.baudrate)
+
+
+# a raw TCP socket to a device (not the webrepl), which is not driven as a REPL
+class SocketTransport(Transport):
+    brepl = False
+
+    def __init__(self, sock):
+        Transport.__init__(self)
+        self.sock = sock
+
+    def readconnection(self):
+        r,w,e = select.select([self.sock], [], [], serialtimeout)
+        b = self.sock.recv(4096) if r else b''
+        self.nbytesread += len(b)
+        return b
+
+    def wait_readable(self, timeout):
+        if self.pushback:
+            return True
+        r,w,e = select.select([self.sock], [], [], timeout)
+        return bool(r)
+
+    def write_all(self, b):
+        self.nbyteswritten += len(b)
+        self.sock.sendall(b)
+        return len(b)
+
+    def close(self):
+        self.sock.close()
+
+    def description(self):
+        return "socket {}".format(self.sock.getpeername())
+
+
+# the webrepl over a websocket, which delivers a whole frame at a time.  
+# The REPL is carried in text frames and the file protocol in binary frames, 
+# which are kept apart here so neither gets mixed into the other
+class WebsocketTransport(Transport):
+    readallwait = 0.02   # enough for frames already on their way, without a long stall on every drain
+    bfileprotocol = True
+
+    def __init__(self, ws, websocketurl):
+        Transport.__init__(self)
+        self.ws = ws
+        self.websocketurl = websocketurl
+        self.binarypushback = bytearray()
+
+    def readconnection(self):
+        r,w,e = select.select([self.ws], [], [], serialtimeout)
+        if not r:
+            return b''
+        opcode, b = self.ws.recv_data()   # (the raw bytes of a text frame, rather than decoding them)
+        self.nbytesread += len(b)
+        if opcode == websocket.ABNF.OPCODE_BINARY:
+            self.binarypushback += b
+            return b''
+        return b
+
+    def write_binary(self, b):
+        self.nbyteswritten += len(b)
+        return self.ws.send_binary(b)
+
+    def read_binary(self, n, timeout=5):
+        tend = time.time() + timeout
+        while len(self.binarypushback) < n:
+            r,w,e = select.select([self.ws], [], [], max(0, tend - time.time()))
+            if not r:
+                break
+            self.pushback += self.readconnection()   # any REPL output on the way is kept for the chunker
+        res = bytes(self.binarypushback[:n])
+        del self.binarypushback[:n]
+        return res
+
+    def wait_readable(self, timeout):
+        if self.pushback:
+            return True
+        r,w,e = select.select([self.ws], [], [], timeout)
+        return bool(r)
+
+    def write_all(self, b):
+        self.nbyteswritten += len(b)
+        return self.ws.send(b)
+
+    def close(self):
+        self.ws.close()
+
+    def description(self):
+        return "websocket {}".format(self.websocketurl)
+
+
+# Drains another transport on a thread into a bounded buffer of timestamped blocks,
+# so output printed between cells (from timers or _thread) is not lost when the
+# OS/USB buffer fills, and the reads during a cell come from memory.
+# When the idlecallback is set, blocks are handed to it as they arrive instead
+# (for forwarding to the notebook while no cell is running).
+class BackgroundReader(Transport):
+    def __init__(self, transport, maxbytes):
+        Transport.__init__(self)
+        self.transport = transport
+        self.brepl = transport.brepl
+        self.brawpaste = transport.brawpaste
+        self.bflowcontrol = transport.bflowcontrol
+        self.linkrate = transport.linkrate
+        self.bfileprotocol = False          # (binary replies would be read by the thread)
+        self.blocks = collections.deque()   # (time received, bytes)
+        self.nbytes = 0
+        self.maxbytes = maxbytes
+        self.ndropped = 0                   # bytes discarded from the front when the buffer was full
+        self.exception = None               # what stopped the thread, raised on the reading side
+        self.idlecallback = None
+        self.cond = threading.Condition()
+        self.brunning = True
+        self.thread = threading.Thread(target=self.run, name="devicereader", daemon=True)
+        self.thread.start()
+
+    def run(self):
+        while self.brunning:
+            try:
+                b = self.transport.read_available()
+            except Exception as e:   # SerialException, OSError or a websocket exception
+                with self.cond:
+                    self.exception = e
+                    self.brunning = False
+                    self.cond.notify_all()
+                break
+            if not b:
+                continue
+            with self.cond:
+                if self.idlecallback:
+                    self.idlecallback(b)
+                    continue
+                self.blocks.append((time.time(), b))
+                self.nbytes += len(b)
+                while self.nbytes > self.maxbytes:
+                    t, d = self.blocks.popleft()
+                    self.nbytes -= len(d)
+                    self.ndropped += len(d)
+                self.cond.notify_all()
+
+    def take(self, n):
+        res = bytearray()
+        while self.blocks and (n < 0 or len(res) < n):
+            t, b = self.blocks.popleft()
+            if n >= 0 and len(res) + len(b) > n:
+                self.blocks.appendleft((t, b[n - len(res):]))
+                b = b[:n - len(res)]
+            res += b
+        self.nbytes -= len(res)
+        return bytes(res)
+
+    # waits until n bytes (or any if n<0) are available, and returns up to n of them
+    def read(self, n=-1, timeout=serialtimeout):
+        with self.cond:
+            self.cond.wait_for(lambda: self.nbytes >= max(n, 1) or not self.brunning, timeout)
+            if not self.blocks and self.exception:
+                raise self.exception
+            return self.take(n)
+
+    def read_available(self):
+        return self.read(-1, serialtimeout)
+
+    def wait_readable(self, timeout):
+        with self.cond:
+            return self.cond.wait_for(lambda: self.nbytes or not self.brunning, timeout) and self.nbytes > 0
+
+    def in_waiting(self):
+        return self.nbytes
+
+    def read_all(self):
+        return self.read(-1, 0)
+
+    # the buffered output split into lines, each with the time its first byte arrived
+    def readlines(self):
+        res = [ ]
+        with self.cond:
+            while self.blocks:
+                t, b = self.blocks.popleft()
+                for line in b.splitlines(True):
+                    if res and not res[-1][1].endswith(b"\n"):
+                        res[-1] = (res[-1][0], res[-1][1] + line)
+                    else:
+                        res.append((t, line))
+            self.nbytes = 0
+        return res
+
+    def setidlecallback(self, idlecallback):
+        with self.cond:
+            self.idlecallback = idlecallback
+            if idlecallback and self.blocks:
+                idlecallback(self.take(-1))
+
+    def write_all(self, b):
+        return self.transport.write_all(b)
+
+    def bytecounts(self):
+        return self.transport.bytecounts()
+
+    # stops the thread and returns the transport it was reading, with anything unread pushed back
+    def stop(self):
+        self.brunning = False
+        self.thread.join(serialtimeout*4)
+        with self.cond:
+            self.transport.pushback[:0] = self.take(-1)
+        return self.transport
+
+    def close(self):
+        self.stop().close()
+
+    def description(self):
+        return self.transport.description() + " (background reader)"
+
+
+# Takes the binary frames written by streamframe() on the device (see samplestream.py)
+# out of what is read from another transport and hands them to the sink, leaving 
+# the ordinary text of the REPL to be read as before.  A frame split across reads 
+# is held until the rest of it arrives.
+class FrameDemux(Transport):
+    def __init__(self, transport, sink):
+        Transport.__init__(self)
+        self.transport = transport
+        self.sink = sink
+        self.brepl = transport.brepl
+        self.brawpaste = transport.brawpaste
+        self.bflowcontrol = transport.bflowcontrol
+        self.linkrate = transport.linkrate
+        self.readallwait = transport.readallwait
+        self.bfileprotocol = False   # (the binary frames of a webrepl would not be for this)
+        self.partial = b''           # the start of a frame still to be completed
+
+    def demux(self, b):
+        if self.partial:
+            b = self.partial + b
+            self.partial = b''
+        elif framemagic[:1] not in b:
+            return b
+        res = [ ]
+        i = 0
+        while True:
+            j = b.find(framemagic, i)
+            if j == -1:
+                if b.endswith(framemagic[:1]):   # could be the first byte of the magic
+                    res.append(b[i:-1])
+                    self.partial = b[-1:]
+                else:
+                    res.append(b[i:])
+                break
+            res.append(b[i:j])
+            if len(b) < j + frameheader.size:
+                self.partial = b[j:]
+                break
+            magic, n, seq = frameheader.unpack_from(b, j)
+            if n > maxframesize:   # not a frame after all
+                res.append(b[j:j+len(framemagic)])
+                i = j + len(framemagic)
+                continue
+            if len(b) < j + frameheader.size + n:
+                self.partial = b[j:]
+                break
+            self.sink.addframe(seq, b[j+frameheader.size:j+frameheader.size+n])
+            i = j + frameheader.size + n
+        return b''.join(res)
+
+    def readconnection(self):
+        while True:   # (a block that was all frames isn't returned as empty, which would look like the device going quiet)
+            b = self.transport.read_available()
+            if not b:
+                return b
+            b = self.demux(b)
+            if b:
+                return b
+
+    def wait_readable(self, timeout):
+        return bool(self.pushback) or self.transport.wait_readable(timeout)
+
+    def read_all(self):
+        res = bytes(self.pushback) + self.demux(self.transport.read_all())
+        self.pushback.clear()
+        return res
+
+    def write_all(self, b):
+        return self.transport.write_all(b)
+
+    def bytecounts(self):
+        return self.transport.bytecounts()
+
+    # returns the transport it was reading, with any text not yet read pushed back
+    def stop(self):
+        self.transport.pushback[:0] = self.pushback
+        return self.transport
+
+    def close(self):
+        self.transport.close()
+
+    def description(self):
+        return self.transport.description() + " (streaming frames)"